@@ -0,0 +1,14 @@
+static double Iq(double q, double phi_p, double nu, double b, double n, double sldp, double slds, double vm, double vs, double chi) {
+
+	// Chain parameters:
+	double o2nu, g_o2nu, g_onu, U, Fp, Pp, Sq;
+
+	// Polymer chain form factor:
+	chain_init(nu, &o2nu, &g_o2nu, &g_onu);
+	U = (q*b) * (q*b) * pow(n, 2.0*nu) / 6.0;
+	chain_fp(U, o2nu, g_o2nu, g_onu, &Fp, &Pp);
+
+	// Form the structure factor according to the RPA:
+	Sq = 1.0/(n*phi_p*vm*Pp) + 1.0/(vs * (1.0 - phi_p)) - 2.00*chi/sqrt(vm*vs);
+	return (sldp - slds) * (sldp - slds) * 1e-4 / Sq;
+}
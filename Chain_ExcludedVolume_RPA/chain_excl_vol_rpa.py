@@ -18,9 +18,16 @@ Authorship and Verification
 
 import numpy as np
 from numpy import inf, errstate, power,exp, sqrt
-from sasmodels.special import sas_gammainc, sas_gamma
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
 
-name = "poly_excl_vol_rpa"
+# Shared model library (lib/), loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+
+name = "chain_excl_vol_rpa"
 title = "Polymer with excluded volume, RPA"
 description = """\
       List of default parameters:
@@ -35,7 +42,7 @@ category = "shape-independent"
 #             ["name", "units", default,       [lower, upper], "type", "description"],
 parameters = [
               ["phi_p",      "",                 0.01,      [0, 1],         "",     "Polymer volume fraction"],
-              ["nu",       "",                 0.5,       [0, 1],         "",     "Excluded volume parameter"],
+              ["nu",       "",                 0.5,       [0.25, 1],      "",     "Excluded volume parameter"],
               ["b",        "Ang",              7.0,       [1, inf],       "",     "Kuhn length"],
               ["n",        "",                30.0,       [1, inf],       "",     "Degree of polymerization"],
               ["sldp",     "1e-6/Ang^2",       1.4,       [-inf,inf],     "sld",  "Polymer SLD"],
@@ -46,16 +53,19 @@ parameters = [
              ]
 # pylint: enable=bad-whitespace, line-too-long
 
-def Iq(q,
-       phi_p,
-       nu,
-       b,
-       n,
-       sldp,
-       slds,
-       vm,
-       vs,
-       chi):
+source = ["lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "chain_excl_vol_rpa.c"]
+
+# NumPy version of Iq in chain_excl_vol_rpa.c, kept as a reference for the compiled kernel.
+def Iq_numpy(q,
+             phi_p,
+             nu,
+             b,
+             n,
+             sldp,
+             slds,
+             vm,
+             vs,
+             chi):
     """
     :param q:              Input q-value
     :param phi_p:            Polymer volume fraction
@@ -70,13 +80,9 @@ def Iq(q,
     :return:               Calculated intensity
     """
 
-    # Excl. Vol. Parameters
-    onu  = 1.0/nu
-    o2nu = 1.0/2.0/nu
- 
     # Polymer chain form factor:
     U = q**2 * b**2 * power(n, 2.0*nu) / 6.0
-    Pp = onu * power(U, -o2nu) * sas_gamma(o2nu) * sas_gammainc(o2nu, U) - onu * power(U, -onu) * sas_gamma(onu) * sas_gammainc(onu, U)
+    _, Pp = chain.chain_fp(U, nu)
 
     # Form the structure factor according to the RPA:
     Sq = power(n*phi_p*vm*Pp, -1.00) + power(vs * (1.0 - phi_p), -1.00) - 2.00*chi/sqrt(vm*vs)
@@ -84,12 +90,16 @@ def Iq(q,
 
     return inten
 
-Iq.vectorized = True  # Iq accepts an array of q values
+def Iq_batch(q, **pars):
+    """
+    Iq_numpy for many parameter sets at once; see lib/batch.py.
+    """
+    return batch.evaluate(Iq_numpy, parameters, q, pars)
 
 def random():
     pars = dict(
         scale=1,
-        phi = np.random.uniform(0.001, 0.999),
+        phi_p = np.random.uniform(0.001, 0.999),
         nu  = np.random.uniform(0.3,0.6),
         b   = np.random.uniform(7,15),
         n   = np.random.uniform(20,200),
@@ -101,3 +111,11 @@ def random():
 
 demo = dict(scale=1, background=0,
             nu = 0.5, b=7, n=40)
+
+# Reference values from Iq_numpy.
+tests = [
+    [{"background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [0.14966263, 0.14846255, 0.076697541, 0.004817675]],
+    [{"nu": 0.6, "n": 100.0, "chi": 0.0, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [0.24937248, 0.24233112, 0.062117895, 0.0051133698]],
+]
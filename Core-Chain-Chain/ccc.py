@@ -2,6 +2,17 @@
 
 import numpy as np  # type: ignore
 from numpy import pi, inf, power, errstate
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), and SciPy, loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+contrast_basis = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "contrast_basis.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+gradient = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "gradient.py"))
+term_cache = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "term_cache.py"))
 
 name = "ccc"
 title = "Spherically symmetric core with grafted polymer chains having two different conformations. Version 2, May 2020."
@@ -10,6 +21,7 @@ category = "shape:sphere"
 
 structure_factor = False
 form_factor = True
+have_Fq = True
 
 #             [ "name",       "units",         default, [lower, upper], "type",   "description"],
 parameters = [["volf",        "None",          0.02,    [0,1],          "",       "Particle volume fraction"],
@@ -28,11 +40,149 @@ parameters = [["volf",        "None",          0.02,    [0,1],          "",
               ["nu2",         "None",          0.50,    [0.25, 1.0],    "",       "Excluded volume parameter of chain in region 2"],
               ["v1",          "Ang^3",         12000,   [0, inf]   ,    "volume", "Volume of polymer in region 1"],
               ["v2",          "Ang^3",         12000,   [0, inf]   ,    "volume", "Volume of polymer in region 2"],
-              ["I0",          "None",          0.0,     [0, inf],       "volume",  "Intensity of free chains"],
+              ["I0",          "None",          0.0,     [0, inf],       "volume",  "Forward intensity of free chains, which are monodisperse"],
               ["rg3",         "Ang",           25.0,    [0, inf],       "",        "Radius of gyration of free chains"],
               ["nu3",         "None",          0.5,     [0.25, 1.0],    "",        "Flory parm for free chain."],
+              ["ng_dist",     "",              0,       [["fixed", "poisson"]], "", "Distribution of the number of grafted chains"],
+              ["pdi",         "",              1.0,     [1.0, inf],     "",       "Chain dispersity Mw/Mn"],
+              ["pdi_dist",    "",              0,       [["schulz", "lognormal"]], "", "Chain length distribution"],
              ]
 
 radius_effective_modes = ["radius", "outer_radius"]
-source = ["lib/sas_3j1x_x.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "ccc.c"]
+source = ["lib/sas_3j1x_x.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "ccc.c"]
+
+
+def _core_terms(q, radius, i_shell):
+    # Core and shell amplitudes per unit contrast, and the core phase factor.
+    r_coreshell = radius + i_shell
+    vcore = 4.0/3.0 * pi * radius**3
+    vcoreshell = 4.0/3.0 * pi * r_coreshell**3
+    return (vcore * gradient.sas_3j1x_x(q*radius), vcoreshell * gradient.sas_3j1x_x(q*r_coreshell),
+            gradient.sas_sinx_x(q*r_coreshell))
+
+def _chain_terms(q, rg, nu, pdi, pdi_dist):
+    return chain.chain_fp_pdi(chain.chain_usub(q, rg, nu), nu, pdi, pdi_dist)
+
+# Intermediate terms of Iq_basis and the parameters they depend on; see
+# lib/term_cache.py.
+Iq_terms = [
+    ("core", ("radius", "i_shell"), _core_terms),
+    ("E2", ("rc",), lambda q, rc: gradient.sas_sinx_x(q*rc)),
+    ("chain1", ("rg1", "nu1", "pdi", "pdi_dist"), _chain_terms),
+    ("chain2", ("rg2", "nu2", "pdi", "pdi_dist"), _chain_terms),
+    ("chain3", ("rg3", "nu3"), lambda q, rg, nu: _chain_terms(q, rg, nu, 1.0, 0)),
+]
+
+def Iq_basis(q, volf, radius, i_shell, rc, poly_sig, rg1, rg2, nu1, nu2, v1, v2, I0, rg3, nu3, ng_dist=0, pdi=1.0, pdi_dist=0, terms=None):
+    """
+    Contrast-free partial scattering functions of the Iq kernel in ccc.c.
+
+    Returns a ContrastBasis (see lib/contrast_basis.py) to be called with
+    sld_c, sld_s, sld1, sld2 and sld_solvent.  The contrasts are core
+    (sld_c - sld_s), shell (sld_s - sld_solvent), chain 1 and chain 2
+    (sld1 - sld_solvent, sld2 - sld_solvent).  The chain terms are averaged
+    over chain length with dispersity *pdi*; see chain_fp_pdi.  The free
+    chains are monodisperse, so that I0 is their forward intensity.  *terms*
+    holds the values of Iq_terms if they are already known.
+    """
+    def contrasts(sld_c, sld_s, sld1, sld2, sld_solvent):
+        return sld_c - sld_s, sld_s - sld_solvent, sld1 - sld_solvent, sld2 - sld_solvent
+    CORE, SHELL, CHAIN1, CHAIN2 = range(4)
+
+    q = np.asarray(q, dtype=float)
+    if terms is None:
+        terms = term_cache.evaluate(Iq_terms, q, dict(
+            radius=radius, i_shell=i_shell, rc=rc, rg1=rg1, nu1=nu1, rg2=rg2, nu2=nu2,
+            rg3=rg3, nu3=nu3, pdi=pdi, pdi_dist=pdi_dist))
+    Ng = 4.00 * pi * (0.1*(radius + i_shell))**2 * poly_sig
+    Ng_pairs = chain.chain_pairs(Ng, ng_dist)
+    r_coreshell = radius + i_shell
+    vcore = 4.0/3.0 * pi * radius**3
+    vcoreshell = 4.0/3.0 * pi * r_coreshell**3
+    vtotal = vcoreshell + Ng * (v1 + v2)
+    pre = 1.0e-4 * volf / vtotal
+
+    # Core and shell amplitudes per unit contrast, phase factors and chains:
+    A, B, E1 = terms["core"]
+    E2 = terms["E2"]
+    F1, P1 = terms["chain1"]
+    F2, P2 = terms["chain2"]
+    _, P3 = terms["chain3"]
+    a1, a2 = v1*F1, v2*F2
+
+    basis = contrast_basis.ContrastBasis(contrasts)
+    # Term 1: Nanoparticle core
+    basis.add(CORE, CORE, pre * A*A)
+    basis.add(CORE, SHELL, pre * 2.0*A*B)
+    basis.add(SHELL, SHELL, pre * B*B)
+    # Term 3: Polymer block self terms; terms 6, 7: block/block crossterms
+    basis.add(CHAIN1, CHAIN1, pre * (Ng*v1*v1*P1 + Ng_pairs*a1*E1*E1*a1))
+    basis.add(CHAIN2, CHAIN2, pre * (Ng*v2*v2*P2 + Ng_pairs*a2*E2*E2*a2))
+    # Terms 4, 5: Block/nanoparticle crossterms
+    basis.add(CORE, CHAIN1, pre * 2.0*Ng*A*E1*a1)
+    basis.add(SHELL, CHAIN1, pre * 2.0*Ng*B*E1*a1)
+    basis.add(CORE, CHAIN2, pre * 2.0*Ng*A*E2*a2)
+    basis.add(SHELL, CHAIN2, pre * 2.0*Ng*B*E2*a2)
+    # Term 8: Block 2/block 1 crossterm
+    basis.add(CHAIN1, CHAIN2, pre * 2.0*(Ng_pairs + Ng)*a1*E1*E2*a2)
+    # Term 9: Free chains
+    basis.constant += I0 * 1.0e-4 * P3
+    return basis
+
+def Iq_numpy(q, sld_c, sld_s, sld1, sld2, sld_solvent, terms=None, **structure):
+    """
+    NumPy version of the Iq kernel in ccc.c, from Iq_basis.
+    """
+    return Iq_basis(q, terms=terms, **structure).evaluate(sld_c=sld_c, sld_s=sld_s, sld1=sld1, sld2=sld2, sld_solvent=sld_solvent)
+
+def Iq_batch(q, **pars):
+    """
+    Iq for many parameter sets at once; see lib/batch.py.
+    """
+    return batch.evaluate(Iq_numpy, parameters, q, pars)
+
+def Iq_cache(maxsize=None):
+    """
+    Iq with its intermediate terms memoized across calls; see lib/term_cache.py.
+    *maxsize* defaults to term_cache.DEFAULT_MAXSIZE.
+    """
+    if maxsize is None:
+        maxsize = term_cache.DEFAULT_MAXSIZE
+    return term_cache.TermCache(Iq_terms, Iq_numpy, parameters, maxsize)
+
+def Iq_grad(q, **pars):
+    """
+    Iq and its derivatives with respect to the parameters; see lib/gradient.py.
+    """
+    return gradient.evaluate(Iq_numpy, parameters, q, pars)
+
+def random():
+    pars = dict(
+        radius   = np.random.uniform(20,200),
+        i_shell  = np.random.uniform(0,20),
+        rc       = np.random.uniform(50,300),
+        poly_sig = np.random.uniform(0.05,1),
+        rg1      = np.random.uniform(20,200),
+        rg2      = np.random.uniform(20,200),
+        nu1      = np.random.uniform(0.3,0.8),
+        nu2      = np.random.uniform(0.3,0.8),
+        v1       = np.random.uniform(1000,30000),
+        v2       = np.random.uniform(1000,30000),
+    )
+    return pars
 
+# Reference values from Iq_batch: the defaults, free chains (I0 > 0), a
+# block matched to the solvent, polydisperse blocks and a Poisson number of
+# chains.
+tests = [
+    [{"background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [288.23278, 74.197316, 0.076293717, 0.00079195169]],
+    [{"I0": 100.0, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [288.24277, 74.207111, 0.078982705, 0.00091913249]],
+    [{"sld1": 6.37, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [65.308761, 32.926588, 0.063078813, 5.2159985e-05]],
+    [{"pdi": 1.5, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [284.12551, 65.79277, 0.076291473, 0.0007919527]],
+    [{"ng_dist": 1, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [288.74034, 74.259792, 0.076294283, 0.00079195199]],
+]
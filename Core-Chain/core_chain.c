@@ -0,0 +1,68 @@
+static double form_volume(double radius, double rg, double v_poly) {
+	return 1.00; // Complex structures can be normalized w/ scale.
+}
+
+static double radius_effective(int mode, double radius, double rg, double v_poly) {
+    switch(mode) {
+	// Core radius
+	case 1:
+		return radius;
+		break;
+
+	// Outer radius
+	case 2:
+		return (radius + rg);
+		break;
+    }
+    return radius;
+}
+
+static void Fq(double q, double *f1, double *f2, double sld, double sld_poly, double sld_solvent, double radius, double poly_sig, double rg, double nu, double v_poly, double ng_dist) {
+
+	// Number of grafted chains per core:
+	double Ng = poly_sig * 4.00 * M_PI * (0.1 * radius) * (0.1 * radius);
+
+	// Volume of core regions:
+	double Vcore  = M_4PI_3 * cube(radius);
+	double Vtotal = Vcore + Ng*v_poly;
+
+	// Chain parameters:
+	double o2nu, g_o2nu, g_onu, Usub;
+
+	// Misc terms:
+	double Ea, Fs, Fp, Pp, delta, inten;
+
+	// Propagator function:
+	Ea = sas_sinx_x(q*radius);
+
+	// Polymer size variable
+	chain_init(nu, &o2nu, &g_o2nu, &g_onu);
+	Usub = chain_usub(q, rg, nu);
+
+	// Form factor amplitude of core-shell sphere:
+	Fs = 3.0*(sld - sld_solvent)*Vcore*sas_3j1x_x(q*radius);
+
+	// Form factor amplitude and form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
+	chain_fp(Usub, o2nu, g_o2nu, g_onu, &Fp, &Pp);
+
+	// Combine all terms to form intensity:
+	delta = sld_poly - sld_solvent;
+
+	// Term 1: Core-shell particle:
+	inten = Fs * Fs;
+
+	// Term 2: Polymer
+	inten += Ng * v_poly * v_poly * delta * delta * Pp;
+
+	// Term 3: Particle/polymer crossterm:
+	inten += 2.0 * Ng * v_poly * delta * Fs * Ea * Fp;
+
+	// Term 4: Polymer/polymer crossterm:
+	inten += chain_pairs(Ng, ng_dist) * v_poly * v_poly * delta * delta * Fp * Ea * Ea * Fp;
+
+	// Convert SLDs to A^-2, and convert intensity to cm^-1. Normalize by particle volume.
+	*f2 = inten * 1.0e-6 * 1.0e-6 * 1.0e8 / Vtotal;
+
+	// Mean particle amplitude with the same normalization, for the beta approximation.
+	*f1 = sqrt(1.0e-6 * 1.0e-6 * 1.0e8 / Vtotal) * (Fs + Ng * v_poly * delta * Ea * Fp);
+}
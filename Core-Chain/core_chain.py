@@ -14,8 +14,19 @@ M.J.A. Hore, J. Ford, K. Ohno, R. J. Composto, B. Hammouda, Macromolecules 46, 9
 """
 
 import numpy as np  # type: ignore
-from numpy import pi, inf, power, errstate
-from sasmodels.special import sas_gamma, sas_gammainc, sas_sinx_x, sas_3j1x_x
+from numpy import pi, inf
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), and SciPy, loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+contrast_basis = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "contrast_basis.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+fused = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "fused.py"))
+gradient = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "gradient.py"))
+term_cache = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "term_cache.py"))
 
 name = "core_chain"
 title = "Spherically symmetric core with grafted polymer chains."
@@ -32,17 +43,69 @@ parameters = [["sld",         "1e-6/Ang^2",    3.5,     [-inf, inf],    "sld",
               ["rg",          "Ang",           40,      [0, inf],       "volume", "Grafted polymer radius of gyration"],
               ["nu",          "None",          0.50,    [0.25, 1.0],    "",       "Grafted polymer excluded volume parameter"],
               ["v_poly",      "1/Ang^3",       30,      [0, inf]   ,    "volume", "Volume of one polymer"],
+              ["ng_dist",     "",              0,       [["fixed", "poisson"]], "", "Distribution of the number of grafted chains"],
              ]
 
-def Iq(q,
-       sld,
-       sld_poly,
-       sld_solvent,
-       radius=60,
-       poly_sig=0.50,
-       rg=40,
-       nu=0.5,
-       v_poly=30):
+radius_effective_modes = ["radius", "outer_radius"]
+have_Fq = True
+source = ["lib/sas_3j1x_x.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "core_chain.c"]
+
+def _core_terms(q, radius):
+    # Core amplitude per unit contrast, and the core phase factor.
+    Vcore = 4.0/3.0 * pi * radius**3
+    return 3.0*Vcore*gradient.sas_3j1x_x(q*radius), gradient.sas_sinx_x(q*radius)
+
+# Intermediate terms of Iq_basis and the parameters they depend on; see
+# lib/term_cache.py.
+Iq_terms = [
+    ("core", ("radius",), _core_terms),
+    ("chain", ("rg", "nu"), lambda q, rg, nu: chain.chain_fp(chain.chain_usub(q, rg, nu), nu)),
+]
+
+def Iq_basis(q, radius, poly_sig, rg, nu, v_poly, ng_dist=0, terms=None):
+    """
+    Contrast-free partial scattering functions of the Iq kernel in core_chain.c.
+
+    Returns a ContrastBasis (see lib/contrast_basis.py) to be called with
+    sld, sld_poly and sld_solvent.  The contrasts are core
+    (sld - sld_solvent) and polymer (sld_poly - sld_solvent).  *terms* holds
+    the values of Iq_terms if they are already known.
+    """
+    def contrasts(sld, sld_poly, sld_solvent):
+        return sld - sld_solvent, sld_poly - sld_solvent
+    CORE, POLY = range(2)
+
+    q = np.asarray(q, dtype=float)
+    if terms is None:
+        terms = term_cache.evaluate(Iq_terms, q, dict(radius=radius, rg=rg, nu=nu))
+    Ng = poly_sig * 4.00 * pi * (0.1 * radius) * (0.1 * radius)
+    Vcore = 4.0/3.0 * pi * radius**3
+    pre = 1.0e-6 * 1.0e-6 * 1.0e8 / (Vcore + Ng*v_poly)
+
+    A, Ea = terms["core"]
+    Fp, Pp = terms["chain"]
+
+    basis = contrast_basis.ContrastBasis(contrasts)
+    # Term 1: Core particle
+    basis.add(CORE, CORE, pre * A*A)
+    # Terms 2, 4: Polymer and polymer/polymer crossterm
+    basis.add(POLY, POLY, pre * v_poly * v_poly * (Ng*Pp + chain.chain_pairs(Ng, ng_dist)*Fp*Ea*Ea*Fp))
+    # Term 3: Particle/polymer crossterm
+    basis.add(CORE, POLY, pre * 2.0 * Ng * v_poly * A * Ea * Fp)
+    return basis
+
+# NumPy version of Iq in core_chain.c, from Iq_basis.
+def Iq_numpy(q,
+             sld,
+             sld_poly,
+             sld_solvent,
+             radius=60,
+             poly_sig=0.50,
+             rg=40,
+             nu=0.5,
+             v_poly=30,
+             ng_dist=0,
+             terms=None):
     """
     :param q:              Input q-value
     :param sld:		   Core scattering length density
@@ -53,71 +116,52 @@ def Iq(q,
     :param rg:             Grafted polymer radius of gyration
     :param nu:             Grafted polymer excluded volume parameter
     :param v_poly:         Volume of one polymer 
+    :param ng_dist:        Chain count distribution, 0 = fixed, 1 = Poisson
+    :param terms:          Values of Iq_terms, if already known
     :return:               Calculated intensity
     """
+    basis = Iq_basis(q, radius, poly_sig, rg, nu, v_poly, ng_dist, terms)
+    return basis.evaluate(sld=sld, sld_poly=sld_poly, sld_solvent=sld_solvent)
 
-    # Number of grafted chains per core:
-    Ng = poly_sig * 4.00 * pi * (0.1 * radius) * (0.1 * radius)
-
-    # Volume of core regions:
-    Vcore      = 4.0/3.0 * pi * radius**3
-    Vtotal     = Vcore + Ng*v_poly
-
-    # One over excl. vol. parm.:
-    onu  = 1.0 / nu
-    o2nu = 1.0 / 2.0 / nu
-
-    # Propagator function:
-    Ea = sas_sinx_x(q*radius)
-
-    # Polymer size variable
-    Usub = (q*rg)**2 * (2.0*nu + 1.0) * (2.0*nu + 2.0) / 6.0
-
-    # Form factor amplitude of core-shell sphere:
-    with errstate(divide='ignore'):
-        Fs = 3.0*(sld - sld_solvent)*Vcore*sas_3j1x_x(q*radius)
-
-
-    # Form factor amplitude of the polymer:
-    with errstate(divide='ignore'):
-        Fp = o2nu*power(Usub, -o2nu) * sas_gamma(o2nu) * sas_gammainc(o2nu, Usub) 
-
-
-    # Form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
-    with errstate(divide='ignore'):
-        Pp = onu * power(Usub, -o2nu)*sas_gamma(o2nu)*sas_gammainc(o2nu, Usub) - onu * power(Usub, -onu)*sas_gamma(onu)*sas_gammainc(onu,Usub)
-
-    # Combine all terms to form intensity:
-    #
-    # Term 1: Core-shell particle:
-    inten = Fs * Fs
-
-    # Term 2: Polymer
-    inten = inten + Ng * v_poly * v_poly * (sld_poly - sld_solvent) * (sld_poly - sld_solvent) * Pp
-
-    # Term 3: Particle/polymer crossterm:
-    inten = inten + 2.0 * Ng * v_poly * (sld_poly - sld_solvent) * Fs * Ea * Fp
-
-    # Term 4: Polymer/polymer crossterm:
-    inten = inten + Ng * (Ng - 1) * v_poly * v_poly * (sld_poly - sld_solvent) * (sld_poly - sld_solvent) * Fp * Ea * Ea * Fp
-    with errstate(divide='ignore'):
-        inten = inten * 1.0e-6 * 1.0e-6 * 1.0e8 / Vtotal
+def Iq_fused(q, sld, sld_poly, sld_solvent, radius=60, poly_sig=0.50, rg=40, nu=0.5,
+             v_poly=30, ng_dist=0, out=None, chunk_size=fused.CHUNK_SIZE):
+    """
+    Iq_numpy evaluated over chunks of q into *out*; see lib/fused.py.
+    """
+    pars = dict(sld=sld, sld_poly=sld_poly, sld_solvent=sld_solvent, radius=radius,
+                poly_sig=poly_sig, rg=rg, nu=nu, v_poly=v_poly, ng_dist=ng_dist)
+    return fused.evaluate(_Iq_chunk, q, pars, out, chunk_size)
 
-    return inten
+def _Iq_chunk(q, out, work, sld, sld_poly, sld_solvent, **structure):
+    Iq_basis(q, **structure).evaluate(out=out, sld=sld, sld_poly=sld_poly, sld_solvent=sld_solvent)
 
-Iq.vectorized = True  # Iq accepts an array of q values
+def Iq_batch(q, out=None, **pars):
+    """
+    Iq_numpy for many parameter sets at once, into *out* if given; see
+    lib/batch.py.
+    """
+    return batch.evaluate(Iq_fused, parameters, q, pars, out)
 
-# Effective radius for S(q) calculations:
-def ER(radius, rg, v_poly):
-    return radius + rg
+def Iq_cache(maxsize=None):
+    """
+    Iq with its intermediate terms memoized across calls; see lib/term_cache.py.
+    *maxsize* defaults to term_cache.DEFAULT_MAXSIZE.
+    """
+    if maxsize is None:
+        maxsize = term_cache.DEFAULT_MAXSIZE
+    return term_cache.TermCache(Iq_terms, Iq_numpy, parameters, maxsize)
 
-# VR defaults to 1.0
+def Iq_grad(q, **pars):
+    """
+    Iq and its derivatives with respect to the parameters; see lib/gradient.py.
+    """
+    return gradient.evaluate(Iq_numpy, parameters, q, pars)
 
 def random():
     pars = dict(
 	radius   = np.random.uniform(20,200),
         poly_sig = np.random.uniform(0,2),
-        rg       = np.random.unifomr(20,150),
+        rg       = np.random.uniform(20,150),
         nu       = np.random.uniform(0.3,0.6),
         v_poly   = np.random.uniform(10,50),
     )
@@ -126,3 +170,11 @@ def random():
 #demo = dict(scale=1, background,0,
 #            sld=3.0, sld_shell=1.0, sld_poly = 1.0, sld_solvent=4.3,
 #            radius=50, t_shell=20, poly_sig=0.50, rg=70, nu=0.5, v_poly=30)
+
+# Reference values from Iq_batch.
+tests = [
+    [{"background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [666.60493, 619.38214, 4.6108818, 0.0002567989]],
+    [{"radius": 40.0, "rg": 80.0, "nu": 0.6, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [198.68938, 190.99809, 1.4632637, 0.0014281331]],
+]
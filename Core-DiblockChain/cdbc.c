@@ -16,99 +16,126 @@ static double radius_effective(int mode, double radius, double i_shell, double p
     }
 }
 
-static double Iq(double q, double volf, double sld_c, double sld_s, double sld1, double sld2, double sld_solvent, double radius, double i_shell, double poly_sig, double rc, double Cinfty, double M0, double M1, double M2, double nu1, double nu2, double v, double I0, double rg3, double nu3) {
+// q-independent part of Fq for one parameter set; see CHAIN_PREPARE in
+// lib/polymer_chain.c.  Terms with a zero prefactor are flagged off.
+typedef struct {
+	double r_coreshell, Ng;
+	double u1, u2;			// U/q^2 for blocks 1 and 2
+	double core, shell;		// (sld_c - sld_s) vcore, (sld_s - sld_solvent) vcoreshell
+	double a1, a2, p1, p2;		// v (sld - sld_solvent) and its square, for blocks 1 and 2
+	double pre, amp;		// 1e-4 volf/vtotal and its square root
+	int chain1, chain2, chain3;	// whether each chain contributes
+	chain_prep c1, c2, c3;
+} cdbc_prep;
+
+static void cdbc_prepare(cdbc_prep *p, double volf, double sld_c, double sld_s, double sld1, double sld2, double sld_solvent, double radius, double i_shell, double poly_sig, double rc, double Cinfty, double M0, double M1, double M2, double nu1, double nu2, double v, double I0, double rg3, double nu3, double pdi, double pdi_dist) {
 
 	// Number of grafted chains.
-	double Ng   = 4.00 * M_PI * pow(0.1*(radius+i_shell), 2.0) * poly_sig;
+	p->r_coreshell = radius + i_shell;
+	p->Ng = 4.00 * M_PI * pow(0.1*p->r_coreshell, 2.0) * poly_sig;
 
 	// Bond angle (radians)
-	double theta0 = 68.0 * M_PI/180.0;
-
-	// Parameters for polymer form factors/amplitudes:
-	double onu1, o2nu1, onu2, o2nu2, Usub1, Usub2, Usub3;
-	double onu3, o2nu3;
-
-	// Misc terms:
-	double r_coreshell, Fs, Fp1, Fp2, Pp1, Pp2, E1, E2;
-	double vcore, vcoreshell, vtotal, inten, v1, v2, v3;
-
-	// There are 9 terms in the intensity.
-	double term1, term2, term3, term4, term5, term6, term7, term8;
+	const double theta0 = 68.0 * M_PI/180.0;
 
 	// Calculate Kuhn Length
-	double b = Cinfty * 1.54 / cos(theta0/2.0);
+	const double b = Cinfty * 1.54 / cos(theta0/2.0);
 
 	// Calculate degree of polymerizations, given Cinfty:
-	double N1 = (M1/M0) * pow(cos(theta0/2.0), 2) / Cinfty;
-	double N2 = (M2/M0) * pow(cos(theta0/2.0), 2) / Cinfty;
-
-	// Exponents/Pre-factors for incomplete gamma function.
-	onu1  = 1.0/nu1;
-	onu2  = 1.0/nu2;
-	onu3  = 1.0/nu3;
-	o2nu1 = 1.0/2.0/nu1;
-	o2nu2 = 1.0/2.0/nu2;
-	o2nu3 = 1.0/2.0/nu3;
-	Usub1 = pow(q*b, 2.0) * pow(N1, 2.0*nu1) / 6.0;
-	Usub2 = pow(q*b, 2.0) * pow(N2, 2.0*nu2) / 6.0;
-	Usub3 = (q * rg3) * (q * rg3) * (2.0*nu3 + 1.0) * (2.0*nu3 + 2.0) / 6.0;
+	const double N1 = (M1/M0) * pow(cos(theta0/2.0), 2) / Cinfty;
+	const double N2 = (M2/M0) * pow(cos(theta0/2.0), 2) / Cinfty;
+	p->u1 = b*b * pow(N1, 2.0*nu1) / 6.0;
+	p->u2 = b*b * pow(N2, 2.0*nu2) / 6.0;
+
+	// Volumes and amplitude prefactors:
+	const double v1 = N1 * v;
+	const double v2 = N2 * v;
+	const double vcore      = M_4PI_3 * cube(radius);
+	const double vcoreshell = M_4PI_3 * cube(p->r_coreshell);
+	const double vtotal     = vcoreshell + p->Ng * (v1 + v2);
+	p->core  = (sld_c - sld_s) * vcore;
+	p->shell = (sld_s - sld_solvent) * vcoreshell;
+	p->a1 = v1 * (sld1 - sld_solvent);
+	p->a2 = v2 * (sld2 - sld_solvent);
+	p->p1 = p->a1 * p->a1;
+	p->p2 = p->a2 * p->a2;
+	p->pre = 1.0e-4 * volf / vtotal;
+	p->amp = sqrt(p->pre);
+
+	// Chain constants, for the chains that contribute:
+	p->chain1 = (p->Ng != 0.0 && p->a1 != 0.0);
+	p->chain2 = (p->Ng != 0.0 && p->a2 != 0.0);
+	p->chain3 = (I0 != 0.0);
+	if (p->chain1) chain_prepare(nu1, pdi, pdi_dist, &p->c1);
+	if (p->chain2) chain_prepare(nu2, pdi, pdi_dist, &p->c2);
+	// Free chains are monodisperse, so that I0 is their forward intensity.
+	if (p->chain3) chain_prepare(nu3, 1.0, 0, &p->c3);
+}
+
+static void Fq(double q, double *f1, double *f2, double volf, double sld_c, double sld_s, double sld1, double sld2, double sld_solvent, double radius, double i_shell, double poly_sig, double rc, double Cinfty, double M0, double M1, double M2, double nu1, double nu2, double v, double I0, double rg3, double nu3, double pdi, double pdi_dist) {
+
+	CHAIN_PREPARE(cdbc_prep, p, cdbc_prepare, volf, sld_c, sld_s, sld1, sld2, sld_solvent, radius, i_shell, poly_sig, rc, Cinfty, M0, M1, M2, nu1, nu2, v, I0, rg3, nu3, pdi, pdi_dist);
+	const double Ng = p->Ng;
 
 	// Form factor amplitude for core:
-	v1 = N1 * v;
-	v2 = N2 * v;
-
-	// Volumes, etc.
-	r_coreshell = radius + i_shell;
-	vcore       = M_4PI_3 * cube(radius);
-	vcoreshell  = M_4PI_3 * cube(r_coreshell);
-	vtotal      = vcoreshell + Ng * (v1 + v2);
-	Fs = (sld_c - sld_s) * vcore * sas_3j1x_x(q*radius) + (sld_s - sld_solvent) * vcoreshell * sas_3j1x_x(q*r_coreshell);
-	
+	double Fs = 0.0;
+	if (p->core != 0.0) Fs += p->core * sas_3j1x_x(q*radius);
+	if (p->shell != 0.0) Fs += p->shell * sas_3j1x_x(q*p->r_coreshell);
+
 	// Phase factors:
 	//
-	// E1: Core phase factor:
-	E1 = sas_sinx_x(q*r_coreshell);
-
-	// E2: Diblock chain propagator:
-	double rg1 = b * pow(N1, nu1)/sqrt((2.0*nu1+1.0)*(2.0*nu1+2.0));
-	E2 = exp(-pow(q*rc, 2.0));
-
-	// Form factor amplitudes for polymers:
-	Fp1 = v1 * (sld1 - sld_solvent)*(o2nu1 * pow(Usub1, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, Usub1));
-	Fp2 = v2 * (sld2 - sld_solvent)*(o2nu2 * pow(Usub2, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, Usub2));
-	
-	// Form factors for polymers:
-	Pp1 = v1*v1*pow((sld1 - sld_solvent), 2.0) * (onu1 * pow(Usub1, -o2nu1)*sas_gamma(o2nu1)*sas_gammainc(o2nu1, Usub1) - onu1 * pow(Usub1, -onu1)*sas_gamma(onu1)*sas_gammainc(onu1, Usub1));
-	Pp2 = v2*v2*pow((sld2 - sld_solvent), 2.0) * (onu2 * pow(Usub2, -o2nu2)*sas_gamma(o2nu2)*sas_gammainc(o2nu2, Usub2) - onu2 * pow(Usub2, -onu2)*sas_gamma(onu2)*sas_gammainc(onu2, Usub2));
+	// E1: Core phase factor, for both blocks.
+	// E2: Diblock chain propagator.
+	double E1 = 0.0, E2 = 0.0;
+	if (p->chain1 || p->chain2) E1 = sas_sinx_x(q*p->r_coreshell);
+	if (p->chain2) E2 = exp(-pow(q*rc, 2.0));
+
+	// Chain form factors and amplitudes averaged over chain length, for the
+	// chains that contribute:
+	double F1 = 0.0, F2 = 0.0, P1 = 0.0, P2 = 0.0, P3 = 0.0;
+	if (p->chain1) chain_fp_prep(q*q*p->u1, &p->c1, &F1, &P1);
+	if (p->chain2) chain_fp_prep(q*q*p->u2, &p->c2, &F2, &P2);
+	if (p->chain3) {
+		double F3;
+		chain_fp_prep(chain_usub(q, rg3, nu3), &p->c3, &F3, &P3);
+	}
+
+	// Form factor amplitudes and form factors for polymers:
+	const double Fp1 = p->a1 * F1;
+	const double Fp2 = p->a2 * F2;
+	const double Pp1 = p->p1 * P1;
+	const double Pp2 = p->p2 * P2;
 
 	// Term 1: Nanoparticle Core Term
-	term1 = Fs*Fs;
+	const double term1 = Fs*Fs;
 
 	// Term 2: Diblock Copolymer Term
-	term2 =  Ng * (Pp1 + Pp2 + 2.0 * Fp1 * Fp2);
+	const double term2 =  Ng * (Pp1 + Pp2 + 2.0 * Fp1 * Fp2);
 
 	// Term 3: Polymer Block A <--> Core Cross Term
-	term3 = 2.0 * Ng * (Fs * E1 * Fp1);
+	const double term3 = 2.0 * Ng * (Fs * E1 * Fp1);
 
 	// Term 4: Polymer Block B <--> Core Cross Term
-	term4 = 2.0 * Ng * (Fs * E1 * E2 * Fp2);
+	const double term4 = 2.0 * Ng * (Fs * E1 * E2 * Fp2);
 
 	// Term 5: Polymer Block A <--> Polymer Block A Cross Term
-	term5 = Ng * (Ng - 1) * Fp1 * E1 * E1 * Fp1;
+	const double term5 = Ng * (Ng - 1) * Fp1 * E1 * E1 * Fp1;
 
-	// Term 6: Polymer Block A <--> Polymer Block B Cross Term
-	term6 = Ng * Ng * Fp1 * E1 * E1 * E2 * Fp2;
+	// Term 6: Polymer Block A <--> Polymer Block B Cross Term.  Each pair of
+	// blocks on distinct chains is counted in both orders,
+	// 2 Ng (Ng - 1) Fp1 E1 E1 E2 Fp2; the pairs within a chain are in term 2.
+	const double term6 = 2.0 * Ng * (Ng - 1.0) * Fp1 * E1 * E1 * E2 * Fp2;
 
 	// Term 7: Polymer Block B <--> Polymer Block B Cross Term
-	term7 = Ng * (Ng - 1.0) * Fp2 * E2 * E1 * E1 * E2 * Fp2;
+	const double term7 = Ng * (Ng - 1.0) * Fp2 * E2 * E1 * E1 * E2 * Fp2;
 
 	// Term 8: Free chains (if any)
-	term8 = (onu3 * pow(Usub3, -o2nu3)*sas_gamma(o2nu3)*sas_gammainc(o2nu3, Usub3) - onu3 * pow(Usub3, -onu3)*sas_gamma(onu3)*sas_gammainc(onu3, Usub3));
-	
-	// Final intensity:
-	inten = 1.0e-4 * volf * (term1 + term2 + term3 + term4 + term5 + term6 + term7)/vtotal + I0*1.0e-4*term8;
-	return inten;
+	const double term8 = P3;
 
- 
+	// Final intensity:
+	const double inten = p->pre * (term1 + term2 + term3 + term4 + term5 + term6 + term7) + I0*1.0e-4*term8;
 
+	// Mean particle amplitude with the same normalization, for the beta
+	// approximation; the free chains do not move with the particles.
+	*f1 = p->amp * (Fs + Ng * E1 * (Fp1 + E2 * Fp2));
+	*f2 = inten;
 }
@@ -0,0 +1,76 @@
+static double form_volume(double radius, double t_shell, double v) {
+	return 1.00; // Complex structures can be normalized w/ scale.
+}
+
+static double radius_effective(int mode, double radius, double t_shell, double v) {
+    switch(mode) {
+	// Core-shell radius
+	case 1:
+		return (radius + t_shell);
+		break;
+    }
+    return (radius + t_shell);
+}
+
+static void Fq(double q, double *f1, double *f2, double sld, double sld_shell, double sld_poly, double sld_solvent, double radius, double t_shell, double poly_sig, double C_infty, double M0, double Mn, double nu, double v, double ng_dist) {
+
+	// Bond angles
+	double theta0 = 68.0 * M_PI/180.0;
+
+	// Kuhn length
+	double b = C_infty * 1.54 / cos(theta0/2.0);
+
+	// Deg. of polymerization
+	double N = (Mn/M0) * cos(theta0/2.0)/C_infty;
+
+	// Volume of core regions:
+	double Rcoreshell = radius + t_shell;
+	double Vcore      = M_4PI_3 * cube(radius);
+	double Vcoreshell = M_4PI_3 * cube(Rcoreshell);
+
+	// Number of grafted chains per core:
+	double Ng = poly_sig * 4.00 * M_PI * (0.1 * Rcoreshell) * (0.1 * Rcoreshell);
+
+	double Vtotal = Vcoreshell + Ng*N*v;
+
+	// Chain parameters:
+	double o2nu, g_o2nu, g_onu, Usub, F, P;
+
+	// Misc terms:
+	double Ea, Fs, Fp, Pp, delta, inten;
+
+	// Propagator function:
+	Ea = sas_sinx_x(q*Rcoreshell);
+
+	// Polymer size variable
+	chain_init(nu, &o2nu, &g_o2nu, &g_onu);
+	Usub = (q*b) * (q*b) * pow(N, 2.0*nu) / 6.0;
+
+	// Form factor amplitude of core-shell sphere:
+	Fs = (sld - sld_shell)*Vcore*sas_3j1x_x(q*radius) + (sld_shell - sld_solvent)*Vcoreshell*sas_3j1x_x(q*Rcoreshell);
+
+	// Form factor amplitude and form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
+	chain_fp(Usub, o2nu, g_o2nu, g_onu, &F, &P);
+	Fp = N*v*F;
+	Pp = (N*v) * (N*v) * P;
+
+	// Combine all terms to form intensity:
+	delta = sld_poly - sld_solvent;
+
+	// Term 1: Core-shell particle:
+	inten = Fs * Fs;
+
+	// Term 2: Polymer
+	inten += Ng * delta * delta * Pp;
+
+	// Term 3: Particle/polymer crossterm:
+	inten += 2.0 * Ng * delta * Fs * Ea * Fp;
+
+	// Term 4: Polymer/polymer crossterm:
+	inten += chain_pairs(Ng, ng_dist) * delta * delta * Fp * Ea * Ea * Fp;
+
+	*f2 = inten * 1.0e-4 / Vtotal;
+
+	// Mean particle amplitude with the same normalization, for the beta approximation.
+	*f1 = sqrt(1.0e-4 / Vtotal) * (Fs + Ng * delta * Ea * Fp);
+}
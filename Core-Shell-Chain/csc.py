@@ -1,6 +1,16 @@
 import numpy as np  # type: ignore
-from numpy import cos, pi, inf, power, errstate
-from sasmodels.special import sas_gamma, sas_gammainc, sas_sinx_x, sas_3j1x_x
+from numpy import cos, pi, inf, errstate
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), and SciPy, loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+contrast_basis = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "contrast_basis.py"))
+fused = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "fused.py"))
+special = lazy.LazyModule("sasmodels.special")
 
 name = "csc"
 title = "Core Shell Chain (CSC)"
@@ -21,21 +31,27 @@ parameters = [["sld",         "1e-6/Ang^2",    3.5,     [-inf, inf],    "sld",
               ["Mn",          "g/mol",         11.18,   [0, inf],       "",       "Polymer molar mass"],
               ["nu",          "None",          0.50,    [0.25, 1.0],    "",       "Flory exponent"],
               ["v",           "Ang^3",         162,     [0, inf]   ,    "volume", "Kuhn monomer volume"],
+              ["ng_dist",     "",              0,       [["fixed", "poisson"]], "", "Distribution of the number of grafted chains"],
              ]
 
-def Iq(q,
-       sld,
-       sld_shell,
-       sld_poly,
-       sld_solvent,
-       radius,
-       t_shell,
-       poly_sig,
-       C_infty,
-       M0,
-       Mn,
-       nu,
-       v):
+radius_effective_modes = ["radius"]
+have_Fq = True
+source = ["lib/sas_3j1x_x.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "csc.c"]
+
+def Iq_basis(q, radius, t_shell, poly_sig, C_infty, M0, Mn, nu, v, ng_dist=0):
+    """
+    Contrast-free partial scattering functions of the Iq kernel in csc.c.
+
+    Returns a ContrastBasis (see lib/contrast_basis.py) to be called with
+    sld, sld_shell, sld_poly and sld_solvent.  The contrasts are core
+    (sld - sld_shell), shell (sld_shell - sld_solvent) and polymer
+    (sld_poly - sld_solvent).
+    """
+    def contrasts(sld, sld_shell, sld_poly, sld_solvent):
+        return sld - sld_shell, sld_shell - sld_solvent, sld_poly - sld_solvent
+    CORE, SHELL, POLY = range(3)
+
+    q = np.asarray(q, dtype=float)
 
     # Bond angles
     theta0 = 68.0 * pi/180.0
@@ -54,74 +70,96 @@ def Iq(q,
     # Number of grafted chains per core:
     Ng = poly_sig * 4.00 * pi * (0.1 * Rcoreshell) * (0.1 * Rcoreshell)
 
-    
-    Vtotal = Vcoreshell + Ng*N*v;
-
-    # One over excl. vol. parm.:
-    onu  = 1.0 / nu
-    o2nu = 1.0 / 2.0 / nu
+    Vtotal = Vcoreshell + Ng*N*v
+    with errstate(divide='ignore'):
+        pre = np.divide(1.0e-4, Vtotal)
 
     # Propagator function:
-    Ea = sas_sinx_x(q*(Rcoreshell))
+    Ea = special.sas_sinx_x(q*(Rcoreshell))
 
     # Polymer size variable
     Usub = (q*b)**2 * N**(2*nu) / 6.0
 
-    # Form factor amplitude of core-shell sphere:
-    with errstate(divide='ignore'):
-        Fs = (sld - sld_shell)*Vcore*sas_3j1x_x(q*radius) + (sld_shell - sld_solvent)*Vcoreshell*sas_3j1x_x(q*Rcoreshell)
-
-
-    # Form factor amplitude of the polymer:
-    with errstate(divide='ignore'):
-        Fp = N*v*o2nu*power(Usub, -o2nu) * sas_gamma(o2nu) * sas_gammainc(o2nu, Usub)
-
-    # Form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
-    with errstate(divide='ignore'):
-        Pp = (N*v)**2 * (onu * power(Usub, -o2nu)*sas_gamma(o2nu)*sas_gammainc(o2nu, Usub) - onu * power(Usub, -onu)*sas_gamma(onu)*sas_gammainc(onu,Usub))
-
-    # Combine all terms to form intensity:
-    #
-    # Term 1: Core-shell particle:
-    inten = Fs * Fs
-
-    # Term 2: Polymer
-    inten = inten + Ng * (sld_poly - sld_solvent) * (sld_poly - sld_solvent) * Pp
-
-    # Term 3: Particle/polymer crossterm:
-    inten = inten + 2.0 * Ng * (sld_poly - sld_solvent) * Fs * Ea * Fp
-
-    # Term 4: Polymer/polymer crossterm:
-    inten = inten + Ng * (Ng - 1) * (sld_poly - sld_solvent) * (sld_poly - sld_solvent) * Fp * Ea * Ea * Fp
-    with errstate(divide='ignore'):
-        inten = inten * 1.0e-4 / Vtotal
-
-    return inten
-
-Iq.vectorized = True  # Iq accepts an array of q values
-
-# Effective radius for S(q) calculations:
-def ER(radius, t_shell):
-    return radius + t_shell
-
-# Volume ratio
-def VR(radius, t_shell):
-
-    whole = 4.0/3.0*pi*(radius+t_shell)**3
-    core  = 4.0/3.0*pi*radius**3
-    return whole, whole-core
+    # Form factor amplitudes of the core and of the core-shell sphere, per unit contrast:
+    A = Vcore*special.sas_3j1x_x(q*radius)
+    B = Vcoreshell*special.sas_3j1x_x(q*Rcoreshell)
+
+    # Form factor amplitude and form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
+    F, P = chain.chain_fp(Usub, nu)
+    Fp = N*v*F
+    Pp = (N*v)**2 * P
+
+    basis = contrast_basis.ContrastBasis(contrasts)
+    # Term 1: Core-shell particle
+    basis.add(CORE, CORE, pre * A*A)
+    basis.add(CORE, SHELL, pre * 2.0*A*B)
+    basis.add(SHELL, SHELL, pre * B*B)
+    # Terms 2, 4: Polymer and polymer/polymer crossterm
+    basis.add(POLY, POLY, pre * (Ng*Pp + chain.chain_pairs(Ng, ng_dist)*Fp*Ea*Ea*Fp))
+    # Term 3: Particle/polymer crossterm
+    basis.add(CORE, POLY, pre * 2.0*Ng*A*Ea*Fp)
+    basis.add(SHELL, POLY, pre * 2.0*Ng*B*Ea*Fp)
+    return basis
+
+# NumPy version of Iq in csc.c, from Iq_basis.
+def Iq_numpy(q,
+             sld,
+             sld_shell,
+             sld_poly,
+             sld_solvent,
+             radius,
+             t_shell,
+             poly_sig,
+             C_infty,
+             M0,
+             Mn,
+             nu,
+             v,
+             ng_dist=0):
+    basis = Iq_basis(q, radius, t_shell, poly_sig, C_infty, M0, Mn, nu, v, ng_dist)
+    return basis.evaluate(sld=sld, sld_shell=sld_shell, sld_poly=sld_poly, sld_solvent=sld_solvent)
+
+def Iq_fused(q, sld, sld_shell, sld_poly, sld_solvent, radius, t_shell, poly_sig,
+             C_infty, M0, Mn, nu, v, ng_dist=0, out=None, chunk_size=fused.CHUNK_SIZE):
+    """
+    Iq_numpy evaluated over chunks of q into *out*; see lib/fused.py.
+    """
+    pars = dict(sld=sld, sld_shell=sld_shell, sld_poly=sld_poly, sld_solvent=sld_solvent,
+                radius=radius, t_shell=t_shell, poly_sig=poly_sig, C_infty=C_infty, M0=M0,
+                Mn=Mn, nu=nu, v=v, ng_dist=ng_dist)
+    return fused.evaluate(_Iq_chunk, q, pars, out, chunk_size)
+
+def _Iq_chunk(q, out, work, sld, sld_shell, sld_poly, sld_solvent, **structure):
+    Iq_basis(q, **structure).evaluate(out=out, sld=sld, sld_shell=sld_shell, sld_poly=sld_poly,
+                                      sld_solvent=sld_solvent)
+
+def Iq_batch(q, out=None, **pars):
+    """
+    Iq_numpy for many parameter sets at once, into *out* if given; see
+    lib/batch.py.
+    """
+    return batch.evaluate(Iq_fused, parameters, q, pars, out)
 
 def random():
     pars = dict(
 	radius   = np.random.uniform(20,200),
         t_shell  = np.random.uniform(10,100),
         poly_sig = np.random.uniform(0,2),
-        rg       = np.random.unifomr(20,150),
+        C_infty  = np.random.uniform(5,20),
+        Mn       = np.random.uniform(1000,50000),
         nu       = np.random.uniform(0.3,0.6),
-        v_poly   = np.random.uniform(10,50),
+        v        = np.random.uniform(100,200),
     )
     return pars
 
 #demo = dict(scale=1, background,0,
 #            sld=3.0, sld_shell=1.0, sld_poly = 1.0, sld_solvent=4.3,
 #            radius=50, t_shell=20, poly_sig=0.50, rg=70, nu=0.5, v_poly=30)
+
+# Reference values from Iq_batch.
+tests = [
+    [{"background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [6834.2801, 5677.5706, 26.308042, 0.021556263]],
+    [{"t_shell": 10.0, "nu": 0.6, "Mn": 20000.0, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [4797.7811, 3946.9857, 6.3812652, 0.014204096]],
+]
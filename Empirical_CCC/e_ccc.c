@@ -6,7 +6,7 @@ static double form_volume(double R, double rg1, double poly_sig, double rg2, dou
 	return vol;
 }
 
-static double radius_effective(int mode, double R, double poly_sig, double rg1, double rg2) {
+static double radius_effective(int mode, double R, double poly_sig, double rg1, double rg2, double v1, double v2) {
     switch(mode) {
 	// Core radius
 	case 1:
@@ -20,99 +20,118 @@ static double radius_effective(int mode, double R, double poly_sig, double rg1,
     }
 }
 
+// q-independent part of Fq for one parameter set; see CHAIN_PREPARE in
+// lib/polymer_chain.c.  Terms with a zero prefactor are flagged off.
+typedef struct {
+	double Ng, vt;
+	double Q1, Q2, Q3;		// crossovers to the power laws
+	double P1, P2, P3;		// power law prefactors
+	double core;			// (sld_c - sld_solvent) vc
+	double a1, a2, p1, p2;		// v (sld - sld_solvent) and its square, for blocks 1 and 2
+	int chain1, chain2;		// whether each chain contributes
+	chain_prep c1, c2;
+} e_ccc_prep;
 
-static double Iq(double q, double m, double sld_c, double sld1, double sld2, double sld_solvent, double R, double rc, double poly_sig, double rg1, double rg2, double nu1, double nu2, double v1, double v2) {
-
-	// Q regions:
-        double Q1, Q2, Q3;
-	double P1, P2, P3;
+static void e_ccc_prepare(e_ccc_prep *p, double m, double sld_c, double sld1, double sld2, double sld_solvent, double R, double rc, double poly_sig, double rg1, double rg2, double nu1, double nu2, double v1, double v2) {
 
 	// Number of grafted chains.
-	double Ng = 4.00 * M_PI * pow(0.1*R, 2.0) * poly_sig;
+	p->Ng = 4.00 * M_PI * pow(0.1*R, 2.0) * poly_sig;
 
-	// Parameters for polymer form factors/amplitudes:
-	double onu1, o2nu1, onu2, o2nu2, Usub1, Usub2;
-	double vc = M_4PI_3 * pow(R, 3.0);
-	double vt = vc + Ng*(v1 + v2);
+	// Volumes:
+	const double vc = M_4PI_3 * pow(R, 3.0);
+	p->vt = vc + p->Ng*(v1 + v2);
 
-	// Misc terms:
-	double Fs, Fp1, Fp2, Pp1, Pp2, E1, E2;
-	double inten;
+	// Calculate Q's:
+	p->Q1 = 1.0/R * sqrt(5.0*m/2.0);
+	p->Q2 = 1.0/R * sqrt(3.0*m/4.0);
+	p->Q3 = 1.0/rc * sqrt(3.0*m/4.0);
+	p->P1 = exp(-pow(p->Q1,2.0)*pow(R,  2.0)/5.0) * pow(p->Q1, m);
+	p->P2 = exp(-pow(p->Q2,2.0)*pow(R,  2.0)/6.0) * pow(p->Q2, 0.25*m);
+	p->P3 = exp(-pow(p->Q3,2.0)*pow(rc, 2.0)/6.0) * pow(p->Q3, 0.25*m);
+
+	// Amplitude prefactors:
+	p->core = (sld_c - sld_solvent) * vc;
+	p->a1 = v1 * (sld1 - sld_solvent);
+	p->a2 = v2 * (sld2 - sld_solvent);
+	p->p1 = p->a1 * p->a1;
+	p->p2 = p->a2 * p->a2;
+
+	// Chain constants, for the chains that contribute:
+	p->chain1 = (p->Ng != 0.0 && p->a1 != 0.0);
+	p->chain2 = (p->Ng != 0.0 && p->a2 != 0.0);
+	if (p->chain1) chain_prepare(nu1, 1.0, 0, &p->c1);
+	if (p->chain2) chain_prepare(nu2, 1.0, 0, &p->c2);
+}
 
-	// There are 9 terms in the intensity.
-	double term1, term2, term3, term4, term5, term6, term7, term8, term9;
+static void Fq(double q, double *f1, double *f2, double m, double sld_c, double sld1, double sld2, double sld_solvent, double R, double rc, double poly_sig, double rg1, double rg2, double nu1, double nu2, double v1, double v2) {
 
-	// Calculate Q's:
-        Q1 = 1.0/R * sqrt(5.0*m/2.0);
-        Q2 = 1.0/R * sqrt(3.0*m/4.0);
-        Q3 = 1.0/rc * sqrt(3.0*m/4.0);
-        P1 =      exp(-pow(Q1,2.0)*pow(R,  2.0)/5.0) * pow(Q1, m);
-        P2 =      exp(-pow(Q2,2.0)*pow(R,  2.0)/6.0) * pow(Q2, 0.25*m);
-	P3 =      exp(-pow(Q3,2.0)*pow(rc, 2.0)/6.0) * pow(Q3, 0.25*m);
-
-	// Exponents/Pre-factors for incomplete gamma function.
-	onu1  = 1.0/nu1;
-	onu2  = 1.0/nu2;
-	o2nu1 = 1.0/2.0/nu1;
-	o2nu2 = 1.0/2.0/nu2;
-	Usub1 = (q * rg1) * (q * rg1) * (2.0*nu1 + 1.0) * (2.0*nu1 + 2.0) / 6.0;
-	Usub2 = (q * rg2) * (q * rg2) * (2.0*nu2 + 1.0) * (2.0*nu2 + 2.0) / 6.0;
+	CHAIN_PREPARE(e_ccc_prep, p, e_ccc_prepare, m, sld_c, sld1, sld2, sld_solvent, R, rc, poly_sig, rg1, rg2, nu1, nu2, v1, v2);
+	const double Ng = p->Ng;
 
 	// Form factor amplitude for core:
-	if (q < Q1) {
-		Fs = (sld_c - sld_solvent) * vc * exp(-pow(q, 2.0)*pow(R, 2.0)/10.0);
-	} else {
-		Fs = (sld_c - sld_solvent) * vc * sqrt(P1) * pow(q, -0.5*m);
-	}
-	
-	
-	// Core propagators:
-	if (q < Q2) {
-		E1 = exp(-pow(q, 2.0)*pow(R, 2.0)/6.0);
-	} else {
-		E1 = P2 * pow(q, -0.25*m);
+	double Fs = 0.0;
+	if (p->core != 0.0) {
+		if (q < p->Q1) {
+			Fs = p->core * exp(-pow(q, 2.0)*pow(R, 2.0)/10.0);
+		} else {
+			Fs = p->core * sqrt(p->P1) * pow(q, -0.5*m);
+		}
 	}
 
-	if (q < Q3) {
-		E2 = exp(-pow(q, 2.0)*pow(rc, 2.0)/6.0);
-	} else {
-		E2 = P3 * pow(q, -0.25*m);
+	// Core propagators, and chain form factors and amplitudes, for the
+	// chains that contribute:
+	double E1 = 0.0, E2 = 0.0, Fc1 = 0.0, Fc2 = 0.0, Pc1 = 0.0, Pc2 = 0.0;
+	if (p->chain1) {
+		if (q < p->Q2) {
+			E1 = exp(-pow(q, 2.0)*pow(R, 2.0)/6.0);
+		} else {
+			E1 = p->P2 * pow(q, -0.25*m);
+		}
+		chain_fp_prep(chain_usub(q, rg1, nu1), &p->c1, &Fc1, &Pc1);
+	}
+	if (p->chain2) {
+		if (q < p->Q3) {
+			E2 = exp(-pow(q, 2.0)*pow(rc, 2.0)/6.0);
+		} else {
+			E2 = p->P3 * pow(q, -0.25*m);
+		}
+		chain_fp_prep(chain_usub(q, rg2, nu2), &p->c2, &Fc2, &Pc2);
 	}
 
-	// Form factor amplitudes for polymers:
-	Fp1 = v1 * (sld1 - sld_solvent)*(o2nu1 * pow(Usub1, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, Usub1));
-	Fp2 = v2 * (sld2 - sld_solvent)*(o2nu2 * pow(Usub2, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, Usub2));
-	
-	// Form factors for polymers:
-	Pp1 = v1*v1*pow((sld1 - sld_solvent), 2.0) * (onu1 * pow(Usub1, -o2nu1)*sas_gamma(o2nu1)*sas_gammainc(o2nu1, Usub1) - onu1 * pow(Usub1, -onu1)*sas_gamma(onu1)*sas_gammainc(onu1, Usub1));
-	Pp2 = v2*v2*pow((sld2 - sld_solvent), 2.0) * (onu2 * pow(Usub2, -o2nu2)*sas_gamma(o2nu2)*sas_gammainc(o2nu2, Usub2) - onu2 * pow(Usub2, -onu2)*sas_gamma(onu2)*sas_gammainc(onu2, Usub2));
+	// Form factor amplitudes and form factors for polymers:
+	const double Fp1 = p->a1 * Fc1;
+	const double Fp2 = p->a2 * Fc2;
+	const double Pp1 = p->p1 * Pc1;
+	const double Pp2 = p->p2 * Pc2;
 
 	// Term 1: Nanoparticle Core
-	term1 = Fs*Fs;
+	const double term1 = Fs*Fs;
 
 	// Term 2: Polymer Block Self Term
-	term2 = Ng * (Pp1 + Pp2);
+	const double term2 = Ng * (Pp1 + Pp2);
 
 	// Term 3: Block 1/Nanoparticle Crossterm
-	term3 = 2.0 * Ng * Fs * E1 * Fp1;
+	const double term3 = 2.0 * Ng * Fs * E1 * Fp1;
 
 	// Term 4: Block 2/Nanoparticle Crossterm
-	term4 = 2.0 * Ng * Fs * E2 * Fp2;
+	const double term4 = 2.0 * Ng * Fs * E2 * Fp2;
 
 	// Term 5: Block 1/Block 1 Crossterm
-	term5 = Ng * (Ng - 1.0) * Fp1 * E1 * E1 * Fp1;
+	const double term5 = Ng * (Ng - 1.0) * Fp1 * E1 * E1 * Fp1;
 
 	// Term 6: Block 2/Block 2 Crossterm
-	term6 = Ng * (Ng - 1.0) * Fp2 * E2 * E2 * Fp2;
+	const double term6 = Ng * (Ng - 1.0) * Fp2 * E2 * E2 * Fp2;
 
-	// Term 7: Block 2/Block 1 Crossterm
-	term7 = Ng * Ng * Fp1 * E1 * E2 * Fp2;
+	// Term 7: Block 2/Block 1 Crossterm.  Each pair of a block 1 and a block 2,
+	// on distinct chains or on the same chain, is counted in both orders,
+	// 2 Ng^2 Fp1 E1 E2 Fp2, as in the square of the mean amplitude f1 below.
+	const double term7 = 2.0 * Ng * Ng * Fp1 * E1 * E2 * Fp2;
 
 	// Final intensity:
-	inten = 1.0e-4 * (term1 + term2 + term3 + term4 + term5 + term6 + term7)/vt;
-	return inten;
-
- 
+	const double inten = 1.0e-4 * (term1 + term2 + term3 + term4 + term5 + term6 + term7)/p->vt;
 
+	// Mean particle amplitude with the same normalization, for the beta
+	// approximation.
+	*f1 = sqrt(1.0e-4/p->vt) * (Fs + Ng * (E1 * Fp1 + E2 * Fp2));
+	*f2 = inten;
 }
-
@@ -1,7 +1,16 @@
 
 
 import numpy as np  # type: ignore
-from numpy import pi, inf, power, errstate
+from numpy import pi, inf, power, errstate, exp, sqrt
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+contrast_basis = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "contrast_basis.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
 
 name = "e_ccc"
 title = "Empirical model of polymer-grafted nanosphere."
@@ -10,6 +19,7 @@ category = "shape:sphere"
 
 structure_factor = False
 form_factor = True
+have_Fq = True
 
 #             [ "name",       "units",         default, [lower, upper], "type",   "description"],
 parameters = [["m",           "None",          4.0,     [1,4],          "",       "Core Porod exponent"],
@@ -29,5 +39,87 @@ parameters = [["m",           "None",          4.0,     [1,4],          "",
              ]
 
 radius_effective_modes = ["radius", "outer_radius"]
-source = ["lib/sas_3j1x_x.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "e_ccc.c"]
+source = ["lib/sas_3j1x_x.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "e_ccc.c"]
+
+
+def Iq_basis(q, m, R, rc, poly_sig, rg1, rg2, nu1, nu2, v1, v2):
+    """
+    Contrast-free partial scattering functions of the Iq kernel in e_ccc.c.
+
+    Returns a ContrastBasis (see lib/contrast_basis.py) to be called with
+    sld_c, sld1, sld2 and sld_solvent.  The contrasts are core
+    (sld_c - sld_solvent), chain 1 and chain 2 (sld1 - sld_solvent,
+    sld2 - sld_solvent).
+    """
+    def contrasts(sld_c, sld1, sld2, sld_solvent):
+        return sld_c - sld_solvent, sld1 - sld_solvent, sld2 - sld_solvent
+    CORE, CHAIN1, CHAIN2 = range(3)
+
+    q = np.asarray(q, dtype=float)
+    Ng = 4.00 * pi * (0.1*R)**2 * poly_sig
+    vc = 4.0/3.0 * pi * R**3
+    pre = 1.0e-4 / (vc + Ng*(v1 + v2))
+
+    # Guinier/power-law crossovers:
+    Q1 = 1.0/R * sqrt(5.0*m/2.0)
+    Q2 = 1.0/R * sqrt(3.0*m/4.0)
+    Q3 = 1.0/rc * sqrt(3.0*m/4.0)
+    P1 = exp(-Q1**2 * R**2/5.0) * power(Q1, m)
+    P2 = exp(-Q2**2 * R**2/6.0) * power(Q2, 0.25*m)
+    P3 = exp(-Q3**2 * rc**2/6.0) * power(Q3, 0.25*m)
+
+    # Core amplitude per unit contrast and core propagators:
+    with errstate(divide='ignore'):
+        A = vc * np.where(q < Q1, exp(-q**2 * R**2/10.0), sqrt(P1) * power(q, -0.5*m))
+        E1 = np.where(q < Q2, exp(-q**2 * R**2/6.0), P2 * power(q, -0.25*m))
+        E2 = np.where(q < Q3, exp(-q**2 * rc**2/6.0), P3 * power(q, -0.25*m))
+    F1, Pc1 = chain.chain_fp(chain.chain_usub(q, rg1, nu1), nu1)
+    F2, Pc2 = chain.chain_fp(chain.chain_usub(q, rg2, nu2), nu2)
+    a1, a2 = v1*F1, v2*F2
+
+    basis = contrast_basis.ContrastBasis(contrasts)
+    # Term 1: Nanoparticle core
+    basis.add(CORE, CORE, pre * A*A)
+    # Terms 2, 5, 6: Block self terms and block/block crossterms
+    basis.add(CHAIN1, CHAIN1, pre * Ng * (v1*v1*Pc1 + (Ng - 1.0)*a1*E1*E1*a1))
+    basis.add(CHAIN2, CHAIN2, pre * Ng * (v2*v2*Pc2 + (Ng - 1.0)*a2*E2*E2*a2))
+    # Terms 3, 4: Block/nanoparticle crossterms
+    basis.add(CORE, CHAIN1, pre * 2.0*Ng*A*E1*a1)
+    basis.add(CORE, CHAIN2, pre * 2.0*Ng*A*E2*a2)
+    # Term 7: Block 2/block 1 crossterm
+    basis.add(CHAIN1, CHAIN2, pre * 2.0*Ng*Ng*a1*E1*E2*a2)
+    return basis
+
+def Iq_batch(q, **pars):
+    """
+    Iq for many parameter sets at once; see lib/batch.py.
+    """
+    def kernel(q, sld_c, sld1, sld2, sld_solvent, **structure):
+        return Iq_basis(q, **structure).evaluate(sld_c=sld_c, sld1=sld1, sld2=sld2, sld_solvent=sld_solvent)
+    return batch.evaluate(kernel, parameters, q, pars)
+
+def random():
+    pars = dict(
+        R        = np.random.uniform(20,200),
+        m        = np.random.uniform(3,4),
+        rc       = np.random.uniform(50,300),
+        poly_sig = np.random.uniform(0.05,1),
+        rg1      = np.random.uniform(20,200),
+        rg2      = np.random.uniform(20,200),
+        nu1      = np.random.uniform(0.3,0.8),
+        nu2      = np.random.uniform(0.3,0.8),
+        v1       = np.random.uniform(1000,30000),
+        v2       = np.random.uniform(1000,30000),
+    )
+    return pars
 
+# Reference values from Iq_batch: the defaults and each block matched to
+# the solvent.
+tests = [
+    [{"background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [9418.7827, 2135.0651, 2.266743, 0.042630315]],
+    [{"sld1": 6.37, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [1652.443, 751.58939, 1.6043345, 0.004106949]],
+    [{"sld2": 6.37, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [5666.054, 1344.4598, 2.1841856, 0.040963035]],
+]
@@ -22,84 +22,113 @@ static double radius_effective(int mode, double radius, double poly_sig, double
     }
 }
 
-static double Iq(double q, double volf, double sld_c, double sld_s, double sld1, double sld2, double sld_solvent, double radius, double sigma, double rc, double poly_sig, double rg1, double rg2, double nu1, double nu2, double v1, double v2, double I0, double rg3, double nu3) {
+// q-independent part of Fq for one parameter set; see CHAIN_PREPARE in
+// lib/polymer_chain.c.  Terms with a zero prefactor are flagged off.
+typedef struct {
+	double Ng, Ng_pairs;
+	double core;			// (sld_c - sld_solvent) vcore
+	double a1, a2, p1, p2;		// v (sld - sld_solvent) and its square, for blocks 1 and 2
+	double free;			// (sld2 - sld_solvent)^2 v2, for the free chains
+	double pre, amp;		// 1e-4 volf/vtotal and its square root
+	int chain1, chain2, chain3;	// whether each chain contributes
+	chain_prep c1, c2, c3;
+} f_ccc_prep;
+
+static void f_ccc_prepare(f_ccc_prep *p, double volf, double sld_c, double sld_s, double sld1, double sld2, double sld_solvent, double radius, double sigma, double rc, double poly_sig, double rg1, double rg2, double nu1, double nu2, double v1, double v2, double I0, double rg3, double nu3, double ng_dist) {
 
 	// Number of grafted chains.
-	double Ng = 4.00 * M_PI * pow(0.1*(radius), 2.0) * poly_sig;
-
-	// Parameters for polymer form factors/amplitudes:
-	double onu1, o2nu1, onu2, o2nu2, onu3, o2nu3, Usub1, Usub2, Usub3;
-
-	// Misc terms:
-	double r_coreshell, Fs, Fp1, Fp2, Pp1, Pp2, E1, E2;
-	double vcore, vcoreshell, vtotal, inten, v3;
-
-	// There are 9 terms in the intensity.
-	double term1, term2, term3, term4, term5, term6, term7, term8, term9;
-
-	// Exponents/Pre-factors for incomplete gamma function.
-	onu1  = 1.0/nu1;
-	onu2  = 1.0/nu2;
-	onu3  = 1.0/nu3;
-	o2nu1 = 1.0/2.0/nu1;
-	o2nu2 = 1.0/2.0/nu2;
-	o2nu3 = 1.0/2.0/nu3;
-	Usub1 = (q * rg1) * (q * rg1) * (2.0*nu1 + 1.0) * (2.0*nu1 + 2.0) / 6.0;
-	Usub2 = (q * rg2) * (q * rg2) * (2.0*nu2 + 1.0) * (2.0*nu2 + 2.0) / 6.0;
-	Usub3 = (q * rg3) * (q * rg3) * (2.0*nu3 + 1.0) * (2.0*nu3 + 2.0) / 6.0;
-
-	// Form factor amplitude for core:
-	r_coreshell = radius;
-	vcore       = M_4PI_3 * cube(radius);
-	vcoreshell  = M_4PI_3 * cube(r_coreshell);
-	vtotal      = vcoreshell + Ng * (v1 + v2) + I0*v2;
-	Fs = (sld_c - sld_solvent) * vcore * sas_3j1x_x(q*radius) * exp(-pow(sigma*q, 2.0)/2.0);
-	
-	// Phase factors:
-	E1 = sas_sinx_x(q*(r_coreshell));
-	E2 = sas_sinx_x(q*(rc));
-
-	// Form factor amplitudes for polymers:
-	Fp1 = v1 * (sld1 - sld_solvent)*(o2nu1 * pow(Usub1, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, Usub1));
-	Fp2 = v2 * (sld2 - sld_solvent)*(o2nu2 * pow(Usub2, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, Usub2));
-	
-	// Form factors for polymers:
-	Pp1 = v1*v1*pow((sld1 - sld_solvent), 2.0) * (onu1 * pow(Usub1, -o2nu1)*sas_gamma(o2nu1)*sas_gammainc(o2nu1, Usub1) - onu1 * pow(Usub1, -onu1)*sas_gamma(onu1)*sas_gammainc(onu1, Usub1));
-	Pp2 = v2*v2*pow((sld2 - sld_solvent), 2.0) * (onu2 * pow(Usub2, -o2nu2)*sas_gamma(o2nu2)*sas_gammainc(o2nu2, Usub2) - onu2 * pow(Usub2, -onu2)*sas_gamma(onu2)*sas_gammainc(onu2, Usub2));
+	p->Ng = 4.00 * M_PI * pow(0.1*(radius), 2.0) * poly_sig;
+	p->Ng_pairs = chain_pairs(p->Ng, ng_dist);
+
+	// Volumes and amplitude prefactors:
+	const double vcore  = M_4PI_3 * cube(radius);
+	const double vtotal = vcore + p->Ng * (v1 + v2) + I0*v2;
+	p->core = (sld_c - sld_solvent) * vcore;
+	p->a1 = v1 * (sld1 - sld_solvent);
+	p->a2 = v2 * (sld2 - sld_solvent);
+	p->p1 = p->a1 * p->a1;
+	p->p2 = p->a2 * p->a2;
+	p->free = pow(sld2-sld_solvent, 2.0) * v2;
+	p->pre = 1.0e-4 * volf / vtotal;
+	p->amp = sqrt(p->pre);
+
+	// Chain constants, for the chains that contribute:
+	p->chain1 = (p->Ng != 0.0 && p->a1 != 0.0);
+	p->chain2 = (p->Ng != 0.0 && p->a2 != 0.0);
+	p->chain3 = (I0 != 0.0 && p->free != 0.0);
+	if (p->chain1) chain_prepare(nu1, 1.0, 0, &p->c1);
+	if (p->chain2) chain_prepare(nu2, 1.0, 0, &p->c2);
+	if (p->chain3) chain_prepare(nu3, 1.0, 0, &p->c3);
+}
+
+static void Fq(double q, double *f1, double *f2, double volf, double sld_c, double sld_s, double sld1, double sld2, double sld_solvent, double radius, double sigma, double rc, double poly_sig, double rg1, double rg2, double nu1, double nu2, double v1, double v2, double I0, double rg3, double nu3, double ng_dist) {
+
+	CHAIN_PREPARE(f_ccc_prep, p, f_ccc_prepare, volf, sld_c, sld_s, sld1, sld2, sld_solvent, radius, sigma, rc, poly_sig, rg1, rg2, nu1, nu2, v1, v2, I0, rg3, nu3, ng_dist);
+	const double Ng = p->Ng, Ng_pairs = p->Ng_pairs;
+
+	// Form factor amplitude for core, with a fuzzy interface:
+	double Fs = 0.0;
+	if (p->core != 0.0) {
+		Fs = p->core * sas_3j1x_x(q*radius);
+		if (sigma != 0.0) Fs *= exp(-pow(sigma*q, 2.0)/2.0);
+	}
+
+	// Phase factors, and chain form factors and amplitudes, for the chains
+	// that contribute:
+	double E1 = 0.0, E2 = 0.0, F1 = 0.0, F2 = 0.0, P1 = 0.0, P2 = 0.0, P3 = 0.0;
+	if (p->chain1) {
+		E1 = sas_sinx_x(q*radius);
+		chain_fp_prep(chain_usub(q, rg1, nu1), &p->c1, &F1, &P1);
+	}
+	if (p->chain2) {
+		E2 = sas_sinx_x(q*rc);
+		chain_fp_prep(chain_usub(q, rg2, nu2), &p->c2, &F2, &P2);
+	}
+	if (p->chain3) {
+		double F3;
+		chain_fp_prep(chain_usub(q, rg3, nu3), &p->c3, &F3, &P3);
+	}
+
+	// Form factor amplitudes and form factors for polymers:
+	const double Fp1 = p->a1 * F1;
+	const double Fp2 = p->a2 * F2;
+	const double Pp1 = p->p1 * P1;
+	const double Pp2 = p->p2 * P2;
 
 	// Term 1: Nanoparticle Core
-	term1 = Fs*Fs;
+	const double term1 = Fs*Fs;
 
-	// Term 2: Polymer Self Term
-	// term2 = 2.0 * Ng * Fp1 * Fp2;
-	term2 = 0.0;
+	// Term 2: Polymer Self Term (not included)
 
 	// Term 3: Polymer Block Self Term
-	term3 = Ng * (Pp1 + Pp2);
+	const double term3 = Ng * (Pp1 + Pp2);
 
 	// Term 4: Block 1/Nanoparticle Crossterm
-	term4 = 2.0 * Ng * Fs * E1 * Fp1;
+	const double term4 = 2.0 * Ng * Fs * E1 * Fp1;
 
 	// Term 5: Block 2/Nanoparticle Crossterm
-	term5 = 2.0 * Ng * Fs * E2 * Fp2;
+	const double term5 = 2.0 * Ng * Fs * E2 * Fp2;
 
 	// Term 6: Block 1/Block 1 Crossterm
-	term6 = Ng * (Ng - 1.0) * Fp1 * E1 * E1 * Fp1;
+	const double term6 = Ng_pairs * Fp1 * E1 * E1 * Fp1;
 
 	// Term 7: Block 2/Block 2 Crossterm
-	term7 = Ng * (Ng - 1.0) * Fp2 * E2 * E2 * Fp2;
+	const double term7 = Ng_pairs * Fp2 * E2 * E2 * Fp2;
 
-	// Term 8: Block 2/Block 1 Crossterm
-	 term8 = Ng * (Ng - 1.0) * Fp1 * E1 * E2 * Fp2;
+	// Term 8: Block 2/Block 1 Crossterm.  Each pair of a block 1 and a block 2,
+	// on distinct chains or on the same chain, is counted in both orders,
+	// 2 <Ng^2> Fp1 E1 E2 Fp2 with <Ng^2> = Ng_pairs + Ng, as in the square of
+	// the mean amplitude f1 below.
+	const double term8 = 2.0 * (Ng_pairs + Ng) * Fp1 * E1 * E2 * Fp2;
 
 	// Term 9: Free chains (if any)
-	term9 = pow(sld2-sld_solvent, 2.0) * v2 * (onu3 * pow(Usub3, -o2nu3)*sas_gamma(o2nu3)*sas_gammainc(o2nu3, Usub3) - onu3 * pow(Usub3, -onu3)*sas_gamma(onu3)*sas_gammainc(onu3, Usub3));
-	
+	const double term9 = p->free * P3;
 
 	// Final intensity:
-	inten = 1.0e-4 * volf * (term1 + term2 + term3 + term4 + term5 + term6 + term7 + term8)/vtotal + I0*1.0e-4*term9;
-	return inten;
-
- 
+	const double inten = p->pre * (term1 + term3 + term4 + term5 + term6 + term7 + term8) + I0*1.0e-4*term9;
 
+	// Mean particle amplitude with the same normalization, for the beta
+	// approximation; the free chains do not move with the particles.
+	*f1 = p->amp * (Fs + Ng * (E1 * Fp1 + E2 * Fp2));
+	*f2 = inten;
 }
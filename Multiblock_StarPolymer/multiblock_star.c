@@ -0,0 +1,16 @@
+static double Iq(double q, double f, double b, double slds, double fp_n_blocks, double N[], double nu[], double sld[], double f_b, double fp_n_blocks_b, double N_b[], double nu_b[], double sld_b[], double pdi, double pdi_dist) {
+
+	// Self term and core amplitude of each kind of arm:
+	double S, A, S_b = 0.0, A_b = 0.0;
+	chain_arm(q, b, slds, (int)(fp_n_blocks + 0.5), N, nu, sld, pdi, pdi_dist, &S, &A);
+	if (f_b > 0.0) {
+		chain_arm(q, b, slds, (int)(fp_n_blocks_b + 0.5), N_b, nu_b, sld_b, pdi, pdi_dist, &S_b, &A_b);
+	}
+
+	// Every arm with itself, and every ordered pair of distinct arms:
+	const double total = f*A + f_b*A_b;
+	const double Pq = f*S + f_b*S_b + total*total - f*A*A - f_b*A_b*A_b;
+
+	const double arms = f + f_b;
+	return 1e-4 * Pq / (arms*arms);
+}
@@ -0,0 +1,162 @@
+r"""
+Definition
+----------
+
+This model describes a star polymer whose arms are made of blocks with
+different degrees of polymerization N_k, Flory exponents \nu_k and SLD
+contrasts, numbered from the core out.  The star has f arms of one kind and,
+for heterografted stars, f_b arms of a second kind with their own blocks.
+With f_b = 0 and three blocks it is the model *triblock_star*.
+
+Each arm contributes its self term S, the sum over its block pairs of
+$\Delta_k \Delta_l N_k N_l F_k F_l$ times the (approximate) propagators
+$e^{-U_m}$ of the blocks between them ($P_k$ for a block with itself).  Each
+pair of distinct arms contributes $A A'$, where A is the amplitude of an
+arm about the core.  For f identical arms,
+
+.. math::
+
+    P(q) = \frac{f S + f(f - 1) A^2}{f^2}
+
+and in general the intensity is normalized by the square of the total number of
+arms.  The chain functions of each block are evaluated once per q; see
+*chain_arm()* in *lib/polymer_chain.c*.
+
+References
+----------
+
+Y. Wei and M. J. A. Hore, "Characterizing Polymer Structure with Small-Angle Neutron Scattering: A Tutorial", J. Appl. Phys. 129, 171101 (2021).
+B. Hammouda, "Form Factors for Branched Polymers with Excluded Volume", J. of Research of NIST, 121, 139-164 (2016).
+"""
+
+import numpy as np
+from numpy import inf
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+
+name = "multiblock_star"
+title = "Multiblock Star Polymer"
+description = """\
+      Star polymer with f arms of n_blocks blocks each, and optionally
+      f_b arms of a second kind with n_blocks_b blocks, each block with
+      its own degree of polymerization, Flory exponent and SLD."""
+category = "shape-independent"
+
+#: Largest number of blocks per arm.
+MAX_BLOCKS = 6
+
+# pylint: disable=bad-whitespace, line-too-long
+#             ["name", "units", default,       [lower, upper], "type", "description"],
+parameters = [
+              ["f",                "",           4,    [1, inf],          "",    "Number of arms"],
+              ["b",                "Ang",        7.0,  [1, inf],          "",    "Kuhn length"],
+              ["slds",             "1e-6/Ang^2", 6.3,  [-inf,inf],        "sld", "Solvent SLD"],
+              ["n_blocks",         "",           3,    [1, MAX_BLOCKS],   "",    "Number of blocks per arm"],
+              ["N[n_blocks]",      "",           50,   [0,inf],           "",    "Deg. Polym. of block k, from the core out"],
+              ["nu[n_blocks]",     "",           0.5,  [0.25,0.999],      "",    "Flory Exp. of block k"],
+              ["sld[n_blocks]",    "1e-6/Ang^2", 1.0,  [-inf,inf],        "sld", "SLD of block k"],
+              ["f_b",              "",           0,    [0, inf],          "",    "Number of arms of the second kind"],
+              ["n_blocks_b",       "",           1,    [1, MAX_BLOCKS],   "",    "Number of blocks per arm of the second kind"],
+              ["N_b[n_blocks_b]",  "",           50,   [0,inf],           "",    "Deg. Polym. of block k of the second kind"],
+              ["nu_b[n_blocks_b]", "",           0.5,  [0.25,0.999],      "",    "Flory Exp. of block k of the second kind"],
+              ["sld_b[n_blocks_b]", "1e-6/Ang^2", 1.0, [-inf,inf],        "sld", "SLD of block k of the second kind"],
+              ["pdi",              "",           1.0,  [1.0, inf],        "",    "Arm block dispersity Mw/Mn"],
+              ["pdi_dist",         "",           0,    [["schulz", "lognormal"]], "", "Block length distribution"],
+             ]
+# pylint: enable=bad-whitespace, line-too-long
+
+source = ["lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "multiblock_star.c"]
+
+# NumPy version of Iq in multiblock_star.c, kept as a reference for the compiled kernel.
+def Iq_numpy(q,
+             f,
+             b,
+             slds,
+             n_blocks,
+             N,
+             nu,
+             sld,
+             f_b,
+             n_blocks_b,
+             N_b,
+             nu_b,
+             sld_b,
+             pdi=1.0,
+             pdi_dist=0):
+    """
+    As the C kernel, with N, nu, sld (and N_b, nu_b, sld_b) sequences of
+    block values.  Blocks past n_blocks are given zero length, which makes
+    them invisible, so n_blocks may vary between parameter sets.
+    """
+    def arm(n, N, nu, sld):
+        count = min(int(np.max(n) + 0.5), len(N))
+        return ([np.where(k < np.asarray(n) - 0.5, N[k], 0.0) for k in range(count)],
+                nu[:count], sld[:count])
+
+    second = np.any(np.asarray(f_b) > 0)
+    arms = [arm(n_blocks, N, nu, sld)] + ([arm(n_blocks_b, N_b, nu_b, sld_b)] if second else [])
+    terms = chain.chain_arms(q, b, slds, arms, pdi, pdi_dist)
+    (S, A), (S_b, A_b) = terms[0], terms[1] if second else (0.0, 0.0)
+
+    # Every arm with itself, and every ordered pair of distinct arms:
+    total = f*A + f_b*A_b
+    Pq = f*S + f_b*S_b + total*total - f*A*A - f_b*A_b*A_b
+    return 1e-4 * Pq / (f + f_b)**2
+
+def _flat_parameters():
+    # Vector parameters such as N[n_blocks] as N1 ... N6, as in sasmodels.
+    table = []
+    for p in parameters:
+        if "[" in p[0]:
+            base = p[0].split("[")[0]
+            table.extend([["%s%d" % (base, k)] + p[1:] for k in range(1, MAX_BLOCKS + 1)])
+        else:
+            table.append(p)
+    return table
+
+def Iq_batch(q, **pars):
+    """
+    Iq_numpy for many parameter sets at once; see lib/batch.py.  Vector
+    parameters are given by their sasmodels names N1, N2, ..., sld_b6.
+    """
+    def kernel(q, **values):
+        blocks = lambda base: [values["%s%d" % (base, k)] for k in range(1, MAX_BLOCKS + 1)]
+        return Iq_numpy(q, values["f"], values["b"], values["slds"], values["n_blocks"],
+                        blocks("N"), blocks("nu"), blocks("sld"), values["f_b"],
+                        values["n_blocks_b"], blocks("N_b"), blocks("nu_b"), blocks("sld_b"),
+                        values["pdi"], values["pdi_dist"])
+    return batch.evaluate(kernel, _flat_parameters(), q, pars)
+
+def random():
+    n_blocks = np.random.randint(1, MAX_BLOCKS + 1)
+    pars = dict(
+        scale=1,
+        f        = np.random.randint(2, 13),
+        b        = np.random.uniform(7, 15),
+        n_blocks = n_blocks,
+    )
+    for k in range(1, n_blocks + 1):
+        pars["N%d" % k] = np.random.uniform(10, 200)
+        pars["nu%d" % k] = np.random.uniform(0.3, 0.6)
+        pars["sld%d" % k] = np.random.uniform(-0.5, 6.5)
+    return pars
+
+demo = dict(scale=1, background=0,
+            f=4, b=7, n_blocks=4, N=[40, 40, 40, 40], sld=[1.0, 1.5, 1.0, 1.5])
+
+# Reference values from the Gaussian star of f arms of 150 monomers, and
+# from Iq_numpy for a heterografted star.
+tests = [
+    [{"sld": [1.0, 1.0, 1.0], "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [63.138024, 57.163905, 2.6849855, 0.10335622]],
+    [{"f": 3, "n_blocks": 4, "N": [30, 60, 20, 80], "nu": [0.4, 0.6, 0.5, 0.55],
+      "sld": [1.0, 4.0, -0.5, 2.0], "f_b": 2, "n_blocks_b": 2, "N_b": [100, 40],
+      "nu_b": [0.58, 0.45], "sld_b": [6.0, 0.5], "pdi": 1.2, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [33.05098, 26.600602, 1.2434489, 0.052225853]],
+]
@@ -0,0 +1,53 @@
+static double form_volume(double rg1, double rg2, double v1, double v2) {
+	return 1.00; // Complex structures can be normalized w/ scale.
+}
+
+static double radius_effective(int mode, double rg1, double rg2, double v1, double v2) {
+    switch(mode) {
+	// Outer radius. This is only an estimation.
+	case 1:
+		return (rg1 + rg2);
+		break;
+    }
+    return (rg1 + rg2);
+}
+
+static double Iq(double q, double sld1, double sld2, double sld_solvent, double rg1, double rg2, double nu1, double nu2, double v1, double v2) {
+
+	// Volume of core regions:
+	double Vtotal = v1 + v2;
+
+	// Chain parameters:
+	double o2nu1, g_o2nu1, g_onu1, o2nu2, g_o2nu2, g_onu2;
+	double Usub1, Usub2, Fp1, Fp2, Pp1, Pp2;
+
+	// Misc terms:
+	double E1, inten;
+
+	// Propagator function:
+	E1 = sas_J0(q*rg1);
+
+	// Polymer size variable
+	chain_init(nu1, &o2nu1, &g_o2nu1, &g_onu1);
+	chain_init(nu2, &o2nu2, &g_o2nu2, &g_onu2);
+	Usub1 = chain_usub(q, rg1, nu1);
+	Usub2 = chain_usub(q, rg2, nu2);
+
+	// Form factor amplitude and form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
+	chain_fp(Usub1, o2nu1, g_o2nu1, g_onu1, &Fp1, &Pp1);
+	chain_fp(Usub2, o2nu2, g_o2nu2, g_onu2, &Fp2, &Pp2);
+
+	// Combine all terms to form intensity:
+	//
+	// Term 1: Protein
+	inten = (sld1 - sld_solvent) * (sld1 - sld_solvent) * v1 * v1 * Pp1;
+
+	// Term 2: Polymer
+	inten += (sld2 - sld_solvent) * (sld2 - sld_solvent) * v2 * v2 * Pp2;
+
+	// Term 3: Cross-term
+	inten += 2.0 * v1 * v2 * (sld1 - sld_solvent) * Fp1 * E1 * Fp2;
+
+	// Convert SLDs to A^-2, and convert intensity to cm^-1. Normalize by particle volume.
+	return inten * 1.0e-6 * 1.0e-6 * 1.0e8 / Vtotal;
+}
@@ -1,7 +1,15 @@
 
 import numpy as np  # type: ignore
-from numpy import pi, inf, power, errstate
-from scipy.special import gammainc, gamma, j0, j1
+from numpy import pi, inf, errstate
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), and SciPy, loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+special = lazy.LazyModule("scipy.special")
 
 name = "protein_polymer"
 title = "Protein-polymer conjugate"
@@ -23,16 +31,20 @@ parameters = [["sld1",        "1e-6/Ang^2",    1.0,     [-inf, inf],    "sld",
               ["v2",          "Ang^3",         30,      [0, inf]   ,    "volume", "Volume of polymer"],
              ]
 
-def Iq(q,
-       sld1,
-       sld2,
-       sld_solvent,
-       rg1,
-       rg2,
-       nu1,
-       nu2,
-       v1,
-       v2):
+radius_effective_modes = ["outer_radius"]
+source = ["lib/polevl.c", "lib/sas_J0.c", "lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "protein_polymer.c"]
+
+# NumPy version of Iq in protein_polymer.c, kept as a reference for the compiled kernel.
+def Iq_numpy(q,
+             sld1,
+             sld2,
+             sld_solvent,
+             rg1,
+             rg2,
+             nu1,
+             nu2,
+             v1,
+             v2):
     """
     :param q:              Input q-value
     :param sld1:           Chain region 1 scattering length density
@@ -50,29 +62,16 @@ def Iq(q,
     # Volume of core regions:
     Vtotal     = (v1 + v2)
 
-    # One over excl. vol. parm.:
-    onu1  = 1.0 / nu1
-    o2nu1 = 1.0 / 2.0 / nu1
-    onu2  = 1.0 / nu2
-    o2nu2 = 1.0 / 2.0 / nu2
-
     # Propagator function:
-    E1 = j0(q*rg1)
+    E1 = special.j0(q*rg1)
 
     # Polymer size variable
-    Usub1 = (q*rg1)**2 * (2.0*nu1 + 1.0) * (2.0*nu1 + 2.0) / 6.0
-    Usub2 = (q*rg2)**2 * (2.0*nu2 + 1.0) * (2.0*nu2 + 2.0) / 6.0
+    Usub1 = chain.chain_usub(q, rg1, nu1)
+    Usub2 = chain.chain_usub(q, rg2, nu2)
 
-    # Form factor amplitude of the polymer:
-    with errstate(divide='ignore'):
-        Fp1 = o2nu1*power(Usub1, -o2nu1) * gamma(o2nu1) * gammainc(o2nu1, Usub1) 
-        Fp2 = o2nu2*power(Usub2, -o2nu2) * gamma(o2nu2) * gammainc(o2nu2, Usub2) 
-
-
-    # Form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
-    with errstate(divide='ignore'):
-        Pp1 = onu1 * power(Usub1, -o2nu1)*gamma(o2nu1)*gammainc(o2nu1, Usub1) - onu1 * power(Usub1, -onu1)*gamma(onu1)*gammainc(onu1,Usub1)
-        Pp2 = onu2 * power(Usub2, -o2nu2)*gamma(o2nu2)*gammainc(o2nu2, Usub2) - onu2 * power(Usub2, -onu2)*gamma(onu2)*gammainc(onu2,Usub2)
+    # Form factor amplitude and form factor of the polymer (Pp(q) is not simply Fp(q)^2!!):
+    Fp1, Pp1 = chain.chain_fp(Usub1, nu1)
+    Fp2, Pp2 = chain.chain_fp(Usub2, nu2)
 
     # Combine all terms to form intensity:
     #
@@ -91,10 +90,27 @@ def Iq(q,
 
     return inten
 
-Iq.vectorized = True  # Iq accepts an array of q values
-
-# Effective Radius for S(Q). This is only an estimation.
-def ER(radius, rc, rg1, rg2, v1, v2):
-    """Effective radius of a core-chain-chain sphere."""
-    eff_rad = radius + rg1 + rg2
-    return eff_rad
+def Iq_batch(q, **pars):
+    """
+    Iq_numpy for many parameter sets at once; see lib/batch.py.
+    """
+    return batch.evaluate(Iq_numpy, parameters, q, pars)
+
+def random():
+    pars = dict(
+        rg1 = np.random.uniform(10,100),
+        rg2 = np.random.uniform(10,100),
+        nu1 = np.random.uniform(0.3,0.6),
+        nu2 = np.random.uniform(0.3,0.6),
+        v1  = np.random.uniform(10,100),
+        v2  = np.random.uniform(10,100),
+    )
+    return pars
+
+# Reference values from Iq_numpy.
+tests = [
+    [{"background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [0.024481889, 0.024536601, 0.0040798865, 0.00017295585]],
+    [{"rg2": 60.0, "nu2": 0.6, "v2": 60.0, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [0.044180759, 0.042128947, 0.0050762579, 0.00031988471]],
+]
@@ -0,0 +1,17 @@
+static double Iq(double q, double f, double b, double sld1, double sld2, double sld3, double slds, double N1, double N2, double N3, double nu1, double nu2, double nu3, double pdi, double pdi_dist) {
+
+	// Blocks from the core out:
+	const double N[3] = {N1, N2, N3};
+	const double nu[3] = {nu1, nu2, nu3};
+	const double sld[3] = {sld1, sld2, sld3};
+
+	// Self term and core amplitude of one arm:
+	double S, A;
+	chain_arm(q, b, slds, 3, N, nu, sld, pdi, pdi_dist, &S, &A);
+
+	// Single branch terms of the f arms, and the interbranch terms of the
+	// f(f-1) ordered pairs of arms:
+	const double Pq = (f*S + f*(f-1.0)*A*A) / (f*f);
+
+	return 1e-4 * Pq;
+}
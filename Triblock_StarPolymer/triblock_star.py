@@ -4,6 +4,8 @@ Definition
 
 This model describes a star polymer with f identical triblock arms. Each arm is described by three blocks
 with different degrees of polymerization N_i, Flory exponents \nu_{i}, and SLD contrasts.
+It is the three block case of *multiblock_star*, which allows any number of
+blocks and heterografted stars.
 
 References
 ----------
@@ -18,8 +20,16 @@ Authorship and Verification
 """
 
 import numpy as np
-from numpy import inf, errstate, power,exp, sqrt
-from sasmodels.special import sas_gammainc, sas_gamma
+from numpy import inf, errstate, power, sqrt
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+# Shared model library (lib/), loaded on first use by the NumPy helpers so
+# that sasmodels can load the compiled model without them.
+lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+batch = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "batch.py"))
+fused = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "fused.py"))
 
 name = "triblock_star"
 title = "Triblock Star Polymer"
@@ -55,106 +65,89 @@ parameters = [
               ["nu1",      "",                 0.5,       [0.25,0.999],   "",     "Flory Exp. 1"],
               ["nu2",      "",                 0.5,       [0.25,0.999],   "",     "Flory Exp. 2"],
               ["nu3",      "",                 0.5,       [0.25,0.999],   "",     "Flory Exp. 3"],
+              ["pdi",      "",                 1.0,       [1.0, inf],     "",     "Arm block dispersity Mw/Mn"],
+              ["pdi_dist", "",                 0,         [["schulz", "lognormal"]], "", "Block length distribution"],
              ]
 # pylint: enable=bad-whitespace, line-too-long
 
-def Iq(q,
-       f,
-       b,
-       sld1,
-       sld2,
-       sld3,
-       slds,
-       N1,
-       N2,
-       N3,
-       nu1,
-       nu2,
-       nu3):
-
-    # Compute the contrast terms:
-    delta1 = sld1 - slds
-    delta2 = sld2 - slds
-    delta3 = sld3 - slds
-
-    # Excl. Vol. Parameters for each block:
-    onu1  = 1.0/nu1
-    o2nu1 = 1.0/2.0/nu1
-    onu2  = 1.0/nu2
-    o2nu2 = 1.0/2.0/nu2
-    onu3  = 1.0/nu3
-    o2nu3 = 1.0/2.0/nu3
-
-    # Polymer chain form factor and form factor amplitude for each block:
-    ## Block 1:
-    U1 = q**2 * b**2 * power(N1, 2.0*nu1) / 6.0
-    P1 = onu1 * power(U1, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, U1) - onu1 * power(U1, -onu1) * sas_gamma(onu1) * sas_gammainc(onu1, U1)
-    F1 = 0.50 * onu1 * power(U1, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, U1)
-
-    ## Block 1, double chain length.
-    U12 = q**2 * b**2 * power(2.0*N1, 2.0*nu1) / 6.0
-    P12 = onu1 * power(U12, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, U12) - onu1 * power(U12, -onu1) * sas_gamma(onu1) * sas_gammainc(onu1, U12)
-    F12 = 0.50 * onu1 * power(U12, -o2nu1) * sas_gamma(o2nu1) * sas_gammainc(o2nu1, U12)
-
-    ## Block 2:
-    U2 = q**2 * b**2 * power(N2, 2.0*nu2) / 6.0
-    P2 = onu2 * power(U2, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, U2) - onu2 * power(U2, -onu2) * sas_gamma(onu2) * sas_gammainc(onu2, U2)
-    F2 = 0.50 * onu2 * power(U2, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, U2)
-
-    ## Block 2, double chain length.
-    U22 = q**2 * b**2 * power(2.0*N2, 2.0*nu2) / 6.0
-    P22 = onu2 * power(U22, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, U22) - onu2 * power(U22, -onu2) * sas_gamma(onu2) * sas_gammainc(onu2, U22)
-    F22 = 0.50 * onu2 * power(U22, -o2nu2) * sas_gamma(o2nu2) * sas_gammainc(o2nu2, U22)
-
-    ## Block 3:
-    U3 = q**2 * b**2 * power(N3, 2.0*nu3) / 6.0
-    P3 = onu3 * power(U3, -o2nu3) * sas_gamma(o2nu3) * sas_gammainc(o2nu3, U3) - onu3 * power(U3, -onu3) * sas_gamma(onu3) * sas_gammainc(onu3, U3)
-    F3 = 0.50 * onu3 * power(U3, -o2nu3) * sas_gamma(o2nu3) * sas_gammainc(o2nu3, U3)
-
-    ## Block 3, double chain length.
-    U32 = q**2 * b**2 * power(2.0*N3, 2.0*nu3) / 6.0
-    P32 = onu3 * power(U32, -o2nu3) * sas_gamma(o2nu3) * sas_gammainc(o2nu3, U32) - onu3 * power(U32, -onu3) * sas_gamma(onu3) * sas_gammainc(onu3, U32)
-    F3 = 0.50 * onu3 * power(U32, -o2nu3) * sas_gamma(o2nu3) * sas_gammainc(o2nu3, U32)
-
-    # Propagator term (approximate):
-    E13  = exp(-U2)
-    E132 = exp(-U22)
-
-    # Combine to form interbranch and single branch terms:
-    Psb = (N1**2) * (delta1**2) * P1 + (N2**2) * (delta2**2) * P2 + (N3**2) * (delta3**2) * P3
-    Psb = Psb + 2.0*N1*N2*delta1*delta2*F1*F2 + 2.0*N2*N3*delta2*delta3*F2*F3
-    Psb = Psb + 2.0*N1*N3*delta1*delta3*F1*E13*F3
-   
-    P2sb = 4.0*(N1**2) * (delta1**2) * P12 + 4.0*(N2**2) * (delta2**2) * P22 + 4.0*(N3**2) * (delta3**2) * P33
-    P2sb = P2sb + 8.0*N1*N2*delta1*delta2*F12*F22 + 8.0*N2*N3*delta2*delta3*F22*F32
-    P2sb = P2sb + 8.0*N1*N3*delta1*delta3*F12*E132*F32
-
-    # Finally! The interbranch interference term!
-    Pib  = 2.0 * P2sb - Psb
-
-    Pq = power(f, -2.0) * (f*Psb - f*(f-1)*Pib)
-
-    # Form the structure factor according to the RPA:
-    #Sq = power(n*phi_p*vm*Pp, -1.00) + power(vs * (1.0 - phi_p), -1.00) - 2.00*chi/sqrt(vm*vs)
-    #inten = 1e-4 * power(Sq, -1.0)
+source = ["lib/sas_gammainc.c", "lib/sas_gamma.c", "../lib/polymer_chain.c", "triblock_star.c"]
+
+# NumPy version of Iq in triblock_star.c, kept as a reference for the compiled kernel.
+def Iq_numpy(q,
+             f,
+             b,
+             sld1,
+             sld2,
+             sld3,
+             slds,
+             N1,
+             N2,
+             N3,
+             nu1,
+             nu2,
+             nu3,
+             pdi=1.0,
+             pdi_dist=0):
+
+    # Self term and core amplitude of one arm, with the chain functions of
+    # the three blocks evaluated together:
+    (S, A), = chain.chain_arms(q, b, slds, [((N1, N2, N3), (nu1, nu2, nu3), (sld1, sld2, sld3))],
+                               pdi, pdi_dist)
+
+    # Single branch terms of the f arms, and the interbranch terms of the
+    # f(f-1) ordered pairs of arms:
+    Pq = power(f, -2.0) * (f*S + f*(f-1)*A*A)
 
     inten = 1e-4 * Pq
     return inten
 
-Iq.vectorized = True  # Iq accepts an array of q values
+def Iq_fused(q, f, b, sld1, sld2, sld3, slds, N1, N2, N3, nu1, nu2, nu3,
+             pdi=1.0, pdi_dist=0, out=None, chunk_size=fused.CHUNK_SIZE):
+    """
+    Iq_numpy evaluated in place over chunks of q; see lib/fused.py.
+    """
+    pars = dict(f=f, b=b, sld1=sld1, sld2=sld2, sld3=sld3, slds=slds, N1=N1, N2=N2, N3=N3,
+                nu1=nu1, nu2=nu2, nu3=nu3, pdi=pdi, pdi_dist=pdi_dist)
+    return fused.evaluate(_Iq_chunk, q, pars, out, chunk_size)
+
+def _Iq_chunk(q, out, work, f, b, sld1, sld2, sld3, slds, N1, N2, N3, nu1, nu2, nu3,
+              pdi, pdi_dist):
+    tmp, = work(1)
+
+    # Self term and core amplitude of one arm, as in Iq_numpy:
+    (S, A), = chain.chain_arms(q, b, slds, [((N1, N2, N3), (nu1, nu2, nu3), (sld1, sld2, sld3))],
+                               pdi, pdi_dist)
+
+    # (f S + f(f-1) A^2)/f^2:
+    np.multiply(S, 1e-4/f, out=out)
+    fused.accumulate(out, tmp, 1e-4*(f - 1.0)/f, A, A)
+
+def Iq_batch(q, out=None, **pars):
+    """
+    Iq_numpy for many parameter sets at once, into *out* if given; see
+    lib/batch.py.
+    """
+    return batch.evaluate(Iq_fused, parameters, q, pars, out)
 
 def random():
     pars = dict(
         scale=1,
-        phi = np.random.uniform(0.001, 0.999),
-        nu  = np.random.uniform(0.3,0.6),
+        f   = np.random.randint(2,13),
         b   = np.random.uniform(7,15),
-        n   = np.random.uniform(20,200),
-        vm  = np.random.uniform(50,200),
-        vs  = np.random.uniform(50,200),
-        chi = np.random.uniform(-0.5,1.5) 
+        N1  = np.random.uniform(10,200),
+        N2  = np.random.uniform(10,200),
+        N3  = np.random.uniform(10,200),
+        nu1 = np.random.uniform(0.3,0.6),
+        nu2 = np.random.uniform(0.3,0.6),
+        nu3 = np.random.uniform(0.3,0.6),
     )
     return pars
 
 demo = dict(scale=1, background=0,
-            nu = 0.5, b=7, n=40)
+            f=4, b=7, N1=40, N2=40, N3=40)
+
+# Reference values from the Gaussian star of f arms of 150 monomers.
+tests = [
+    [{"sld2": 1.0, "background": 0.0},
+     [0.001, 0.01, 0.1, 0.5], [63.138024, 57.163905, 2.6849855, 0.10335622]],
+]
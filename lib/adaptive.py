@@ -0,0 +1,193 @@
+r"""
+Adaptive q sampling
+-------------------
+
+Simulated curves for planning and plotting are usually drawn by evaluating
+the model on a dense log-spaced grid, most of which lies in smooth Guinier
+and power-law regions.  :func:`sample` instead starts from a coarse grid
+and refines only where the curve is not yet resolved.  The result, an
+:class:`AdaptiveCurve`, holds the nodes and interpolates between them, so it
+can be resampled onto any instrument q grid without calling the model
+again::
+
+    from sasmodels.custom import load_custom_kernel_module
+    adaptive = load_custom_kernel_module("lib/adaptive.py")
+
+    curve = adaptive.sample(lambda q: core_chain.Iq_batch(q, radius=80),
+                            1e-3, 1.0, rtol=1e-3, size=80)
+    Iq = curve(q_instrument)
+    curve.save("core_chain.npz")
+
+The curve is a not-a-knot cubic spline through the nodes, in $\log I$
+against $\log q$ when every node is positive, and in $I$ against $\log q$
+otherwise.  Each refinement pass evaluates the model near the log-midpoint
+of every unresolved interval, all in one call.  The value is compared with
+the spline through the existing nodes, and the point becomes a node.  An
+interval is resolved when the error at its midpoint is within *atol* +
+*rtol* $|I|$ and was also within it at the midpoint of its parent
+interval.  Otherwise it is split in two and both halves are checked in the
+next pass.  The second check catches a midpoint that happens to fall where
+an unresolved wiggle crosses the spline.  The error at the midpoints
+estimates the error of the coarser spline, so the final curve, which has
+those midpoints as nodes, is usually well within the tolerance.
+
+Features narrower than the node spacing, such as the oscillations of a
+large monodisperse core, can be missed when every node falls at nearly the
+same phase.  The split points are drawn at random from the middle of each
+interval, with a fixed seed, which makes that less likely.  Give the
+*size* of the scatterer to rule it out.
+
+:func:`model_function` turns a compiled sasmodels model and its parameters
+into a function of q to sample.
+"""
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+from sasmodels.direct_model import call_kernel
+
+#: Default relative tolerance of the interpolated intensity.
+DEFAULT_RTOL = 1e-3
+
+#: Default nodes per decade of q in the initial grid.
+POINTS_PER_DECADE = 10
+
+#: Default largest number of nodes.
+MAX_POINTS = 100000
+
+#: Intervals narrower than this in ln q are not split.
+MIN_STEP = 1e-6
+
+#: Split points are drawn from the middle 0.5 +/- JITTER of each interval.
+JITTER = 0.1
+
+#: Seed for the split points, so that sampling is reproducible.
+SEED = 1
+
+
+class AdaptiveCurve(object):
+    """
+    Intensity interpolated between adaptively placed nodes.
+
+    :param q:              Node q values, increasing
+    :param Iq:             Model intensity at the nodes
+    :param converged:      False if refinement stopped at *max_points* or
+                           *min_step* with intervals still unresolved
+
+    Call with an array of q to interpolate; q outside the nodes gives NaN.
+    """
+    def __init__(self, q, Iq, converged=True):
+        self.q = np.asarray(q, dtype=float)
+        self.Iq = np.asarray(Iq, dtype=float)
+        self.converged = converged
+        self.log = bool(np.all(self.Iq > 0))
+        self._spline = _spline(self.q, self.Iq, self.log)
+
+    def __len__(self):
+        return len(self.q)
+
+    def __call__(self, q):
+        q = np.asarray(q, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = self._spline(np.log(q))
+        return np.exp(value) if self.log else value
+
+    def save(self, filename):
+        """
+        Write the nodes to *filename* in NumPy .npz format.
+        """
+        np.savez(filename, q=self.q, Iq=self.Iq, converged=self.converged)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Curve saved by :meth:`save`.
+        """
+        with np.load(filename) as data:
+            return cls(data["q"], data["Iq"], bool(data["converged"]))
+
+
+def _spline(q, Iq, log):
+    with np.errstate(divide="ignore"):
+        return CubicSpline(np.log(q), np.log(Iq) if log else Iq, extrapolate=False)
+
+
+def sample(Iq, qmin, qmax, rtol=DEFAULT_RTOL, atol=0.0, size=None,
+           points_per_decade=POINTS_PER_DECADE, max_points=MAX_POINTS, min_step=MIN_STEP):
+    r"""
+    :class:`AdaptiveCurve` of the function *Iq(q)* from *qmin* to *qmax*,
+    refined until the interpolation error is below *atol* + *rtol* $|I|$.
+
+    *size* is the largest dimension of the scatterer in Ang, such as its
+    outer radius.  When given, intervals wider than $\pi/(4 \text{size})$
+    in q are split whatever their error, so that oscillations of period
+    $\pi/\text{size}$ are sampled before any interval is trusted.
+
+    *Iq* is called once per refinement pass with an array of new q values.
+    Refinement stops with *converged* False when the next pass would take
+    the curve past *max_points* nodes; intervals narrower than *min_step*
+    in ln q are not split.
+    """
+    if not 0 < qmin < qmax:
+        raise ValueError("need 0 < qmin < qmax")
+    n = max(4, int(np.ceil(points_per_decade*np.log10(qmax/qmin))) + 1)
+    x = np.linspace(np.log(qmin), np.log(qmax), n)
+    y = _evaluate(Iq, np.exp(x))
+    # Intervals [x[k], x[k+1]] still to be checked, by their left index,
+    # and whether the check of their parent passed.
+    pending = np.arange(n - 1)
+    passed = np.zeros(n - 1, dtype=bool)
+    step = np.inf if size is None else np.pi/(4.0*size)
+    converged = True
+    random = np.random.RandomState(SEED)
+    while len(pending):
+        if len(x) + len(pending) > max_points:
+            converged = False
+            break
+        fraction = random.uniform(0.5 - JITTER, 0.5 + JITTER, len(pending))
+        middle = x[pending] + fraction*(x[pending + 1] - x[pending])
+        value = _evaluate(Iq, np.exp(middle))
+        log = bool(np.all(y > 0) and np.all(value > 0))
+        with np.errstate(divide="ignore"):
+            guess = CubicSpline(x, np.log(y) if log else y)(middle)
+        predicted = np.exp(guess) if log else guess
+        good = np.abs(predicted - value) <= atol + rtol*np.abs(value)
+        wide = (x[pending + 1] - x[pending]) > 2.0*min_step
+        converged = converged and bool(np.all(good | wide))
+        coarse = np.exp(x[pending + 1]) - np.exp(x[pending]) > step
+        split = wide & (coarse | ~(good & passed))
+
+        # Insert the new points, then check both halves of each split interval.
+        order = np.argsort(np.concatenate((x, middle)), kind="stable")
+        position = np.empty(len(order), dtype=int)
+        position[order] = np.arange(len(order))
+        left = position[:len(x)][pending[split]]
+        x = np.concatenate((x, middle))[order]
+        y = np.concatenate((y, value))[order]
+        pending = np.concatenate((left, left + 1))
+        passed = np.concatenate((good[split], good[split]))
+    q = np.exp(x)
+    q[0], q[-1] = qmin, qmax
+    return AdaptiveCurve(q, y, converged)
+
+
+def _evaluate(Iq, q):
+    value = np.asarray(Iq(q), dtype=float)
+    if not np.all(np.isfinite(value)):
+        raise ValueError("Iq is not finite at q = %s" % q[~np.isfinite(value)][:5])
+    return value
+
+
+def model_function(model, pars):
+    """
+    Function of q evaluating the compiled sasmodels *model* (from
+    sasmodels.core.build_model) at the parameter dictionary *pars*, for
+    :func:`sample`.
+    """
+    def Iq(q):
+        kernel = model.make_kernel([q])
+        try:
+            return call_kernel(kernel, pars)
+        finally:
+            kernel.release()
+    return Iq
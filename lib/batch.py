@@ -0,0 +1,73 @@
+r"""
+Batched parameter-set evaluation
+--------------------------------
+
+Each model provides ``Iq_batch(q, **pars)``, which evaluates $I(q)$ for many
+parameter sets in one call.  Any parameter may be an array; the arrays are
+broadcast together, and the result has shape ``broadcast_shape + q.shape``.
+Terms that depend only on q are computed once and shared by every set.
+Parameters that are left out take their defaults from the model's
+parameter table.  As in sasmodels, the result is
+``scale * Iq + background``.
+
+Usage::
+
+    radius = np.linspace(50, 100, 51)
+    rg = np.linspace(20, 60, 41)[:, None]
+    Iq = core_chain.Iq_batch(q, radius=radius, rg=rg, background=0)
+    # Iq.shape == (41, 51, len(q))
+
+For the compiled models the batch is evaluated with NumPy instead of the C
+kernel.  Calls with many parameter sets then cost about the same as one
+array operation, instead of one kernel call per set.
+"""
+
+import numpy as np
+
+#: Defaults for the parameters sasmodels adds to every model.
+COMMON_DEFAULTS = {"scale": 1.0, "background": 0.001}
+
+
+def evaluate(Iq, parameters, q, pars, out=None, broadcast=True):
+    """
+    Evaluate *Iq* over broadcast parameter arrays.
+
+    :param Iq:             NumPy kernel Iq(q, par1, par2, ...)
+    :param parameters:     Model parameter table, used for defaults
+    :param q:              Input q-values (1D)
+    :param pars:           Parameter values; scalars or arrays
+    :param out:            Output array, for kernels taking Iq(q, ..., out=out)
+    :param broadcast:      False to pass each parameter with its own shape, for
+                           kernels that broadcast their arguments themselves
+    :return:               scale*Iq + background, shape broadcast_shape + q.shape
+    """
+    q, kernel_pars = arguments(parameters, q, pars, broadcast)
+    scale = kernel_pars.pop("scale")
+    background = kernel_pars.pop("background")
+    if out is not None:
+        Iq(q, out=out, **kernel_pars)
+        np.multiply(out, scale, out=out)
+        return np.add(out, background, out=out)
+    inten = Iq(q, **kernel_pars)
+    return scale * inten + background
+
+
+def arguments(parameters, q, pars, broadcast=True):
+    """
+    Flattened q and the broadcast kernel arguments for *pars*, with
+    defaults from *parameters* and each value given a trailing q axis.
+    With *broadcast* False the values keep their own shapes.
+    """
+    defaults = dict(COMMON_DEFAULTS)
+    defaults.update((p[0], p[2]) for p in parameters)
+    unknown = set(pars) - set(defaults)
+    if unknown:
+        raise TypeError("unknown parameters: %s" % ", ".join(sorted(unknown)))
+
+    names = list(defaults)
+    values = [np.asarray(pars.get(name, defaults[name]), dtype=float) for name in names]
+    if broadcast:
+        values = np.broadcast_arrays(*values)
+    # A trailing axis broadcasts every parameter set against the q vector.
+    kernel_pars = dict((name, value[..., None]) for name, value in zip(names, values))
+    return np.asarray(q, dtype=float).ravel(), kernel_pars
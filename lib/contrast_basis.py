@@ -0,0 +1,81 @@
+r"""
+Contrast-free basis for contrast variation
+------------------------------------------
+
+The core-chain models are quadratic in their SLD contrasts.  With the
+contrast vector $\Delta = (\Delta_1, \ldots, \Delta_n)$ of a model (for
+example core, shell and the two chain regions of ccc, each relative to the
+solvent or the next layer out),
+
+.. math::
+
+    I(q) = \sum_{i,j} \Delta_i \Delta_j S_{ij}(q) + I_c(q)
+
+where the partial scattering functions $S_{ij}(q)$ and the contrast-free
+term $I_c(q)$ depend only on the structural parameters.  The models build a
+:class:`ContrastBasis` from their structural parameters with ``Iq_basis``;
+calling it with any set of SLDs recombines the basis into $I(q)$ with a
+few multiply-adds per q point, without re-evaluating the chain functions.
+
+Usage::
+
+    basis = ccc.Iq_basis(q, volf=0.02, radius=75, ...)
+    for sld_solvent in (-0.56, 1.0, 2.5, 4.0, 6.37):
+        Iq = basis(sld_c=3.47, sld_s=-0.022, sld1=0.814, sld2=4.24,
+                   sld_solvent=sld_solvent)
+
+SLD arguments may be arrays; the result then has shape ``sld.shape + q.shape``.
+Structural parameters may also be arrays broadcast against q, as in the
+models' ``Iq_batch``; :meth:`ContrastBasis.evaluate` then takes SLDs that
+broadcast element-wise against the basis.
+"""
+
+import numpy as np
+
+
+class ContrastBasis(object):
+    """
+    Partial scattering functions of a model at fixed structural parameters.
+
+    :param contrasts:      Function of the SLD keywords returning the contrasts
+
+    Terms are accumulated with :meth:`add`; *S* maps the index pair (i, j),
+    i <= j, to the coefficient of contrast i times contrast j, and
+    *constant* holds the contrast-free intensity.
+    """
+    def __init__(self, contrasts):
+        self.contrasts = contrasts
+        self.S = {}
+        self.constant = 0.0
+
+    def add(self, i, j, values):
+        """
+        Add *values* times contrast i times contrast j to the intensity.
+        """
+        key = (min(i, j), max(i, j))
+        self.S[key] = self.S.get(key, 0.0) + values
+
+    def evaluate(self, out=None, **slds):
+        """
+        Recombine the basis into I(q), broadcasting the SLDs element-wise
+        against the basis arrays.  With *out*, the sum is accumulated in
+        place, into an array of the full result shape.
+        """
+        d = self.contrasts(**slds)
+        if out is not None:
+            out[...] = self.constant
+            for (i, j), values in self.S.items():
+                out += d[i] * d[j] * values
+            return out
+        inten = self.constant
+        for (i, j), values in self.S.items():
+            inten = inten + d[i] * d[j] * values
+        return inten
+
+    def __call__(self, **slds):
+        """
+        Recombine the basis into I(q) for the given SLDs, one curve per
+        SLD value.
+        """
+        return self.evaluate(**dict((k, np.asarray(v, dtype=float)[..., None])
+                                    for k, v in slds.items()))
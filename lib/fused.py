@@ -0,0 +1,90 @@
+r"""
+Chunked in-place evaluation
+---------------------------
+
+Written as array expressions, the NumPy models allocate a full-length
+temporary for almost every operation, e.g.
+``inten = inten + Ng * v_poly * v_poly * delta * delta * Pp``.  For long q
+vectors this costs more in the allocator than in the arithmetic, and peak
+memory reaches tens of times the size of q.
+
+:func:`evaluate` instead runs a model kernel over q in chunks of
+*CHUNK_SIZE* points, small enough for the working set to stay in cache.
+The kernel is called as ``kernel(q, out, work, **pars)`` with the q chunk,
+the matching slice of the output and a :class:`Workspace` of scratch
+arrays shaped like that slice, which are allocated once and reused for
+every chunk.  The output array may be supplied by the caller.
+
+core_chain and csc evaluate their ``Iq_basis``, the same NumPy reference
+as every other path of the model, for each chunk, and recombine it into
+*out* in place with ``ContrastBasis.evaluate(out=...)``.  Their
+temporaries are then the size of a chunk rather than of q.
+triblock_star writes its arm terms into *out* with ufunc ``out=``
+arguments and :func:`accumulate`.  The chain functions of
+lib/polymer_chain.py still allocate their own temporaries, but only the
+size of a chunk.
+
+Parameters are scalars or, as from ``Iq_batch``, arrays with a trailing
+axis of length 1; the result has shape ``broadcast_shape + q.shape``.
+"""
+
+import numpy as np
+
+#: Number of q points per chunk.
+CHUNK_SIZE = 4096
+
+
+class Workspace(object):
+    """
+    Scratch arrays for one chunk, allocated on first use.
+
+    ``work(n)`` returns *n* arrays shaped like the current output chunk.
+    """
+    def __init__(self, shape):
+        self.shape = shape
+        self.width = shape[-1]
+        self._buffers = []
+
+    def __call__(self, n):
+        while len(self._buffers) < n:
+            self._buffers.append(np.empty(self.shape))
+        return [buffer[..., :self.width] for buffer in self._buffers[:n]]
+
+
+def evaluate(kernel, q, pars, out=None, chunk_size=CHUNK_SIZE):
+    """
+    Evaluate *kernel* over q in chunks.
+
+    :param kernel:         Function kernel(q, out, work, **pars) filling out
+    :param q:              Input q-values (1D)
+    :param pars:           Parameter values; scalars or arrays with a trailing axis of 1
+    :param out:            Output array, or None to allocate one
+    :param chunk_size:     Number of q points per chunk
+    :return:               *out*, of shape broadcast_shape + q.shape
+    """
+    q = np.asarray(q, dtype=float).ravel()
+    shapes = [np.shape(value) for value in pars.values()]
+    if any(shape and shape[-1] != 1 for shape in shapes):
+        raise ValueError("parameter arrays need a trailing axis of length 1")
+    shape = np.broadcast_shapes(q.shape, *shapes)
+    if out is None:
+        out = np.empty(shape)
+    elif out.shape != shape:
+        raise ValueError("out has shape %s, expected %s" % (out.shape, shape))
+    work = Workspace(shape[:-1] + (min(chunk_size, max(len(q), 1)),))
+    for start in range(0, len(q), chunk_size):
+        stop = min(start + chunk_size, len(q))
+        work.width = stop - start
+        kernel(q[start:stop], out[..., start:stop], work, **pars)
+    return out
+
+
+def accumulate(out, tmp, coef, *factors):
+    """
+    out += coef * factors[0] * factors[1] * ..., using *tmp* as scratch.
+    """
+    np.multiply(factors[0], coef, out=tmp)
+    for factor in factors[1:]:
+        np.multiply(tmp, factor, out=tmp)
+    np.add(out, tmp, out=out)
+
@@ -0,0 +1,216 @@
+r"""
+Analytic parameter gradients
+----------------------------
+
+The compiled core-chain models provide ``Iq_grad(q, **pars)``, which returns
+the intensity together with its derivative with respect to every fitted
+parameter, for least-squares fitters that take a Jacobian.  Arguments and
+broadcasting are as for ``Iq_batch`` (see lib/batch.py), and the result is::
+
+    Iq, jac = ccc.Iq_grad(q, radius=80, rg1=50)
+    # Iq = scale*I(q) + background; jac["rg1"] = dIq/drg1, same shape as Iq
+
+Choice parameters (*ng_dist*, *pdi_dist*) and the parameters in *FIXED*,
+such as the chain dispersity *pdi*, are held fixed and have no entry in
+*jac*.
+
+The gradient is not a separate formula: :func:`evaluate` runs the model's
+NumPy kernel, the one behind ``Iq_batch``, with each parameter replaced by a
+:class:`Dual` number carrying its derivatives (forward-mode automatic
+differentiation).  Arithmetic and NumPy ufuncs on dual numbers propagate
+the derivatives by the chain rule.  The special functions propagate them
+with their closed-form derivatives: :func:`sas_sinx_x` and
+:func:`sas_3j1x_x` here, which the models call instead of those of
+sasmodels.special, and ``chain_fp`` and ``chain_fp_pdi`` in
+lib/polymer_chain.py, whose $\nu$ derivatives in $1 \le U \le 40$ are
+central differences (see ``chain_fp_grad``).  Each intermediate of the
+kernel is computed once, and its derivatives cost a few array operations
+per parameter that it depends on.  One call costs four to six evaluations
+of $I(q)$, against one per parameter for finite differences.
+"""
+
+from os.path import dirname, join as joinpath
+
+import numpy as np
+from numpy import cos
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.special import sas_sinx_x as _sas_sinx_x, sas_3j1x_x as _sas_3j1x_x
+
+batch = load_custom_kernel_module(joinpath(dirname(__file__), "batch.py"))
+
+#: Below this x the derivatives of sin(x)/x and 3 j1(x)/x use their series.
+SERIES_X = 0.1
+
+#: Parameters held fixed, for which the chain functions have no derivative.
+FIXED = ("pdi",)
+
+
+def evaluate(Iq, parameters, q, pars):
+    """
+    Evaluate *Iq* and its derivatives over broadcast parameter arrays.
+
+    :param Iq:             NumPy kernel Iq(q, par1, par2, ...), as for batch.evaluate
+    :param parameters:     Model parameter table, used for defaults
+    :param q:              Input q-values (1D)
+    :param pars:           Parameter values; scalars or arrays
+    :return:               scale*Iq + background and {name: dIq/dname},
+                           each of shape broadcast_shape + q.shape
+    """
+    q, kernel_pars = batch.arguments(parameters, q, pars)
+    scale = kernel_pars.pop("scale")
+    background = kernel_pars.pop("background")
+    names = [p[0] for p in parameters
+             if p[0] not in FIXED and not (isinstance(p[3], list) and isinstance(p[3][0], list))]
+    for name in names:
+        kernel_pars[name] = Dual(kernel_pars[name], {name: 1.0})
+    inten, jac = parts(Iq(q, **kernel_pars))
+    shape = np.broadcast(inten, scale, background).shape
+    result = dict((name, np.broadcast_to(scale * jac.get(name, 0.0), shape)) for name in names)
+    result["scale"] = np.broadcast_to(inten, shape)
+    result["background"] = np.ones(shape)
+    return scale * inten + background, result
+
+
+class Dual(object):
+    """
+    A value with its derivatives, for forward-mode differentiation.
+
+    :param value:          Value, a scalar or an array
+    :param grad:           {parameter name: d value/d parameter}
+
+    Operators and the ufuncs in *_UFUNC_RULES* return dual numbers.
+    """
+    __slots__ = ("value", "grad")
+
+    def __init__(self, value, grad=None):
+        self.value = value
+        self.grad = {} if grad is None else grad
+
+    def apply(self, value, derivative):
+        """
+        f(self) as a dual number, from *value* f(self.value) and
+        *derivative* f'(self.value).
+        """
+        return Dual(value, dict((name, derivative*dx) for name, dx in self.grad.items()))
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        rules = _UFUNC_RULES.get(ufunc)
+        if rules is None or method != "__call__" or kwargs:
+            return NotImplemented
+        values = [x.value if isinstance(x, Dual) else x for x in inputs]
+        value = ufunc(*values)
+        return Dual(value, linear(*[(x.grad, rule(value, *values))
+                                    for x, rule in zip(inputs, rules) if isinstance(x, Dual)]))
+
+    def __add__(self, other):
+        return np.add(self, other)
+
+    def __radd__(self, other):
+        return np.add(other, self)
+
+    def __sub__(self, other):
+        return np.subtract(self, other)
+
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+
+    def __mul__(self, other):
+        return np.multiply(self, other)
+
+    def __rmul__(self, other):
+        return np.multiply(other, self)
+
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+
+    def __pow__(self, other):
+        return np.power(self, other)
+
+    def __rpow__(self, other):
+        return np.power(other, self)
+
+    def __neg__(self):
+        return np.negative(self)
+
+    def __repr__(self):
+        return "Dual(%r, %r)" % (self.value, self.grad)
+
+
+#: Partial derivatives of the supported ufuncs, one function of
+#: (result, *arguments) per argument.
+_UFUNC_RULES = {
+    np.add: (lambda r, a, b: 1.0, lambda r, a, b: 1.0),
+    np.subtract: (lambda r, a, b: 1.0, lambda r, a, b: -1.0),
+    np.multiply: (lambda r, a, b: b, lambda r, a, b: a),
+    np.true_divide: (lambda r, a, b: 1.0/b, lambda r, a, b: -r/b),
+    np.power: (lambda r, a, b: b*np.power(a, b - 1.0), lambda r, a, b: r*np.log(a)),
+    np.negative: (lambda r, a: -1.0,),
+    np.exp: (lambda r, a: r,),
+    np.log: (lambda r, a: 1.0/a,),
+    np.sqrt: (lambda r, a: 0.5/r,),
+    np.sin: (lambda r, a: np.cos(a),),
+    np.cos: (lambda r, a: -np.sin(a),),
+}
+
+
+def parts(x):
+    """
+    Value and {name: derivative} of *x*, which may be a plain value.
+    """
+    return (x.value, x.grad) if isinstance(x, Dual) else (x, {})
+
+
+def linear(*terms):
+    """
+    Sum of (derivatives, factor) pairs, where *derivatives* is
+    {name: value}, e.g. the derivatives of f(x, y) are
+    linear((x.grad, df/dx), (y.grad, df/dy)).
+    """
+    result = {}
+    for derivatives, factor in terms:
+        for key, value in derivatives.items():
+            result[key] = result[key] + factor * value if key in result else factor * value
+    return result
+
+
+def sas_sinx_x(x):
+    """
+    sin(x)/x, for plain or dual numbers.
+    """
+    if isinstance(x, Dual):
+        return x.apply(_sas_sinx_x(x.value), sas_sinx_x_dx(x.value))
+    return _sas_sinx_x(x)
+
+
+def sas_3j1x_x(x):
+    """
+    3 j1(x)/x, for plain or dual numbers.
+    """
+    if isinstance(x, Dual):
+        return x.apply(_sas_3j1x_x(x.value), sas_3j1x_x_dx(x.value))
+    return _sas_3j1x_x(x)
+
+
+def sas_sinx_x_dx(x):
+    """
+    Derivative of sin(x)/x.
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = (cos(x) - _sas_sinx_x(x)) / x
+    x2 = x * x
+    return np.where(abs(x) < SERIES_X, -x/3.0 * (1.0 - x2/10.0 * (1.0 - x2/28.0 * (1.0 - x2/54.0))), result)
+
+
+def sas_3j1x_x_dx(x):
+    """
+    Derivative of 3 j1(x)/x = 3 (sin(x) - x cos(x))/x^3.
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = 3.0 * (_sas_sinx_x(x) - _sas_3j1x_x(x)) / x
+    x2 = x * x
+    return np.where(abs(x) < SERIES_X, -x/5.0 * (1.0 - x2/14.0 * (1.0 - x2/36.0 * (1.0 - x2/66.0))), result)
@@ -0,0 +1,175 @@
+r"""
+Hot-path instrumentation
+------------------------
+
+Opt-in profiling of the NumPy models: where does the time go inside one
+evaluation of $I(q)$?  A :class:`Profile` attached to a model module counts
+and times the calls of the special functions (*SPECIAL*) made by the model
+and by the shared library modules it loads, and times each intermediate term
+of the model's ``Iq_terms`` (see lib/term_cache.py), such as the core
+amplitudes, each chain's $F(U)$ and $P(U)$, and the free chains::
+
+    profile = instrument.Profile()
+    Iq = profile.evaluate(ccc, q, pars, pd={"radius": (radii, weights)})
+    profile.save("ccc_profile.json")
+
+:meth:`Profile.evaluate` averages the model over a dispersion mesh one point
+at a time and times each point.  Models with ``Iq_terms`` are evaluated
+through their term path, ``Iq_cache`` with nothing kept, so every term is
+computed and timed at every point; the others through ``Iq_batch``.  Any
+other code, such as a fit, can be profiled inside
+``with profile.attach(module):``; the report then covers every call made
+while attached.
+
+Attaching replaces the functions in the module namespaces with counting
+wrappers and detaching puts the originals back, so a model that is not
+attached runs exactly the code it always does.  Counts are in calls and in
+values computed, since the functions are vectorized.  Times are wall
+times and are inclusive: a term's time includes the special functions it
+calls.  The counts describe the NumPy reference path only.  The compiled C
+kernels skip terms whose prefactor is zero, such as the free chains when
+I0 = 0, and call sas_gamma once per parameter set in their prepare stage
+(see CHAIN_PREPARE in lib/polymer_chain.c), so they make fewer calls.  The
+times show the relative cost of the terms, not their cost in C.
+"""
+
+import json
+import time
+import types
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import product
+from os.path import dirname, abspath, join as joinpath
+
+import numpy as np
+from sasmodels.custom import load_custom_kernel_module
+
+#: Special functions counted wherever a model or the library imports them.
+SPECIAL = ("sas_gammainc", "sas_gamma", "sas_3j1x_x", "sas_sinx_x")
+
+LIB = dirname(abspath(__file__))
+
+batch = load_custom_kernel_module(joinpath(LIB, "batch.py"))
+
+
+def _namespaces(module):
+    # The model module and the library modules reachable from it, including
+    # the modules bound through a LazyModule (see lib/lazy.py), which are
+    # loaded here.
+    found, pending = [], [module]
+    while pending:
+        namespace = pending.pop()
+        if any(namespace is other for other in found):
+            continue
+        found.append(namespace)
+        for value in vars(namespace).values():
+            if type(value).__name__ == "LazyModule":
+                pending.append(value._load())
+            elif (isinstance(value, types.ModuleType)
+                  and dirname(abspath(getattr(value, "__file__", None) or "/")) == LIB):
+                pending.append(value)
+    return found
+
+
+class Profile(object):
+    """
+    Call counts and times of the special functions and terms of a model.
+
+    *special* and *terms* map names to {"calls", "values", "seconds"};
+    *points* lists the dispersion points timed by :meth:`evaluate`.
+    """
+    def __init__(self):
+        self.special = OrderedDict()
+        self.terms = OrderedDict()
+        self.points = []
+
+    def reset(self):
+        """
+        Clear the counters.
+        """
+        self.special.clear()
+        self.terms.clear()
+        del self.points[:]
+
+    def _wrap(self, table, name, function):
+        entry = table.setdefault(name, dict(calls=0, values=0, seconds=0.0))
+        def wrapper(*args, **kw):
+            start = time.perf_counter()
+            result = function(*args, **kw)
+            entry["seconds"] += time.perf_counter() - start
+            entry["calls"] += 1
+            entry["values"] += int(np.size(result[0] if isinstance(result, tuple) else result))
+            return result
+        return wrapper
+
+    @contextmanager
+    def attach(self, module):
+        """
+        Count the special functions and terms of the model *module* while
+        in the with block.
+        """
+        saved = []
+        try:
+            for namespace in _namespaces(module):
+                for name in SPECIAL:
+                    if callable(getattr(namespace, name, None)):
+                        saved.append((namespace, name, getattr(namespace, name)))
+                        setattr(namespace, name, self._wrap(self.special, name, getattr(namespace, name)))
+            if hasattr(module, "Iq_terms"):
+                saved.append((module, "Iq_terms", module.Iq_terms))
+                module.Iq_terms = [(name, depends, self._wrap(self.terms, name, function))
+                                   for name, depends, function in module.Iq_terms]
+            yield self
+        finally:
+            for namespace, name, value in reversed(saved):
+                setattr(namespace, name, value)
+
+    def evaluate(self, module, q, pars=None, pd=None):
+        """
+        scale*I(q) + background of the model *module* at *pars*, averaged
+        over the dispersion mesh *pd* = {name: (values, weights)} with one
+        call per point.  Each point is timed and added to *points*.
+        """
+        pars = dict(pars or {})
+        names = list(pd or {})
+        axes = [list(zip(*pd[name])) for name in names]
+        total, weight_sum = 0.0, 0.0
+        with self.attach(module):
+            if hasattr(module, "Iq_terms"):
+                Iq_point = module.Iq_cache(maxsize=0)
+            else:
+                Iq_point = module.Iq_batch
+            for point in product(*axes):
+                values = dict((name, float(v)) for name, (v, _) in zip(names, point))
+                weight = float(np.prod([w for _, w in point]))
+                start = time.perf_counter()
+                Iq = Iq_point(q, **dict(pars, scale=1.0, background=0.0, **values))
+                self.points.append(dict(values, weight=weight, seconds=time.perf_counter() - start))
+                total, weight_sum = total + weight*Iq, weight_sum + weight
+        defaults = batch.COMMON_DEFAULTS
+        return (pars.get("scale", defaults["scale"]) * total / weight_sum
+                + pars.get("background", defaults["background"]))
+
+    def report(self):
+        """
+        The counters as a dict of plain values, for JSON.  Each special
+        function and term also gets its fraction of the total time of the
+        dispersion points, when there are any.
+        """
+        total = sum(point["seconds"] for point in self.points)
+        def table(entries):
+            return OrderedDict((name, dict(entry, fraction=entry["seconds"]/total if total else None))
+                               for name, entry in entries.items())
+        return OrderedDict([
+            ("seconds", total),
+            ("special", table(self.special)),
+            ("terms", table(self.terms)),
+            ("points", list(self.points)),
+        ])
+
+    def save(self, filename):
+        """
+        Write :meth:`report` to *filename* as JSON.
+        """
+        with open(filename, "w") as fid:
+            json.dump(self.report(), fid, indent=1)
@@ -0,0 +1,58 @@
+r"""
+Lazily loaded modules
+---------------------
+
+The models in this collection are compiled, but their files also define
+NumPy helpers (``Iq_basis``, ``Iq_batch``, ``Iq_grad``, ``Iq_cache``, ...)
+built on the shared library in lib/ and on SciPy.  sasmodels executes the
+model file whenever it loads the model, so the helpers' modules are bound
+through a :class:`LazyModule`, which loads them on first attribute access::
+
+    from sasmodels.custom import load_custom_kernel_module
+    lazy = load_custom_kernel_module(joinpath(dirname(__file__), "..", "lib", "lazy.py"))
+
+    chain = lazy.LazyModule(joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+    special = lazy.LazyModule("sasmodels.special")
+
+Loading a model for its compiled kernel then imports neither the library
+nor SciPy.  Attributes are looked up in the loaded module on every access,
+so patching the module, as lib/instrument.py does, is seen through the
+proxy.
+"""
+
+import importlib
+
+from sasmodels.custom import load_custom_kernel_module
+
+
+class LazyModule(object):
+    """
+    Module loaded on first attribute access.
+
+    :param target:         Path of a .py file, loaded with
+                           sasmodels.custom.load_custom_kernel_module,
+                           or the dotted name of an importable module
+    """
+    def __init__(self, target):
+        self.__dict__["_target"] = target
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """
+        The module, loaded on the first call.
+        """
+        if self._module is None:
+            target = self._target
+            module = (load_custom_kernel_module(target) if target.endswith(".py")
+                      else importlib.import_module(target))
+            self.__dict__["_module"] = module
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return "<LazyModule %r%s>" % (self._target, "" if self._module is None else " (loaded)")
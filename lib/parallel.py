@@ -0,0 +1,137 @@
+r"""
+Thread-parallel evaluation over q
+---------------------------------
+
+Every model here is evaluated independently at each q, so a long q vector
+can be split into chunks and the chunks evaluated at the same time.  The
+compiled kernels are called through ctypes and the NumPy models spend
+their time in ufuncs, and both release the GIL, so a thread pool is
+enough to use all the cores.
+
+:func:`evaluate` runs a Python function of q, such as a model's
+``Iq_batch``, over chunks of q on a thread pool.  :class:`ParallelKernel`
+does the same for a compiled sasmodels model: it builds one kernel per
+chunk and calls them all with the same parameters::
+
+    from sasmodels.core import load_model_info, build_model
+    from sasmodels.custom import load_custom_kernel_module
+    parallel = load_custom_kernel_module("lib/parallel.py")
+
+    model = build_model(load_model_info("Core-Chain-Chain/ccc.py"), platform="dll")
+    kernel = parallel.ParallelKernel(model, [q], workers=16)
+    Iq = kernel(dict(radius=80, rg1=50))
+    kernel.release()
+
+    Iq = parallel.evaluate(lambda q: core_chain.Iq_batch(q, radius=80), q, workers=16)
+
+The chunk boundaries depend only on the length of q and *chunk_size*, not
+on the number of workers or on timing, and each chunk is evaluated exactly
+as it would be serially, so the results are identical to a serial
+evaluation and reproducible from run to run.
+
+Threads still take turns holding the GIL between ufunc calls.  The NumPy
+models therefore scale less well than the compiled kernels, and need
+larger chunks to scale at all.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sasmodels.direct_model import call_kernel
+
+#: Number of q points per chunk for :func:`evaluate`.
+CHUNK_SIZE = 1 << 16
+
+#: Number of q points per chunk for :class:`ParallelKernel`.
+KERNEL_CHUNK_SIZE = 1 << 14
+
+
+def default_workers():
+    """
+    Number of worker threads to use: the number of CPUs available to this
+    process.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def chunks(n, chunk_size):
+    """
+    Slices splitting range(n) into pieces of at most *chunk_size*.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    return [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+
+def evaluate(Iq, q, workers=None, chunk_size=CHUNK_SIZE, executor=None):
+    """
+    Evaluate *Iq(q)* over chunks of q on a thread pool.
+
+    :param Iq:             Function of a 1D q array, returning an array whose last axis is q
+    :param q:              Input q-values (1D)
+    :param workers:        Number of threads; default from :func:`default_workers`
+    :param chunk_size:     Number of q points per chunk
+    :param executor:       Existing concurrent.futures executor to use instead
+    :return:               The chunk results joined along the last axis
+    """
+    q = np.asarray(q, dtype=float).ravel()
+    parts = [q[index] for index in chunks(len(q), chunk_size)]
+    if len(parts) <= 1 or workers == 1:
+        return np.concatenate([np.asarray(Iq(part)) for part in parts] or [Iq(q)], axis=-1)
+    if executor is not None:
+        results = list(executor.map(Iq, parts))
+    else:
+        with ThreadPoolExecutor(min(workers or default_workers(), len(parts))) as pool:
+            results = list(pool.map(Iq, parts))
+    return np.concatenate([np.asarray(result) for result in results], axis=-1)
+
+
+class ParallelKernel(object):
+    """
+    Evaluate a compiled sasmodels model over chunks of q on a thread pool.
+
+    :param model:          Result of sasmodels.core.build_model
+    :param q_vectors:      List of q arrays, as for model.make_kernel: [q] or [qx, qy]
+    :param workers:        Number of threads; default from :func:`default_workers`
+    :param chunk_size:     Number of q points per chunk
+
+    Call with a parameter dictionary, as for sasmodels.direct_model.call_kernel,
+    to get I(q).  Call :meth:`release` when done to free the kernels and the
+    threads.
+    """
+    def __init__(self, model, q_vectors, workers=None, chunk_size=KERNEL_CHUNK_SIZE):
+        q_vectors = [np.asarray(v, dtype=float).ravel() for v in q_vectors]
+        if len(set(len(v) for v in q_vectors)) != 1:
+            raise ValueError("q vectors must have the same length")
+        self.model = model
+        self.nq = len(q_vectors[0])
+        self._chunks = chunks(self.nq, chunk_size)
+        self.kernels = [model.make_kernel([v[index] for v in q_vectors])
+                        for index in self._chunks]
+        self.workers = min(workers or default_workers(), max(len(self.kernels), 1))
+        self._pool = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+
+    def __call__(self, pars):
+        if self._pool is None:
+            results = [call_kernel(kernel, pars) for kernel in self.kernels]
+        else:
+            results = list(self._pool.map(lambda kernel: call_kernel(kernel, pars), self.kernels))
+        Iq = np.empty(self.nq)
+        for index, result in zip(self._chunks, results):
+            Iq[index] = result
+        return Iq
+
+    def release(self):
+        """
+        Free the compiled kernels and stop the worker threads.
+        """
+        for kernel in self.kernels:
+            kernel.release()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,375 @@
+/*******************************************************************
+
+Excluded-volume polymer chain (Hammouda)
+
+Form factor P(U) and form factor amplitude F(U) of a chain with Flory
+exponent nu, shared by the core-chain, star and RPA models:
+
+    F(U) = 1/(2 nu) U^(-1/(2 nu)) gamma(1/(2 nu), U)
+    P(U) = 1/nu U^(-1/(2 nu)) gamma(1/(2 nu), U) - 1/nu U^(-1/nu) gamma(1/nu, U)
+
+gamma(a, U) is the lower incomplete gamma function, Gamma(a)*sas_gammainc(a, U),
+and U = (q Rg)^2 (2 nu + 1)(2 nu + 2)/6 = (q b)^2 N^(2 nu)/6.
+
+Both F and P are returned from one evaluation of each incomplete gamma
+function.  Gamma(1/(2 nu)) and Gamma(1/nu) do not depend on q; compute them
+once with chain_init() and pass them to chain_fp() for every q.
+
+The incomplete gamma functions are only evaluated for CHAIN_USMALL <= U <=
+CHAIN_ULARGE.  Below that range F and P are summed from their Taylor series
+in U, with a = 1/(2 nu),
+
+    F(U) = a sum_k (-U)^k / (k! (a + k))
+    P(U) = 2 a^2 sum_k (-U)^k / (k! (a + k) (2a + k))
+
+which gives F(0) = P(0) = 1 rather than 0*inf at q = 0.  Above it the
+e^-U tails of gamma(a, U) are below double precision and F and P reduce to
+their power-law asymptotes
+
+    F(U) = a Gamma(a) U^-a
+    P(U) = 2a (Gamma(a) U^-a - Gamma(2a) U^-2a)
+
+Both branches agree with the incomplete gamma expressions to within a few
+ulp at the switch points for 0.25 <= nu <= 1.
+
+For grafted chains, chain_pairs() gives the mean number of ordered pairs of
+distinct chains on a particle with mean chain count Ng.  With ng_dist =
+CHAIN_NG_FIXED every particle carries exactly Ng chains (Ng may be
+fractional), giving Ng(Ng - 1).  With CHAIN_NG_POISSON the count is Poisson
+distributed with mean Ng, and <Ng(Ng - 1)> = Ng^2 exactly.  Terms linear in
+Ng, including the particle volume, are unchanged by the average, so the
+Poisson model costs nothing extra per q.
+
+chain_fp_pdi() averages over a distribution of chain lengths N with
+dispersity pdi = Mw/Mn at fixed number-average length Nn.  With x = N/Nn the
+chain volume scales as x and U as x^(2 nu), so it returns the volume-weighted
+amplitude and form factor
+
+    F = <x F(U x^(2 nu))>,   P = <x^2 P(U x^(2 nu))>
+
+with F(0) = 1 and P(0) = <x^2> = pdi.  pdi_dist selects a Schulz-Zimm
+(gamma, shape k = 1/(pdi - 1)) or log-normal number distribution of x.  For
+Gaussian chains (nu = 1/2) the Schulz-Zimm average has the closed form
+
+    F = (1 - M)/U,   P = 2 (M - 1 + U)/U^2,   M = (1 + U/k)^-k
+
+(summed from its moment series for small U).  Otherwise a fixed 20 point
+Gauss-Hermite rule is used, in ln x for the log-normal distribution and in
+x^(1/3), which is nearly normal for a gamma distribution, reweighted by the
+exact density for Schulz-Zimm.  The relative error of the rule is below
+1e-4 for pdi <= 1.5 and about 2e-3 at pdi = 2.
+
+chain_arm() gives the self term and the amplitude about the core of a star
+arm made of blocks with their own length, Flory exponent and SLD.  A star
+of f identical arms scatters as f S + f(f - 1) A^2.
+
+sasmodels calls a kernel once per q point, so anything computed from the
+parameters alone is recomputed for every q.  chain_prepare() does the
+q-independent part of chain_fp_pdi() for one chain: the gamma function
+constants and the nodes of the chain length rule, including the x^(2 nu)
+scale factors.  chain_fp_prep() then evaluates F and P at each q.  A kernel
+collects its q-independent quantities in a struct filled by a prepare
+function, and declares it with
+
+    CHAIN_PREPARE(type, name, prepare, par1, par2, ...);
+
+which makes name a const type * to the result of prepare(&value, par1,
+par2, ...).  In DLL builds the result is kept in thread-local storage and
+reused while the parameters are unchanged, so it is computed once per
+parameter set (and per thread) rather than once per q.  GPU builds (OpenCL
+and CUDA) and compilers other than gcc and clang have no such storage, and
+prepare() runs at every call.
+
+Requires lib/sas_gamma.c and lib/sas_gammainc.c.
+
+********************************************************************/
+
+#define CHAIN_USMALL 1.0
+#define CHAIN_ULARGE 40.0
+#define CHAIN_NSERIES 18
+#define CHAIN_NG_FIXED 0
+#define CHAIN_NG_POISSON 1
+#define CHAIN_PDI_SCHULZ 0
+#define CHAIN_PDI_LOGNORMAL 1
+#define CHAIN_PDI_HALF 10
+#define CHAIN_PDI_NODES (2*CHAIN_PDI_HALF)
+#define CHAIN_PDI_NSERIES 40
+
+// Positive nodes and normalized weights of the 20 point Gauss-Hermite rule
+// for the weight exp(-t^2/2).
+static const double chain_pdi_t[CHAIN_PDI_HALF] = {
+    0.34696415708135592, 1.0429453488027509, 1.7452473208141268,
+    2.4586636111723679, 3.1890148165533896, 3.9439673506573163,
+    4.7345813340460552, 5.5787388058932015, 6.5105901570136542,
+    7.6190485416797582};
+static const double chain_pdi_w[CHAIN_PDI_HALF] = {
+    0.26079306344955477, 0.16173933398400003, 0.061506372063976959,
+    0.013997837447100996, 0.0018301031310804924, 0.00012882627996192942,
+    4.4021210902308646e-06, 6.127490259982928e-08, 2.4820623623151797e-10,
+    1.2578006724379264e-13};
+
+// q-independent constants of a chain with Flory exponent nu.
+static void
+chain_init(double nu, double *o2nu, double *gamma_o2nu, double *gamma_onu)
+{
+    *o2nu = 0.5/nu;
+    *gamma_o2nu = sas_gamma(*o2nu);
+    *gamma_onu = sas_gamma(2.0*(*o2nu));
+}
+
+// Amplitude F(U) and form factor P(U) for 1/(2 nu) = o2nu.
+static void
+chain_fp(double U, double o2nu, double gamma_o2nu, double gamma_onu,
+         double *F, double *P)
+{
+    const double onu = 2.0*o2nu;
+
+    if (U < CHAIN_USMALL) {
+        double term = 1.0, sum_f = 0.0, sum_p = 0.0;
+        for (int k = 0; k < CHAIN_NSERIES; k++) {
+            const double ak = 1.0/(o2nu + k);
+            sum_f += term * ak;
+            sum_p += term * ak / (onu + k);
+            term *= -U/(k + 1);
+        }
+        *F = o2nu * sum_f;
+        *P = onu * o2nu * sum_p;
+    } else if (U > CHAIN_ULARGE) {
+        const double u_o2nu = pow(U, -o2nu);
+        *F = o2nu * gamma_o2nu * u_o2nu;
+        *P = onu * u_o2nu * (gamma_o2nu - gamma_onu * u_o2nu);
+    } else {
+        const double u_o2nu = pow(U, -o2nu);
+
+        // U^(-1/2nu) gamma(1/2nu, U) and U^(-1/nu) gamma(1/nu, U)
+        const double g1 = u_o2nu * gamma_o2nu * sas_gammainc(o2nu, U);
+        const double g2 = u_o2nu * u_o2nu * gamma_onu * sas_gammainc(onu, U);
+
+        *F = o2nu * g1;
+        *P = onu * (g1 - g2);
+    }
+}
+
+// Chain variable U from the radius of gyration.
+static double
+chain_usub(double q, double rg, double nu)
+{
+    return (q * rg) * (q * rg) * (2.0*nu + 1.0) * (2.0*nu + 2.0) / 6.0;
+}
+
+// Mean number of ordered pairs of distinct grafted chains, <Ng(Ng - 1)>.
+static double
+chain_pairs(double Ng, double ng_dist)
+{
+    return ((int)ng_dist == CHAIN_NG_POISSON) ? Ng*Ng : Ng*(Ng - 1.0);
+}
+
+// Chain lengths x = N/Nn and weights of the dispersity rule.
+static void
+chain_pdi_init(double pdi, double pdi_dist, double *x, double *w)
+{
+    double total = 0.0;
+    if ((int)pdi_dist == CHAIN_PDI_LOGNORMAL) {
+        // ln x is normal with variance ln(pdi) and mean -ln(pdi)/2.
+        const double sigma = sqrt(log(pdi));
+        for (int i = 0; i < CHAIN_PDI_NODES; i++) {
+            const int j = (i < CHAIN_PDI_HALF ? i : i - CHAIN_PDI_HALF);
+            const double t = (i < CHAIN_PDI_HALF ? -chain_pdi_t[j] : chain_pdi_t[j]);
+            x[i] = exp(sigma*(t - 0.5*sigma));
+            w[i] = chain_pdi_w[j];
+        }
+        return;
+    }
+
+    // Schulz-Zimm: u = x^(1/3) is close to normal with mean 1 - 1/(9k) and
+    // standard deviation 1/(3 sqrt(k)) (Wilson-Hilferty).  The weights are
+    // the exact density of u over the normal density, up to a constant.
+    const double k = 1.0/(pdi - 1.0);
+    const double mean = 1.0 - 1.0/(9.0*k);
+    const double sd = 1.0/(3.0*sqrt(k));
+    for (int i = 0; i < CHAIN_PDI_NODES; i++) {
+        const int j = (i < CHAIN_PDI_HALF ? i : i - CHAIN_PDI_HALF);
+        const double t = (i < CHAIN_PDI_HALF ? -chain_pdi_t[j] : chain_pdi_t[j]);
+        const double u = mean + sd*t;
+        if (u <= 0.0) {
+            x[i] = w[i] = 0.0;
+        } else {
+            x[i] = u*u*u;
+            w[i] = chain_pdi_w[j] * exp((3.0*k - 1.0)*log(u) - k*(x[i] - 1.0) + 0.5*t*t);
+        }
+        total += w[i];
+    }
+    for (int i = 0; i < CHAIN_PDI_NODES; i++) {
+        w[i] /= total;
+    }
+}
+
+#define CHAIN_RULE_NONE 0
+#define CHAIN_RULE_GAUSSIAN 1
+#define CHAIN_RULE_NODES 2
+
+// q-independent part of chain_fp_pdi() for one chain.
+typedef struct {
+    double o2nu, gamma_o2nu, gamma_onu;
+    int rule;                   // CHAIN_RULE_*: monodisperse, closed form, or nodes
+    double k;                   // Schulz-Zimm shape 1/(pdi - 1), for the closed form
+    int n;                      // number of nodes with nonzero weight
+    double x[CHAIN_PDI_NODES], w[CHAIN_PDI_NODES], scale[CHAIN_PDI_NODES];   // scale = x^(2 nu)
+} chain_prep;
+
+// Fill in the chain length rule of c, given its gamma function constants.
+static void
+chain_prepare_pdi(double pdi, double pdi_dist, chain_prep *c)
+{
+    c->n = 0;
+    if (pdi <= 1.0) {
+        c->rule = CHAIN_RULE_NONE;
+    } else if ((int)pdi_dist == CHAIN_PDI_SCHULZ && c->o2nu == 1.0) {
+        c->rule = CHAIN_RULE_GAUSSIAN;
+        c->k = 1.0/(pdi - 1.0);
+    } else {
+        double x[CHAIN_PDI_NODES], w[CHAIN_PDI_NODES];
+        c->rule = CHAIN_RULE_NODES;
+        chain_pdi_init(pdi, pdi_dist, x, w);
+        for (int i = 0; i < CHAIN_PDI_NODES; i++) {
+            if (w[i] > 0.0) {
+                c->x[c->n] = x[i];
+                c->w[c->n] = w[i];
+                c->scale[c->n] = pow(x[i], 1.0/c->o2nu);
+                c->n++;
+            }
+        }
+    }
+}
+
+// q-independent constants of a chain with Flory exponent nu and dispersity pdi.
+static void
+chain_prepare(double nu, double pdi, double pdi_dist, chain_prep *c)
+{
+    chain_init(nu, &c->o2nu, &c->gamma_o2nu, &c->gamma_onu);
+    chain_prepare_pdi(pdi, pdi_dist, c);
+}
+
+// Amplitude and form factor averaged over the chain length distribution,
+// from the constants of chain_prepare().
+static void
+chain_fp_prep(double U, const chain_prep *c, double *F, double *P)
+{
+    if (c->rule == CHAIN_RULE_NONE) {
+        chain_fp(U, c->o2nu, c->gamma_o2nu, c->gamma_onu, F, P);
+        return;
+    }
+
+    if (c->rule == CHAIN_RULE_GAUSSIAN) {
+        // Gaussian chains: closed form from the moments <x^n> of the
+        // gamma distribution.
+        const double k = c->k;
+        if (U < 0.25*fmin(k, 1.0)) {
+            double moment = 1.0 + 1.0/k;   // <x^2>
+            double term = 1.0, sum_f = 1.0, sum_p = 0.0;
+            for (int n = 0; n < CHAIN_PDI_NSERIES; n++) {
+                // term = (-U)^n/(n+1)!, moment = <x^(n+2)>
+                sum_p += 2.0 * term * moment / (n + 2);
+                term *= -U/(n + 2);
+                sum_f += term * moment;
+                moment *= 1.0 + (n + 2)/k;
+            }
+            *F = sum_f;
+            *P = sum_p;
+        } else {
+            const double M1 = expm1(-k*log1p(U/k));   // M - 1
+            *F = -M1/U;
+            *P = 2.0*(M1 + U)/(U*U);
+        }
+        return;
+    }
+
+    double sum_f = 0.0, sum_p = 0.0;
+    for (int i = 0; i < c->n; i++) {
+        double Fi, Pi;
+        chain_fp(U*c->scale[i], c->o2nu, c->gamma_o2nu, c->gamma_onu, &Fi, &Pi);
+        sum_f += c->w[i] * c->x[i] * Fi;
+        sum_p += c->w[i] * c->x[i] * c->x[i] * Pi;
+    }
+    *F = sum_f;
+    *P = sum_p;
+}
+
+// Amplitude and form factor averaged over the chain length distribution.
+static void
+chain_fp_pdi(double U, double o2nu, double gamma_o2nu, double gamma_onu,
+    double pdi, double pdi_dist, double *F, double *P)
+{
+    chain_prep c;
+    c.o2nu = o2nu;
+    c.gamma_o2nu = gamma_o2nu;
+    c.gamma_onu = gamma_onu;
+    chain_prepare_pdi(pdi, pdi_dist, &c);
+    chain_fp_prep(U, &c, F, P);
+}
+
+// Copy key[0..n) to last[0..n); return 1 if they were already equal.
+static int
+chain_same(double last[], const double key[], int n)
+{
+    int same = 1;
+    for (int i = 0; i < n; i++) {
+        if (last[i] != key[i]) {
+            same = 0;
+            last[i] = key[i];
+        }
+    }
+    return same;
+}
+
+// nvcc also defines __GNUC__, but device code cannot use __thread.
+#if defined(__GNUC__) && !defined(USE_OPENCL) && !defined(USE_CUDA)
+#define CHAIN_PREPARE(type, name, prepare, ...) \
+    const double name##_key[] = {__VA_ARGS__}; \
+    static __thread type name##_value; \
+    static __thread double name##_last[sizeof(name##_key)/sizeof(name##_key[0])]; \
+    static __thread int name##_ready = 0; \
+    if (!chain_same(name##_last, name##_key, sizeof(name##_key)/sizeof(name##_key[0])) \
+            || !name##_ready) { \
+        prepare(&name##_value, __VA_ARGS__); \
+        name##_ready = 1; \
+    } \
+    const type *name = &name##_value
+#else
+#define CHAIN_PREPARE(type, name, prepare, ...) \
+    type name##_value; \
+    prepare(&name##_value, __VA_ARGS__); \
+    const type *name = &name##_value
+#endif
+
+// Self term S and core amplitude A of a star arm of n blocks, numbered from
+// the core out.  Each block k has weight w_k = (sld_k - slds) N_k, and its
+// chain functions are evaluated once.  Block pairs are joined by the
+// (approximate) propagators E_m = exp(-U_m) of the blocks between them:
+//
+//     S = sum_k w_k^2 P_k + 2 sum_(k<l) w_k F_k E_(k+1)...E_(l-1) w_l F_l
+//     A = sum_k w_k F_k E_1...E_(k-1)
+//
+// The pair sum is accumulated in one pass, G_(k+1) = G_k E_k + w_k F_k.
+static void
+chain_arm(double q, double b, double slds, int n, const double N[],
+    const double nu[], const double sld[], double pdi, double pdi_dist,
+    double *S, double *A)
+{
+    double self = 0.0, pairs = 0.0, inner = 0.0, amplitude = 0.0, path = 1.0;
+    for (int k = 0; k < n; k++) {
+        double o2nu, gamma_o2nu, gamma_onu, F, P;
+        const double U = (q*b) * (q*b) * pow(N[k], 2.0*nu[k]) / 6.0;
+        chain_init(nu[k], &o2nu, &gamma_o2nu, &gamma_onu);
+        chain_fp_pdi(U, o2nu, gamma_o2nu, gamma_onu, pdi, pdi_dist, &F, &P);
+        const double w = (sld[k] - slds) * N[k];
+        const double E = exp(-U);
+        self += w*w*P;
+        pairs += w*F*inner;
+        inner = inner*E + w*F;
+        amplitude += w*F*path;
+        path *= E;
+    }
+    *S = self + 2.0*pairs;
+    *A = amplitude;
+}
@@ -0,0 +1,399 @@
+r"""
+Excluded-volume polymer chain (Hammouda)
+----------------------------------------
+
+Vectorized form factor $P(U)$ and form factor amplitude $F(U)$ of a chain
+with Flory exponent $\nu$, shared by the Python models in this collection.
+This is the NumPy counterpart of *lib/polymer_chain.c*.
+
+.. math::
+
+    F(U) &= \frac{1}{2\nu} U^{-1/2\nu} \gamma(1/2\nu, U) \\
+    P(U) &= \frac{1}{\nu} U^{-1/2\nu} \gamma(1/2\nu, U)
+            - \frac{1}{\nu} U^{-1/\nu} \gamma(1/\nu, U)
+
+with $U = (q R_g)^2 (2\nu + 1)(2\nu + 2)/6 = (q b)^2 N^{2\nu}/6$.
+
+As in the C version, the incomplete gamma functions are only evaluated for
+$1 \le U \le 40$.  Smaller $U$ uses the Taylor series ($a = 1/2\nu$)
+
+.. math::
+
+    F(U) = a \sum_k \frac{(-U)^k}{k!\,(a + k)}, \qquad
+    P(U) = 2a^2 \sum_k \frac{(-U)^k}{k!\,(a + k)(2a + k)}
+
+so that $F(0) = P(0) = 1$, and larger $U$ uses the power-law asymptotes
+$F = a\Gamma(a) U^{-a}$ and $P = 2a(\Gamma(a) U^{-a} - \Gamma(2a) U^{-2a})$.
+
+:func:`chain_pairs` gives the mean number of ordered pairs of distinct
+grafted chains, $\langle N_g(N_g - 1)\rangle$: $N_g(N_g - 1)$ for a fixed
+chain count and $N_g^2$ for a Poisson distributed count with mean $N_g$.
+
+:func:`chain_fp_pdi` averages over chain lengths with dispersity
+$D = M_w/M_n$ at fixed number-average length, returning
+$\langle x F(U x^{2\nu})\rangle$ and $\langle x^2 P(U x^{2\nu})\rangle$ for
+$x = N/N_n$ with a Schulz-Zimm or log-normal distribution, exactly as
+*chain_fp_pdi()* in the C version: the Zimm closed form for Gaussian chains
+with Schulz-Zimm lengths, and a fixed 20 point Gauss-Hermite rule otherwise.
+
+:func:`chain_arms` gives the self term $S$ and the amplitude about the core
+$A$ of star arms made of blocks with their own length, Flory exponent and
+SLD, as *chain_arm()* in the C version.  A star of $f$ identical arms
+scatters as $f S + f(f - 1) A^2$.
+
+:func:`chain_fp_grad` also returns the derivatives of $F$ and $P$ with
+respect to $U$ and to $\nu$ at fixed $U$.  :func:`chain_fp` and
+:func:`chain_fp_pdi` use them when given the dual numbers of the models'
+analytic gradients (see lib/gradient.py).  The $U$ derivatives use the
+relations
+
+.. math::
+
+    \frac{dF}{d\ln U} = \frac{1}{2\nu}\left(e^{-U} - F\right), \qquad
+    \frac{dP}{d\ln U} = \frac{1}{\nu}\left(F - P\right)
+
+or the differentiated series for small $U$.  The $\nu$ derivatives are
+analytic in the series and asymptotic branches, where they need only the
+digamma function; for $1 \le U \le 40$ they are central differences of
+the incomplete gamma branch alone, with relative step *CHAIN_DNU_STEP*.
+
+Models load this file with::
+
+    from os.path import dirname, join as joinpath
+    from sasmodels.custom import load_custom_kernel_module
+    chain = load_custom_kernel_module(
+        joinpath(dirname(__file__), "..", "lib", "polymer_chain.py"))
+
+References
+----------
+
+B. Hammouda, "Form Factors for Branched Polymers with Excluded Volume", J. of Research of NIST, 121, 139-164 (2016).
+"""
+
+from os.path import dirname, join as joinpath
+
+import numpy as np
+from numpy import power, exp, log
+from scipy.special import digamma
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.special import sas_gamma, sas_gammainc
+
+gradient = load_custom_kernel_module(joinpath(dirname(__file__), "gradient.py"))
+
+#: Chain count distributions for chain_pairs, matching the ng_dist choices.
+NG_FIXED, NG_POISSON = 0, 1
+
+#: Chain length distributions for chain_fp_pdi, matching the pdi_dist choices.
+PDI_SCHULZ, PDI_LOGNORMAL = 0, 1
+
+#: Gauss-Hermite rule for the weight exp(-t^2/2), with normalized weights.
+PDI_T, PDI_W = np.polynomial.hermite_e.hermegauss(20)
+PDI_W = PDI_W / PDI_W.sum()
+PDI_NSERIES = 40
+
+#: U below which the Taylor series is used, and above which the power-law asymptotes are used.
+CHAIN_USMALL, CHAIN_ULARGE = 1.0, 40.0
+
+#: Number of terms in the Taylor series.
+CHAIN_NSERIES = 18
+
+#: Relative step in nu for the derivatives of the incomplete gamma branch.
+CHAIN_DNU_STEP = 1e-5
+
+
+def chain_init(nu):
+    """
+    Return the q-independent constants (1/2nu, gamma(1/2nu), gamma(1/nu)).
+    """
+    o2nu = 0.5 / nu
+    return o2nu, sas_gamma(o2nu), sas_gamma(2.0 * o2nu)
+
+
+def chain_fp(U, nu, constants=None):
+    """
+    :param U:              Chain variable (q Rg)^2 (2nu+1)(2nu+2)/6
+    :param nu:             Flory exponent
+    :param constants:      Result of chain_init(nu), if already known
+    :return:               Amplitude F(U) and form factor P(U)
+    """
+    if isinstance(U, gradient.Dual) or isinstance(nu, gradient.Dual):
+        return _chain_fp_dual(U, nu)
+    o2nu, gamma_o2nu, gamma_onu = chain_init(nu) if constants is None else constants
+    U, o2nu, gamma_o2nu, gamma_onu = np.broadcast_arrays(
+        np.asarray(U, dtype=float), o2nu, gamma_o2nu, gamma_onu)
+    F, P = np.empty(U.shape), np.empty(U.shape)
+
+    small = U < CHAIN_USMALL
+    large = U > CHAIN_ULARGE
+    middle = ~(small | large)
+    for index, branch in ((small, _chain_series), (large, _chain_asymptote),
+                          (middle, _chain_gammainc)):
+        if index.any():
+            F[index], P[index] = branch(
+                U[index], o2nu[index], gamma_o2nu[index], gamma_onu[index])
+    return F, P
+
+
+def _chain_series(U, o2nu, gamma_o2nu, gamma_onu):
+    onu = 2.0 * o2nu
+    term = np.ones_like(U)
+    sum_f, sum_p = np.zeros_like(U), np.zeros_like(U)
+    for k in range(CHAIN_NSERIES):
+        ak = 1.0 / (o2nu + k)
+        sum_f += term * ak
+        sum_p += term * ak / (onu + k)
+        term *= -U / (k + 1)
+    return o2nu * sum_f, onu * o2nu * sum_p
+
+
+def _chain_asymptote(U, o2nu, gamma_o2nu, gamma_onu):
+    onu = 2.0 * o2nu
+    u_o2nu = power(U, -o2nu)
+    return o2nu * gamma_o2nu * u_o2nu, onu * u_o2nu * (gamma_o2nu - gamma_onu * u_o2nu)
+
+
+def _chain_gammainc(U, o2nu, gamma_o2nu, gamma_onu):
+    onu = 2.0 * o2nu
+    u_o2nu = power(U, -o2nu)
+    g1 = u_o2nu * gamma_o2nu * sas_gammainc(o2nu, U)
+    g2 = u_o2nu * u_o2nu * gamma_onu * sas_gammainc(onu, U)
+    return o2nu * g1, onu * (g1 - g2)
+
+
+def chain_usub(q, rg, nu):
+    """
+    Chain variable U from the radius of gyration.
+    """
+    return (q * rg)**2 * (2.0 * nu + 1.0) * (2.0 * nu + 2.0) / 6.0
+
+
+def chain_pairs(Ng, ng_dist=NG_FIXED):
+    """
+    Mean number of ordered pairs of distinct grafted chains, <Ng(Ng - 1)>.
+    """
+    poisson = np.asarray(ng_dist).astype(int) == NG_POISSON
+    return Ng * (Ng - 1.0 + poisson)
+
+
+def chain_pdi_init(pdi, pdi_dist=PDI_SCHULZ):
+    """
+    Chain lengths x = N/Nn and weights of the dispersity rule, with shape
+    (20,) + broadcast shape of pdi and pdi_dist.  pdi <= 1 gives x = 1.
+    """
+    pdi, dist = np.broadcast_arrays(np.asarray(pdi, dtype=float), np.asarray(pdi_dist).astype(int))
+    shape = (-1,) + (1,)*pdi.ndim
+    t, w0 = PDI_T.reshape(shape), PDI_W.reshape(shape)
+    with np.errstate(all='ignore'):
+        # Log-normal: ln x is normal with variance ln(pdi), mean -ln(pdi)/2.
+        sigma = np.sqrt(np.log(pdi))
+        x_ln = exp(sigma*(t - 0.5*sigma))
+
+        # Schulz-Zimm: x^(1/3) is close to normal (Wilson-Hilferty); weights
+        # are the exact density over the normal density, up to a constant.
+        k = 1.0/(pdi - 1.0)
+        u = 1.0 - 1.0/(9.0*k) + t/(3.0*np.sqrt(k))
+        x_sz = np.where(u > 0, u**3, 0.0)
+        w_sz = np.where(u > 0, w0*exp((3.0*k - 1.0)*log(u) - k*(x_sz - 1.0) + 0.5*t*t), 0.0)
+        w_sz = w_sz / w_sz.sum(axis=0)
+
+    lognormal = dist == PDI_LOGNORMAL
+    mono = pdi <= 1.0
+    x = np.where(mono, 1.0, np.where(lognormal, x_ln, x_sz))
+    w = np.where(mono | lognormal, w0, w_sz)
+    return x, w
+
+
+def chain_fp_pdi(U, nu, pdi=1.0, pdi_dist=PDI_SCHULZ):
+    """
+    :param U:              Chain variable at the number-average chain length
+    :param nu:             Flory exponent
+    :param pdi:            Dispersity Mw/Mn
+    :param pdi_dist:       PDI_SCHULZ or PDI_LOGNORMAL
+    :return:               <x F(U x^2nu)> and <x^2 P(U x^2nu)>, x = N/Nn
+    """
+    if isinstance(U, gradient.Dual) or isinstance(nu, gradient.Dual):
+        return _chain_fp_dual(U, nu, pdi, pdi_dist)
+    if np.all(np.asarray(pdi) <= 1.0):
+        return chain_fp(U, nu)
+    U = np.asarray(U, dtype=float)
+    x, w = _chain_pdi_nodes(U, pdi, pdi_dist)
+    F, P = chain_fp(U * power(x, 2.0*nu), nu)
+    F, P = np.sum(w*x*F, axis=0), np.sum(w*x*x*P, axis=0)
+
+    # Gaussian chains with Schulz-Zimm lengths: closed form.
+    gaussian = ((np.asarray(pdi_dist).astype(int) == PDI_SCHULZ)
+                & (np.asarray(nu) == 0.5) & (np.asarray(pdi) > 1.0))
+    if gaussian.any():
+        Fg, Pg = _chain_schulz_gaussian(U, 1.0/(np.asarray(pdi, dtype=float) - 1.0))
+        F, P = np.where(gaussian, Fg, F), np.where(gaussian, Pg, P)
+    return F, P
+
+
+def _chain_pdi_nodes(U, pdi, pdi_dist):
+    # Nodes and weights with a leading node axis, broadcastable against U.
+    x, w = chain_pdi_init(pdi, pdi_dist)
+    ndim = max(U.ndim, x.ndim - 1)
+    x = x.reshape(x.shape[:1] + (1,)*(ndim - x.ndim + 1) + x.shape[1:])
+    return x, w.reshape(x.shape)
+
+
+def _chain_schulz_gaussian(U, k):
+    with np.errstate(all='ignore'):
+        M1 = np.expm1(-k*np.log1p(U/k))
+        F, P = -M1/U, 2.0*(M1 + U)/(U*U)
+
+        # Moment series for small U.
+        moment = 1.0 + 1.0/k
+        term, sum_f, sum_p = 1.0, 1.0, 0.0
+        for n in range(PDI_NSERIES):
+            sum_p = sum_p + 2.0*term*moment/(n + 2)
+            term = term * -U/(n + 2)
+            sum_f = sum_f + term*moment
+            moment = moment * (1.0 + (n + 2)/k)
+    small = U < 0.25*np.minimum(k, 1.0)
+    return np.where(small, sum_f, F), np.where(small, sum_p, P)
+
+
+def chain_arms(q, b, slds, arms, pdi=1.0, pdi_dist=PDI_SCHULZ):
+    """
+    Self term S and core amplitude A of each kind of star arm; see
+    chain_arm() in polymer_chain.c.
+
+    :param q:              Input q-values
+    :param b:              Kuhn length
+    :param slds:           Solvent SLD
+    :param arms:           (N, nu, sld) per kind of arm, each a sequence of
+                           block values from the core out
+    :param pdi:            Block dispersity Mw/Mn
+    :param pdi_dist:       PDI_SCHULZ or PDI_LOGNORMAL
+    :return:               List of (S, A), one per kind of arm
+
+    The chain functions of the blocks of all the arms are evaluated in a
+    single call.
+    """
+    blocks = [block for N, nu, sld in arms for block in zip(N, nu, sld)]
+    # Block values broadcast together, blocks first, with an axis for q:
+    values = np.broadcast_arrays(*[value for block in blocks for value in block])
+    shape = (len(blocks),) + (values[0].shape or (1,))
+    N, nu, sld = (np.stack(values[k::3]).reshape(shape) for k in range(3))
+    U = (q*b)**2 / 6.0 * power(N, 2.0*nu)
+    F, P = chain_fp_pdi(U, nu, pdi, pdi_dist)
+    w = (sld - slds) * N
+    wF, E = w*F, exp(-U)
+
+    result, start = [], 0
+    for arm in arms:
+        diagonal, pairs, inner, amplitude, path = 0.0, 0.0, 0.0, 0.0, 1.0
+        for k in range(start, start + len(arm[0])):
+            diagonal = diagonal + w[k]*w[k]*P[k]
+            pairs = pairs + wF[k]*inner
+            inner = inner*E[k] + wF[k]
+            amplitude = amplitude + wF[k]*path
+            path = path*E[k]
+        result.append((diagonal + 2.0*pairs, amplitude))
+        start += len(arm[0])
+    return result
+
+
+def chain_fp_grad(U, nu, pdi=1.0, pdi_dist=PDI_SCHULZ):
+    """
+    :param U:              Chain variable, as for chain_fp_pdi
+    :param nu:             Flory exponent
+    :param pdi:            Dispersity Mw/Mn
+    :param pdi_dist:       PDI_SCHULZ or PDI_LOGNORMAL
+    :return:               F, P, dF/dU, dP/dU, dF/dnu, dP/dnu; the nu
+                           derivatives are at fixed U
+    """
+    U = np.asarray(U, dtype=float)
+    F, P = chain_fp_pdi(U, nu, pdi, pdi_dist)
+    if np.all(np.asarray(pdi) <= 1.0):
+        return (F, P) + _chain_du(U, nu, F, P) + _chain_dnu(U, nu)
+
+    # Average the derivatives over the length distribution.  U x^2nu
+    # depends on nu through x^2nu as well.
+    x, w = _chain_pdi_nodes(U, pdi, pdi_dist)
+    scale = power(x, 2.0*nu)
+    Ux = U * scale
+    Fx, Px = chain_fp(Ux, nu)
+    Fx_U, Px_U = _chain_du(Ux, nu, Fx, Px)
+    Fx_nu, Px_nu = _chain_dnu(Ux, nu)
+    with np.errstate(divide='ignore'):
+        Ux_nu = np.where(x > 0, 2.0*log(x), 0.0) * Ux
+    mono = np.asarray(pdi) <= 1.0
+    F_U = np.where(mono, Fx_U[0], np.sum(w*x*scale*Fx_U, axis=0))
+    P_U = np.where(mono, Px_U[0], np.sum(w*x*x*scale*Px_U, axis=0))
+    F_nu = np.where(mono, Fx_nu[0], np.sum(w*x*(Fx_nu + Fx_U*Ux_nu), axis=0))
+    P_nu = np.where(mono, Px_nu[0], np.sum(w*x*x*(Px_nu + Px_U*Ux_nu), axis=0))
+    return F, P, F_U, P_U, F_nu, P_nu
+
+
+def _chain_fp_dual(U, nu, pdi=1.0, pdi_dist=PDI_SCHULZ):
+    # chain_fp_pdi for dual numbers U and nu.
+    U, U_grad = gradient.parts(U)
+    nu, nu_grad = gradient.parts(nu)
+    F, P, F_U, P_U, F_nu, P_nu = chain_fp_grad(U, nu, pdi, pdi_dist)
+    return (gradient.Dual(F, gradient.linear((U_grad, F_U), (nu_grad, F_nu))),
+            gradient.Dual(P, gradient.linear((U_grad, P_U), (nu_grad, P_nu))))
+
+
+def _chain_du(U, nu, F, P):
+    # dF/dU and dP/dU from F and P, with the differentiated series for small U.
+    o2nu = 0.5 / np.asarray(nu, dtype=float)
+    U, o2nu, F, P = np.broadcast_arrays(U, o2nu, F, P)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        F_U = o2nu * (exp(-U) - F) / U
+        P_U = 2.0 * o2nu * (F - P) / U
+    small = U < CHAIN_USMALL
+    if small.any():
+        Us, a = U[small], o2nu[small]
+        term = np.ones_like(Us)
+        sum_f, sum_p = np.zeros_like(Us), np.zeros_like(Us)
+        for k in range(CHAIN_NSERIES):
+            sum_f += term / (a + k + 1)
+            sum_p += term / ((a + k + 1) * (2.0*a + k + 1))
+            term *= -Us / (k + 1)
+        F_U[small], P_U[small] = -a * sum_f, -2.0 * a * a * sum_p
+    return F_U, P_U
+
+
+def _chain_dnu(U, nu):
+    # dF/dnu and dP/dnu at fixed U, branch by branch as in chain_fp.
+    nu = np.asarray(nu, dtype=float)
+    U, nu = np.broadcast_arrays(U, nu)
+    F_nu, P_nu = np.empty(U.shape), np.empty(U.shape)
+    small = U < CHAIN_USMALL
+    large = U > CHAIN_ULARGE
+    middle = ~(small | large)
+    for index, branch in ((small, _chain_series_da), (large, _chain_asymptote_da)):
+        if index.any():
+            a = 0.5 / nu[index]
+            F_a, P_a = branch(U[index], a)
+            # da/dnu = -1/(2 nu^2) = -2 a^2
+            F_nu[index], P_nu[index] = -2.0*a*a*F_a, -2.0*a*a*P_a
+    if middle.any():
+        Um, num = U[middle], nu[middle]
+        h = CHAIN_DNU_STEP * num
+        Fp, Pp = _chain_gammainc(Um, *chain_init(num + h))
+        Fm, Pm = _chain_gammainc(Um, *chain_init(num - h))
+        F_nu[middle], P_nu[middle] = (Fp - Fm)/(2.0*h), (Pp - Pm)/(2.0*h)
+    return F_nu, P_nu
+
+
+def _chain_series_da(U, a):
+    term = np.ones_like(U)
+    sum_f, sum_p = np.zeros_like(U), np.zeros_like(U)
+    for k in range(CHAIN_NSERIES):
+        g = a * a / ((a + k) * (2.0*a + k))
+        sum_f += term * k / (a + k)**2
+        sum_p += term * g * (2.0/a - 1.0/(a + k) - 2.0/(2.0*a + k))
+        term *= -U / (k + 1)
+    return sum_f, 2.0 * sum_p
+
+
+def _chain_asymptote_da(U, a):
+    # F = Gamma(a+1) U^-a, P = 2F - Gamma(2a+1) U^-2a
+    log_U = log(U)
+    F = sas_gamma(a + 1.0) * exp(-a*log_U)
+    G = sas_gamma(2.0*a + 1.0) * exp(-2.0*a*log_U)
+    F_a = F * (digamma(a + 1.0) - log_U)
+    return F_a, 2.0*F_a - 2.0*G*(digamma(2.0*a + 1.0) - log_U)
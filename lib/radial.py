@@ -0,0 +1,217 @@
+r"""
+Radial binning for 2D detector images
+-------------------------------------
+
+The models here are isotropic: $I(q_x, q_y) = I(|q|)$.  On a detector image
+with $10^6$ pixels, most pixels have nearly the same $|q|$ as one of their
+neighbours, so evaluating the model once per pixel repeats the same work.
+
+:class:`RadialBinning` evaluates the model on a set of $|q|$ nodes and
+scatters the result back onto the pixels.  With *rtol* = 0 the nodes are the
+distinct $|q|$ values of the image, so the result is exact.  With *rtol* > 0
+the nodes are geometrically spaced with $\Delta q/q$ = *rtol* between the
+smallest and largest $|q|$.  Each pixel is interpolated with a cubic through
+the four nearest nodes, so the error falls as *rtol*$^4$.  Only nodes that
+some pixel uses are kept.  :meth:`RadialBinning.interpolation_error`
+evaluates the model at the midpoints of the occupied node intervals, where
+the interpolation is least accurate, and reports the largest relative
+error.
+
+:class:`RadialKernel` wraps a compiled sasmodels model in the same way.  A
+1D kernel is built on the nodes once and can then be called repeatedly, for
+example while fitting a 2D frame::
+
+    from sasmodels.core import load_model_info, build_model
+    from sasmodels.custom import load_custom_kernel_module
+    radial = load_custom_kernel_module("lib/radial.py")
+
+    model = build_model(load_model_info("Core-Chain-Chain/ccc.py"))
+    kernel = radial.RadialKernel(model, qx, qy, rtol=1e-3)
+    image = kernel(dict(radius=80, rg1=50))
+    print(kernel.binning.n, "nodes; error", kernel.interpolation_error(dict(radius=80)))
+
+The NumPy models work the same way through ``Iq_batch``::
+
+    binning = radial.RadialBinning(qx, qy, rtol=1e-3)
+    image = binning.evaluate(lambda q: core_chain.Iq_batch(q, radius=80))
+"""
+
+import numpy as np
+
+from sasmodels.direct_model import call_kernel
+
+#: Default node spacing Delta q/q.
+DEFAULT_RTOL = 1e-3
+
+
+def is_isotropic(info):
+    """
+    True if the model's 2D intensity depends only on |q|: it has no
+    orientation or magnetic parameters and no 2D kernel of its own.
+    """
+    return (not info.parameters.has_2d
+            and getattr(info, "Iqxy", None) is None
+            and getattr(info, "Iqac", None) is None
+            and getattr(info, "Iqabc", None) is None)
+
+
+def _stencil(nodes, interval, x):
+    """
+    Lagrange interpolation through the (up to) four nodes around each
+    *interval*, evaluated at *x*.  Returns node indices and weights, both
+    of shape (k, len(x)).
+    """
+    k = min(4, len(nodes))
+    start = np.clip(interval - (k//2 - 1), 0, len(nodes) - k)
+    index = start + np.arange(k)[:, None]
+    xk = nodes[index]
+    weight = np.ones(index.shape)
+    for j in range(k):
+        for m in range(k):
+            if m != j:
+                weight[j] *= (x - xk[m]) / (xk[j] - xk[m])
+    return index, weight
+
+
+class RadialBinning(object):
+    """
+    Map between pixel (qx, qy) values and a set of |q| nodes.
+
+    :param qx, qy:         Pixel q values, any matching shape
+    :param rtol:           Node spacing Delta q/q; 0 for exact unique |q| values
+
+    *q* holds the nodes and *n* the number of nodes; *shape* is the image shape.
+    """
+    def __init__(self, qx, qy, rtol=DEFAULT_RTOL):
+        if rtol < 0:
+            raise ValueError("rtol must be non-negative")
+        qx, qy = np.broadcast_arrays(np.asarray(qx, dtype=float), np.asarray(qy, dtype=float))
+        self.shape = qx.shape
+        self.rtol = rtol
+        qmod = np.hypot(qx, qy).ravel()
+
+        if rtol == 0:
+            self.q, inverse = np.unique(qmod, return_inverse=True)
+            self._index, self._weight = inverse[None, :], np.ones((1, qmod.size))
+            self._mid = None
+            self.n = len(self.q)
+            return
+
+        # Geometric nodes over the positive |q| range, plus q = 0 for the
+        # beam centre if it is on the image.
+        positive = qmod[qmod > 0]
+        nodes = np.empty(0)
+        if positive.size:
+            qmin, qmax = positive.min(), positive.max()
+            n = max(int(np.ceil(np.log(qmax/qmin) / np.log1p(rtol))), 1) + 1
+            nodes = np.geomspace(qmin, qmax, n)
+        if (qmod == 0).any():
+            nodes = np.concatenate(([0.0], nodes))
+        interval = np.clip(np.searchsorted(nodes, qmod) - 1, 0, max(len(nodes) - 2, 0))
+        index, weight = _stencil(nodes, interval, qmod)
+
+        # Midpoints of the occupied intervals, for the error estimate.
+        occupied = np.unique(interval)
+        if len(nodes) > 1:
+            lower, upper = nodes[occupied], nodes[occupied + 1]
+            mid = np.where(lower > 0, np.sqrt(lower*upper), 0.5*upper)
+            mid_index, mid_weight = _stencil(nodes, occupied, mid)
+        else:
+            mid, mid_index, mid_weight = np.empty(0), np.empty((1, 0), dtype=int), np.empty((1, 0))
+
+        # Keep only the nodes that some pixel interpolates from.
+        used = np.zeros(len(nodes), dtype=bool)
+        used[index.ravel()] = True
+        renumber = np.cumsum(used) - 1
+        self.q = nodes[used]
+        self._index, self._weight = renumber[index], weight
+        self._mid = mid, renumber[mid_index], mid_weight
+        self.n = len(self.q)
+
+    def scatter(self, Iq):
+        """
+        Image from the intensity *Iq* at the nodes.  Extra leading dimensions
+        of *Iq* are kept, e.g. for Iq_batch over several parameter sets.
+        """
+        Iq = np.asarray(Iq)
+        return self._interpolate(Iq, self._index, self._weight).reshape(Iq.shape[:-1] + self.shape)
+
+    @staticmethod
+    def _interpolate(Iq, index, weight):
+        result = weight[0] * Iq[..., index[0]]
+        for j in range(1, len(index)):
+            result += weight[j] * Iq[..., index[j]]
+        return result
+
+    def evaluate(self, Iq):
+        """
+        Image from the function *Iq(q)* evaluated once on the nodes.
+        """
+        return self.scatter(Iq(self.q))
+
+    @property
+    def midpoints(self):
+        """
+        Midpoints of the occupied node intervals; empty for exact binning.
+        """
+        return np.empty(0) if self._mid is None else self._mid[0]
+
+    def interpolation_error(self, Iq):
+        """
+        Largest relative error of the interpolated intensity, estimated at
+        the interval midpoints from the function *Iq(q)*.
+        """
+        if not len(self.midpoints):
+            return 0.0
+        return self._error(Iq(self.q), Iq(self.midpoints))
+
+    def _error(self, Iq_nodes, Iq_mid):
+        _, index, weight = self._mid
+        approx = self._interpolate(np.asarray(Iq_nodes), index, weight)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            error = np.abs(approx - Iq_mid) / np.abs(Iq_mid)
+        return float(np.nanmax(error))
+
+
+class RadialKernel(object):
+    """
+    Evaluate a compiled isotropic sasmodels model on a detector image by
+    radial binning.
+
+    :param model:          Result of sasmodels.core.build_model
+    :param qx, qy:         Pixel q values
+    :param rtol:           Node spacing, as for RadialBinning
+
+    Call with a parameter dictionary to get the image.  Call :meth:`release`
+    when done to free the kernel.
+    """
+    def __init__(self, model, qx, qy, rtol=DEFAULT_RTOL):
+        if not is_isotropic(model.info):
+            raise ValueError("model %s is not isotropic" % model.info.id)
+        self.model = model
+        self.binning = RadialBinning(qx, qy, rtol)
+        self.kernel = model.make_kernel([self.binning.q])
+        self._mid_kernel = None
+
+    def __call__(self, pars):
+        return self.binning.scatter(call_kernel(self.kernel, pars))
+
+    def interpolation_error(self, pars):
+        """
+        Largest relative interpolation error at parameters *pars*.
+        """
+        binning = self.binning
+        if not len(binning.midpoints):
+            return 0.0
+        if self._mid_kernel is None:
+            self._mid_kernel = self.model.make_kernel([binning.midpoints])
+        return binning._error(call_kernel(self.kernel, pars),
+                              call_kernel(self._mid_kernel, pars))
+
+    def release(self):
+        """
+        Free the compiled kernels.
+        """
+        self.kernel.release()
+        if self._mid_kernel is not None:
+            self._mid_kernel.release()
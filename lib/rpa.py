@@ -0,0 +1,181 @@
+r"""
+Multicomponent random phase approximation
+-----------------------------------------
+
+Incompressible RPA for a blend of $n$ components, vectorized over q and
+over any number of parameter sets.  Component $n$ is the reference.  The
+bare (non-interacting) structure factor matrix $S^0_{ij}(q)$ is built from
+the excluded-volume chain of *lib/polymer_chain.py*.  Incompressibility,
+$\sum_i \delta\phi_i = 0$, reduces it to the $(n-1)\times(n-1)$ matrix
+
+.. math::
+
+    S^{\rm id}_{ij} = S^0_{ij} - \frac{a_i a_j}{\sum_{kl} S^0_{kl}},
+    \qquad a_i = \sum_k S^0_{ik}
+
+which for a blend of homopolymers gives the familiar
+$(S^{\rm id})^{-1}_{ij} = \delta_{ij}/S^0_{ii} + 1/S^0_{nn}$.
+The interactions enter through
+
+.. math::
+
+    V_{ij} = c_{ij} - c_{in} - c_{jn}, \qquad c_{ij} = \chi_{ij}/\sqrt{v_i v_j}
+
+where $v_i$ is the monomer volume, so that $S^{-1} = (S^{\rm id})^{-1} + V$.
+For two components this is the model in *Chain_ExcludedVolume_RPA*.  $S$ is
+computed as $(1 + S^{\rm id} V)^{-1} S^{\rm id}$, which stays finite where
+$S^{\rm id}$ is singular, as for a copolymer melt at $q = 0$.  The
+intensity is $10^{-4}\,\Delta\rho^T S \Delta\rho$ in cm$^{-1}$, with the
+contrasts $\Delta\rho_i = \rho_i - \rho_n$ in $10^{-6}/\text{\AA}^2$ and
+volumes in $\text{\AA}^3$.
+
+Components are grouped into molecules, given as lists of component
+indices in the order of the blocks along the chain.  A molecule of one
+component is a homopolymer, or with $N = 1$ and $b = 0$ a solvent.  Blocks of
+a copolymer share the Kuhn length and Flory exponent of its first block,
+and the copolymer volume fraction is the sum of its blocks' fractions.  For
+blocks $k$ and $l$ of the same chain, the sum over monomer pairs
+$D_{kl} = \sum_{i\in k,\,j\in l} \langle e^{i q r_{ij}} \rangle$ follows exactly
+from $P(U)$ of contiguous segments, $D(X) = |X|^2 P(X)$:
+
+.. math::
+
+    D_{kl} = \tfrac{1}{2}\left[D(k \cup m \cup l) - D(k \cup m) - D(m \cup l) + D(m)\right]
+
+with $m$ the monomers between them, and
+$S^0_{kl} = \phi_{\rm mol} v_k v_l D_{kl} / V_{\rm mol}$, where $V_{\rm mol}$ is the
+molecular volume.
+
+All values may be arrays that broadcast against q (so an array of
+parameter sets needs a trailing axis for q); the linear algebra is
+done by batched NumPy solves over the broadcast shape, so a scan over
+$\chi$ at fixed composition evaluates the chain form factors only once::
+
+    from sasmodels.custom import load_custom_kernel_module
+    rpa = load_custom_kernel_module("lib/rpa.py")
+
+    chi = np.linspace(0.0, 0.02, 50)[:, None]    # 50 temperatures
+    Iq = rpa.intensity(q, n=[1000, 1000, 1], v=[100, 100, 100], b=[7, 7, 0],
+                       nu=[0.5, 0.5, 0.5], phi=[0.2, 0.2, 0.6], sld=[1.4, 6.4, 0.0],
+                       chi=[[0, 0, chi], [0, 0, chi], [chi, chi, 0]])
+    # Iq.shape == (50, len(q))
+"""
+
+import numpy as np
+from numpy import errstate
+from os.path import dirname, join as joinpath
+from sasmodels.custom import load_custom_kernel_module
+
+chain = load_custom_kernel_module(joinpath(dirname(__file__), "polymer_chain.py"))
+
+
+def _pair_sum(q, length, b, nu):
+    """
+    Sum over monomer pairs of a contiguous chain segment, length^2 P(U).
+    """
+    _, P = chain.chain_fp((q*b)**2 * np.power(length, 2.0*nu) / 6.0, nu)
+    return length*length*P
+
+
+def bare_structure(q, n, v, b, nu, phi, molecules=None):
+    """
+    Bare structure factor matrix S0 of the components.
+
+    :param q:              Input q-values
+    :param n:              Degree of polymerization of each component
+    :param v:              Monomer volume of each component
+    :param b:              Kuhn length of each component
+    :param nu:             Flory exponent of each component
+    :param phi:            Volume fraction of each component
+    :param molecules:      Lists of component indices, one per molecule, in
+                           block order; default one molecule per component
+    :return:               S0, shape broadcast_shape + (ncomp, ncomp)
+    """
+    ncomp = len(n)
+    if molecules is None:
+        molecules = [[k] for k in range(ncomp)]
+    if sorted(k for blocks in molecules for k in blocks) != list(range(ncomp)):
+        raise ValueError("every component must be in exactly one molecule")
+
+    entries = {}
+    for blocks in molecules:
+        first = blocks[0]
+        volume = sum(n[k]*v[k] for k in blocks)
+        with errstate(divide='ignore', invalid='ignore'):
+            density = sum(phi[k] for k in blocks) / volume
+        ends = []
+        for k in blocks:
+            ends.append(n[k] + (ends[-1] if ends else 0.0))
+        for i, k in enumerate(blocks):
+            entries[k, k] = density * v[k]*v[k] * _pair_sum(q, n[k], b[first], nu[first])
+            for j in range(i + 1, len(blocks)):
+                l = blocks[j]
+                start_k, end_k = ends[i] - n[k], ends[i]
+                start_l, end_l = ends[j] - n[l], ends[j]
+                pairs = 0.5*(_pair_sum(q, end_l - start_k, b[first], nu[first])
+                             - _pair_sum(q, start_l - start_k, b[first], nu[first])
+                             - _pair_sum(q, end_l - end_k, b[first], nu[first])
+                             + _pair_sum(q, start_l - end_k, b[first], nu[first]))
+                entries[k, l] = entries[l, k] = density * v[k]*v[l] * pairs
+
+    shape = np.broadcast_shapes(*[np.shape(value) for value in entries.values()])
+    S0 = np.zeros(shape + (ncomp, ncomp))
+    for (k, l), value in entries.items():
+        S0[..., k, l] = value
+    return S0
+
+
+def incompressible(S0):
+    """
+    Structure factor of the first n-1 components of a non-interacting
+    incompressible blend, from the bare matrix *S0*.
+    """
+    a = S0[..., :-1, :].sum(axis=-1)
+    with errstate(divide='ignore', invalid='ignore'):
+        return S0[..., :-1, :-1] - a[..., :, None]*a[..., None, :] / S0.sum(axis=(-2, -1))[..., None, None]
+
+
+def interaction(chi, v):
+    """
+    Interaction matrix V of the first n-1 components, from the symmetric
+    Flory-Huggins matrix *chi*, given as nested lists of values, and the
+    monomer volumes *v*.
+    """
+    ncomp = len(v)
+    entries = [[chi[i][j] / np.sqrt(v[i]*v[j]) for j in range(ncomp)] for i in range(ncomp)]
+    shape = np.broadcast_shapes(*[np.shape(c) for row in entries for c in row])
+    c = np.empty(shape + (ncomp, ncomp))
+    for i in range(ncomp):
+        for j in range(ncomp):
+            c[..., i, j] = entries[i][j]
+    return c[..., :-1, :-1] - c[..., :-1, -1:] - c[..., -1:, :-1]
+
+
+def structure_factor(S_id, V):
+    """
+    Interacting structure factor S = (1 + S_id V)^-1 S_id, solved over the
+    broadcast shape of *S_id* and *V*.
+    """
+    shape = np.broadcast_shapes(S_id.shape, V.shape)
+    identity = np.eye(shape[-1])
+    return np.linalg.solve(identity + np.matmul(S_id, V), np.broadcast_to(S_id, shape))
+
+
+def intensity(q, n, v, b, nu, phi, sld, chi, molecules=None):
+    """
+    RPA intensity of the blend in cm^-1.
+
+    :param sld:            Scattering length density of each component
+    :param chi:            Flory-Huggins parameters, ncomp x ncomp, zero diagonal
+    :return:               I(q), shape broadcast_shape
+
+    The other parameters are as for :func:`bare_structure`.
+    """
+    S = structure_factor(incompressible(bare_structure(q, n, v, b, nu, phi, molecules)),
+                         interaction(chi, v))
+    contrast = [np.asarray(sld[k] - sld[-1], dtype=float) for k in range(len(sld) - 1)]
+    shape = np.broadcast_shapes(*[c.shape for c in contrast])
+    drho = np.empty(shape + (len(contrast),))
+    for k, c in enumerate(contrast):
+        drho[..., k] = c
+    return 1e-4 * np.einsum("...i,...ij,...j->...", drho, S, drho)
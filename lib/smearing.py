@@ -0,0 +1,336 @@
+r"""
+Cached resolution smearing
+--------------------------
+
+Smeared intensities are computed by evaluating the model on a calculation
+grid *q_calc* and then multiplying by a resolution matrix:
+$I_s(q_i) = \sum_j W_{ij} I(q_{\text{calc},j})$.  The matrix depends only
+on the data, so :func:`smearing` builds it once per dataset as a
+scipy.sparse matrix and caches it.  The cache key is the q, dQ and slit
+arrays compared by value.  Each smeared evaluation is then one model call
+on *q_calc* and one sparse matrix-vector product.
+
+Pinhole data use the Gaussian weights of sasmodels.resolution.Pinhole1D,
+truncated to $(-2.5\sigma, +3\sigma)$.  Only the nonzero band is stored,
+and the truncation is applied exactly rather than at the nearest bin.
+Slit data use the integrals of sasmodels.resolution.Slit1D, with the same
+*slit_length* (dxl) and *slit_width* (dxw) conventions.  Slit1D takes $I$
+at the midpoint of each bin, which converges only as $h/q$ with the grid
+spacing $h$ because of the $1/\sqrt{q_\text{calc}^2 - q^2}$ singularity of
+the slit weight.  Here $I$ is interpolated linearly between the points of
+*q_calc* and the interpolant is integrated exactly, which converges as
+$h^2$.  Points with zero dQ, or with zero slit length and width, are
+evaluated at their own q, as sasmodels does.
+
+Unlike sasmodels, which evaluates the model at every data point plus an
+extrapolation, *q_calc* here is built from the resolution.  Grid points
+are *density* per $\sigma$ for pinhole data, and *density* per local data
+spacing for slit data.  When $dQ$ is broad compared with the data spacing,
+as is usual for SANS, this needs far fewer model evaluations.
+:func:`points_per_width` gives a pinhole density for a requested relative
+accuracy.  :func:`choose_density` finds the smallest density that reaches
+the accuracy for a given model function.  The slit grid follows the data,
+which need not resolve the model, so for slit data :func:`smearing` uses
+it unless given a density::
+
+    from sasmodels.custom import load_custom_kernel_module
+    smearing = load_custom_kernel_module("lib/smearing.py")
+
+    Iq = lambda q: core_chain.Iq_batch(q, radius=80)
+    density = smearing.choose_density(Iq, q, dq=dq, accuracy=1e-4)
+    res = smearing.smearing(q, dq=dq, density=density)
+    Iq_smeared = res.evaluate(Iq)
+
+:class:`SmearedKernel` does the same for a compiled sasmodels model.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.special import erf
+
+from sasmodels import resolution
+from sasmodels.direct_model import call_kernel
+
+#: Default relative accuracy of the smeared intensity.
+DEFAULT_ACCURACY = 1e-3
+
+#: Largest grid density tried by choose_density.
+MAX_DENSITY = 64
+
+#: Number of cached smearing operators.
+CACHE_SIZE = 16
+
+#: Steps in the slit width integral when both slit length and width are
+#: nonzero, as sasmodels.resolution.slit_resolution.
+SLIT_WIDTH_STEPS = 30
+
+_CACHE = OrderedDict()
+
+
+def points_per_width(accuracy=DEFAULT_ACCURACY):
+    """
+    Pinhole grid density for relative *accuracy*, assuming an error of
+    (h/sigma)^2/8 for grid spacing h.  This is the midpoint rule bound with room for
+    curvature in I(q); use :func:`choose_density` to fit it to a model.
+    """
+    return max(2, int(np.ceil(1.0/np.sqrt(8.0*accuracy))))
+
+
+def calc_grid(lower, upper, x, step):
+    """
+    Points from *lower* to *upper* spaced by at most *step*, interpolated
+    linearly between its values at the increasing points *x*.  Each
+    interval between the points of *x* is divided evenly.
+    """
+    knots = np.unique(np.concatenate(([lower], x[(x > lower) & (x < upper)], [upper])))
+    step = np.interp(knots, x, step)
+    length = np.diff(knots)
+    counts = np.maximum(np.ceil(length/np.minimum(step[:-1], step[1:])), 1).astype(int)
+    index = np.repeat(np.arange(len(counts)), counts)
+    fraction = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))/counts[index]
+    return np.append(knots[index] + fraction*length[index], upper)
+
+
+def pinhole_matrix(q_calc, q, dq, nsigma=resolution.PINHOLE_N_SIGMA):
+    """
+    Sparse pinhole weights W of shape (len(q), len(q_calc)), as
+    sasmodels.resolution.pinhole_resolution but built band by band.  The
+    bins at the ends of each band are cut at the truncation limits, so the
+    weights converge as (h/sigma)^2 with the grid spacing h.
+    """
+    nsigma_low, nsigma_high = nsigma
+    edges = resolution.bin_edges(q_calc)
+    qlow, qhigh = q - nsigma_low*dq, q + nsigma_high*dq
+    start = np.searchsorted(edges, qlow, side="right") - 1
+    stop = np.searchsorted(edges, qhigh, side="left")
+    start, stop = np.clip(start, 0, len(q_calc)), np.clip(stop, 0, len(q_calc))
+    counts = stop - start
+    rows = np.repeat(np.arange(len(q)), counts)
+    cols = start[rows] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    lower = np.maximum(edges[cols], qlow[rows])
+    upper = np.minimum(edges[cols + 1], qhigh[rows])
+    scale = 1.0/(np.sqrt(2.0)*dq[rows])
+    weights = erf((upper - q[rows])*scale) - erf((lower - q[rows])*scale)
+    weights /= np.bincount(rows, weights, minlength=len(q))[rows]
+    return csr_matrix((weights, (rows, cols)), shape=(len(q), len(q_calc)))
+
+
+def _linear_weights(x, a, b, moments):
+    # Columns and weights on the points x of the integral of I(t) g(t) from
+    # a to b, with I linear between the points.  moments(t) gives the
+    # antiderivatives of g(t) and t g(t).
+    lower, upper = max(a, x[0]), min(b, x[-1])
+    if upper <= lower:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    j = np.arange(np.searchsorted(x, lower, side="right") - 1,
+                  np.searchsorted(x, upper, side="left"))
+    M0_low, M1_low = moments(np.maximum(x[j], lower))
+    M0_high, M1_high = moments(np.minimum(x[j + 1], upper))
+    M0, M1 = M0_high - M0_low, M1_high - M1_low
+    h = x[j + 1] - x[j]
+    return np.concatenate((j, j + 1)), np.concatenate(((x[j + 1]*M0 - M1)/h, (M1 - x[j]*M0)/h))
+
+
+def _length_weights(q_calc, q, length):
+    # (1/L) int_0^L I(sqrt(q^2 + u^2)) du = (1/L) int_q^Q I(t) t/sqrt(t^2 - q^2) dt
+    def moments(t):
+        r = np.sqrt(np.maximum(t*t - q*q, 0.0))
+        return r/length, (t*r + q*q*np.log(t + r))/(2.0*length)
+    return _linear_weights(q_calc, abs(q), np.sqrt(q*q + length*length), moments)
+
+
+def _width_weights(q_calc, q, width):
+    # (1/2W) int_-W^W I(|q + v|) dv, folded at zero when q < W
+    def moments(t):
+        return t/(2.0*width), t*t/(4.0*width)
+    cols, weights = _linear_weights(q_calc, max(q - width, 0.0), q + width, moments)
+    if q < width:
+        folded = _linear_weights(q_calc, 0.0, width - q, moments)
+        cols, weights = np.concatenate((cols, folded[0])), np.concatenate((weights, folded[1]))
+    return cols, weights
+
+
+def slit_matrix(q_calc, q, slit_length, slit_width):
+    """
+    Sparse slit weights W of shape (len(q), len(q_calc)) for the integrals
+    of sasmodels.resolution.slit_resolution, with I(q) linear between the
+    points of *q_calc*.  Each point needs a nonzero slit length or width.
+    """
+    rows, cols, weights = [], [], []
+    for i, (qi, length, width) in enumerate(zip(q, slit_length, slit_width)):
+        if width == 0.0:
+            c, w = _length_weights(q_calc, qi, length)
+        elif length == 0.0:
+            c, w = _width_weights(q_calc, qi, width)
+        else:
+            parts = [_length_weights(q_calc, qi + k*width/SLIT_WIDTH_STEPS, length)
+                     for k in range(-SLIT_WIDTH_STEPS, SLIT_WIDTH_STEPS + 1)]
+            c = np.concatenate([part[0] for part in parts])
+            w = np.concatenate([part[1] for part in parts])/(2*SLIT_WIDTH_STEPS + 1)
+        rows.append(np.full(len(c), i))
+        cols.append(c)
+        weights.append(w)
+    return csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(len(q), len(q_calc)))
+
+
+def _with_exact(q_calc, q, exact, matrix):
+    # Add the points q[exact] to q_calc, with weight one at their own q, and
+    # the other rows from matrix(q_calc, broad), the indices of the others.
+    q_calc = np.union1d(q_calc, q[exact])
+    broad = np.flatnonzero(~exact)
+    W = matrix(q_calc, broad).tocoo()
+    rows = np.concatenate((broad[W.row], np.flatnonzero(exact)))
+    cols = np.concatenate((W.col, np.searchsorted(q_calc, q[exact])))
+    weights = np.concatenate((W.data, np.ones(exact.sum())))
+    return q_calc, csr_matrix((weights, (rows, cols)), shape=(len(q), len(q_calc)))
+
+
+class Smearing(object):
+    """
+    Resolution smearing operator for one dataset.
+
+    :param q:              Data q values, increasing
+    :param dq:             Pinhole 1-sigma resolution at each q
+    :param slit_length:    Slit length (dxl) for slit data
+    :param slit_width:     Slit width (dxw) for slit data
+    :param density:        Grid points per sigma (pinhole) or per data
+                           spacing (slit)
+
+    *q_calc* holds the points at which to evaluate the model and *matrix* the
+    sparse weights.  Points with dQ at most MINIMUM_RESOLUTION of
+    sasmodels.resolution, or with no slit length or width, are not smeared.
+    """
+    def __init__(self, q, dq=None, slit_length=None, slit_width=None, density=None):
+        q = np.asarray(q, dtype=float)
+        density = points_per_width() if density is None else density
+        cutoff = resolution.MINIMUM_ABSOLUTE_Q*q.min()
+        self.q = q
+        if dq is not None:
+            dq = np.broadcast_to(np.asarray(dq, dtype=float), q.shape)
+            exact = dq <= resolution.MINIMUM_RESOLUTION
+            q_calc = np.zeros(0)
+            if not exact.all():
+                nsigma_low, nsigma_high = resolution.PINHOLE_N_SIGMA
+                qb, dqb = q[~exact], dq[~exact]
+                lower = max(np.min(qb - nsigma_low*dqb), cutoff)
+                upper = np.max(qb + nsigma_high*dqb)
+                q_calc = calc_grid(lower, upper, qb, dqb/density)
+            self.q_calc, self.matrix = _with_exact(
+                q_calc, q, exact, lambda x, rows: pinhole_matrix(x, q[rows], dq[rows]))
+        elif slit_length is not None or slit_width is not None:
+            length = np.broadcast_to(np.asarray(0.0 if slit_length is None else slit_length,
+                                                dtype=float), q.shape)
+            width = np.broadcast_to(np.asarray(0.0 if slit_width is None else slit_width,
+                                               dtype=float), q.shape)
+            exact = (length == 0.0) & (width == 0.0)
+            q_calc = np.zeros(0)
+            if not exact.all():
+                spacing = np.gradient(q) if len(q) > 1 else q
+                lower = max(np.min(q - width), cutoff)
+                upper = np.max(np.sqrt((q + width)**2 + length**2))
+                q_calc = calc_grid(lower, upper, q, spacing/density)
+            self.q_calc, self.matrix = _with_exact(
+                q_calc, q, exact,
+                lambda x, rows: slit_matrix(x, q[rows], length[rows], width[rows]))
+        else:
+            raise ValueError("need dq for pinhole or slit_length/slit_width for slit smearing")
+
+    def apply(self, Iq_calc):
+        """
+        Smeared intensity from the model evaluated on *q_calc*.  Extra
+        leading dimensions of *Iq_calc* are kept, e.g. for Iq_batch.
+        """
+        Iq_calc = np.asarray(Iq_calc)
+        if Iq_calc.ndim == 1:
+            return self.matrix.dot(Iq_calc)
+        return self.matrix.dot(Iq_calc.reshape(-1, Iq_calc.shape[-1]).T).T.reshape(
+            Iq_calc.shape[:-1] + self.q.shape)
+
+    def evaluate(self, Iq):
+        """
+        Smeared intensity from the function *Iq(q)*.
+        """
+        return self.apply(Iq(self.q_calc))
+
+
+def _key(*arrays):
+    return tuple(None if a is None else np.asarray(a, dtype=float).tobytes() for a in arrays)
+
+
+def smearing(q, dq=None, slit_length=None, slit_width=None, density=None,
+             accuracy=DEFAULT_ACCURACY, Iq=None):
+    """
+    Cached :class:`Smearing` for the dataset.  *density* defaults to
+    :func:`points_per_width` of *accuracy* for pinhole data, and to
+    :func:`choose_density` for the model function *Iq*, which is then
+    required, for slit data.  Choosing it evaluates *Iq* on several grids,
+    so pass the chosen *density* when smearing the same data repeatedly.
+    """
+    if density is None:
+        if dq is not None:
+            density = points_per_width(accuracy)
+        elif Iq is None:
+            raise ValueError("need density, or Iq to choose it, for slit smearing")
+        else:
+            density = choose_density(Iq, q, dq, slit_length, slit_width, accuracy)
+    key = _key(q, dq, slit_length, slit_width) + (density,)
+    result = _CACHE.get(key)
+    if result is None:
+        result = Smearing(q, dq, slit_length, slit_width, density)
+        _CACHE[key] = result
+        if len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    else:
+        _CACHE.move_to_end(key)
+    return result
+
+
+def clear_cache():
+    """
+    Drop every cached smearing operator.
+    """
+    _CACHE.clear()
+
+
+def choose_density(Iq, q, dq=None, slit_length=None, slit_width=None,
+                   accuracy=DEFAULT_ACCURACY):
+    """
+    Smallest grid density, doubling from 1, at which the smeared *Iq*
+    changes by less than *accuracy* (relative) when the density is doubled.
+    """
+    density = 1
+    previous = smearing(q, dq, slit_length, slit_width, density).evaluate(Iq)
+    while density < MAX_DENSITY:
+        current = smearing(q, dq, slit_length, slit_width, 2*density).evaluate(Iq)
+        if np.max(np.abs(previous - current)/np.abs(current)) < accuracy:
+            break
+        density, previous = 2*density, current
+    return density
+
+
+class SmearedKernel(object):
+    """
+    Evaluate a compiled sasmodels model with resolution smearing.
+
+    :param model:          Result of sasmodels.core.build_model
+    :param smearing:       :class:`Smearing` operator for the data
+
+    Call with a parameter dictionary to get the smeared I(q).  Call
+    :meth:`release` when done to free the kernel.
+    """
+    def __init__(self, model, smearing):
+        self.model = model
+        self.smearing = smearing
+        self.kernel = model.make_kernel([smearing.q_calc])
+
+    def __call__(self, pars):
+        return self.smearing.apply(call_kernel(self.kernel, pars))
+
+    def release(self):
+        """
+        Free the compiled kernel.
+        """
+        self.kernel.release()
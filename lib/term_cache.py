@@ -0,0 +1,147 @@
+r"""
+Dependency-aware term caching
+-----------------------------
+
+Fits and polydispersity loops call a model many times while changing one or
+two parameters.  The expensive parts of the core-chain models are a few
+intermediate terms, and each depends on only some of the parameters: the
+core amplitudes on the radii, each chain's $F(U)$ and $P(U)$ on its $R_g$
+and $\nu$, and so on.  Recombining them into $I(q)$ is cheap.
+
+Models that support caching list their intermediates in ``Iq_terms`` as
+``(name, parameter names, function)`` entries, where the function is called
+as ``function(q, *values)`` with the values of the named parameters.  Their
+``Iq_cache()`` returns a :class:`TermCache`, which evaluates $I(q)$ like
+``Iq_batch`` for scalar parameters but memoizes each term by q vector and
+parameter values.  A call recomputes only the terms whose parameters
+changed::
+
+    cache = ccc.Iq_cache()
+    for radius in np.linspace(60, 90, 31):
+        Iq = cache(q, radius=radius)      # chain terms computed once
+    print(cache.hits, cache.misses)
+
+:meth:`TermCache.dispersion` averages over a mesh of parameter values in
+the same way, so for radius polydispersity the chain terms are computed
+once instead of once per radius point.
+
+The cache keeps at most *maxsize* terms in least recently used order, and
+at most *MAX_Q* distinct q vectors; q vectors are compared by value.
+Memory is about *maxsize* times a few arrays of the length of q.
+"""
+
+from collections import OrderedDict
+from os.path import dirname, join as joinpath
+
+import numpy as np
+from sasmodels.custom import load_custom_kernel_module
+
+batch = load_custom_kernel_module(joinpath(dirname(__file__), "batch.py"))
+
+#: Default number of cached terms.
+DEFAULT_MAXSIZE = 64
+
+#: Number of distinct q vectors kept.
+MAX_Q = 4
+
+
+def evaluate(terms, q, pars):
+    """
+    Evaluate every term of *terms* directly, returning {name: value}.
+    """
+    return dict((name, function(q, *[pars[p] for p in depends]))
+                for name, depends, function in terms)
+
+
+class TermCache(object):
+    """
+    Memoized evaluation of a model from its intermediate terms.
+
+    :param terms:          The model's Iq_terms
+    :param kernel:         Function kernel(q, terms=terms, **pars) returning Iq,
+                           with *terms* the {name: value} of the terms
+    :param parameters:     Model parameter table, used for defaults
+    :param maxsize:        Largest number of cached terms
+
+    *hits* and *misses* count term lookups.
+    """
+    def __init__(self, terms, kernel, parameters, maxsize=DEFAULT_MAXSIZE):
+        self.terms = terms
+        self.kernel = kernel
+        self.parameters = parameters
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._cache = OrderedDict()
+        self._q = OrderedDict()
+        self._next_q = 0
+
+    def __call__(self, q, **pars):
+        """
+        scale*Iq + background at scalar parameter values *pars*.
+        """
+        q, kernel_pars = batch.arguments(self.parameters, q, pars)
+        if any(np.size(value) != 1 for value in kernel_pars.values()):
+            raise TypeError("TermCache takes scalar parameters; use Iq_batch for arrays")
+        values = dict((name, value.item()) for name, value in kernel_pars.items())
+        scale = values.pop("scale")
+        background = values.pop("background")
+        terms = self._terms(self._q_key(q), q, values)
+        return scale * self.kernel(q, terms=terms, **values) + background
+
+    def dispersion(self, q, pd, **pars):
+        """
+        Weighted average of I(q) over a mesh of parameter values.
+
+        :param pd:             {name: (values, weights)} for the dispersed parameters
+        :return:               scale*<Iq> + background
+        """
+        names = list(pd)
+        mesh = np.meshgrid(*[np.asarray(pd[name][0], dtype=float) for name in names], indexing="ij")
+        weights = np.prod(np.meshgrid(*[np.asarray(pd[name][1], dtype=float) for name in names],
+                                      indexing="ij"), axis=0).ravel()
+        fixed = dict(pars, scale=1.0, background=0.0)
+        total = 0.0
+        for point, weight in zip(zip(*[values.ravel() for values in mesh]), weights):
+            if weight:
+                total = total + weight * self(q, **dict(fixed, **dict(zip(names, point))))
+        defaults = batch.COMMON_DEFAULTS
+        return (pars.get("scale", defaults["scale"]) * total / weights.sum()
+                + pars.get("background", defaults["background"]))
+
+    def clear(self):
+        """
+        Drop every cached term and q vector.
+        """
+        self._cache.clear()
+        self._q.clear()
+
+    def _q_key(self, q):
+        for key, known in self._q.items():
+            if known.shape == q.shape and np.array_equal(known, q):
+                self._q.move_to_end(key)
+                return key
+        if len(self._q) >= MAX_Q:
+            old, _ = self._q.popitem(last=False)
+            for entry in [entry for entry in self._cache if entry[0] == old]:
+                del self._cache[entry]
+        key, self._next_q = self._next_q, self._next_q + 1
+        self._q[key] = q.copy()
+        return key
+
+    def _terms(self, q_key, q, pars):
+        result = {}
+        for name, depends, function in self.terms:
+            args = tuple(pars[p] for p in depends)
+            key = (q_key, name, args)
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                value = function(q, *args)
+                self._cache[key] = value
+                if len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+            else:
+                self.hits += 1
+                self._cache.move_to_end(key)
+            result[name] = value
+        return result
@@ -0,0 +1,131 @@
+"""
+Compiled kernels against the NumPy Iq_batch of each model, and against each
+NumPy path derived from Iq_basis, over random() parameter sets.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from sasmodels.core import load_model_info, build_model
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.direct_model import call_kernel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODELS = [
+    "Core-Chain-Chain/ccc.py",
+    "FuzzyCore-Chain-Chain/f_ccc.py",
+    "Core-DiblockChain/cdbc.py",
+    "Empirical_CCC/e_ccc.py",
+    "Core-Chain/core_chain.py",
+    "Core-Shell-Chain/csc.py",
+    "Protein-Polymer/protein_polymer.py",
+    "Chain_ExcludedVolume_RPA/chain_excl_vol_rpa.py",
+    "Triblock_StarPolymer/triblock_star.py",
+    "Multiblock_StarPolymer/multiblock_star.py",
+]
+
+#: NumPy paths of the models built on Iq_basis, besides Iq_batch.
+PATHS = {
+    "Core-Chain-Chain/ccc.py": ("numpy", "cache", "grad"),
+    "FuzzyCore-Chain-Chain/f_ccc.py": ("numpy", "cache", "grad"),
+    "Core-DiblockChain/cdbc.py": ("numpy", "cache", "grad"),
+    "Core-Chain/core_chain.py": ("numpy", "fused", "cache", "grad"),
+    "Core-Shell-Chain/csc.py": ("numpy", "fused"),
+}
+
+#: Parameter sets per model and case.
+SETS = 8
+
+Q = np.logspace(-3, 0, 60)
+
+_cache = {}
+
+
+def _model(path):
+    if path not in _cache:
+        filename = os.path.join(ROOT, path)
+        info = load_model_info(filename)
+        _cache[path] = (info, build_model(info, platform="dll"),
+                        load_custom_kernel_module(filename))
+    return _cache[path]
+
+
+def _parameter_sets(info, module, case, seed):
+    names = set(p.name for p in info.parameters.kernel_parameters)
+    if case == "pdi" and "pdi" not in names:
+        pytest.skip("no chain dispersity")
+    if case == "poisson" and "ng_dist" not in names:
+        pytest.skip("no chain count distribution")
+    random = np.random.RandomState(seed)
+    np.random.seed(seed)
+    for _ in range(SETS):
+        pars = dict(module.random(), background=0.0)
+        if case == "pdi":
+            pars.update(pdi=random.uniform(1.05, 2.0), pdi_dist=random.randint(2))
+        elif case == "poisson":
+            pars.update(ng_dist=1)
+        yield pars
+
+
+def _compiled(model, pars):
+    kernel = model.make_kernel([Q])
+    try:
+        return call_kernel(kernel, pars)
+    finally:
+        kernel.release()
+
+
+@pytest.mark.parametrize("case", ["random", "pdi", "poisson"])
+@pytest.mark.parametrize("path", MODELS)
+def test_kernel_matches_numpy(path, case):
+    info, model, module = _model(path)
+    for pars in _parameter_sets(info, module, case, seed=MODELS.index(path)):
+        compiled = _compiled(model, pars)
+        reference = np.asarray(module.Iq_batch(Q, **pars)).ravel()
+        atol = 1e-12 * np.max(abs(reference))
+        assert np.allclose(compiled, reference, rtol=1e-10, atol=atol), pars
+
+
+@pytest.mark.parametrize("name", ["numpy", "fused", "cache", "grad"])
+@pytest.mark.parametrize("path", list(PATHS))
+def test_path_matches_kernel(path, name):
+    if name not in PATHS[path]:
+        pytest.skip("no %s path" % name)
+    info, model, module = _model(path)
+    defaults = dict((p[0], p[2]) for p in module.parameters)
+    cache = module.Iq_cache() if name == "cache" else None
+    for pars in _parameter_sets(info, module, "random", seed=MODELS.index(path)):
+        compiled = _compiled(model, pars)
+        atol = 1e-12 * np.max(abs(compiled))
+        kernel_pars = dict(defaults, **dict((k, v) for k, v in pars.items() if k in defaults))
+        if name == "numpy":
+            Iq = module.Iq_numpy(Q, **kernel_pars)
+        elif name == "fused":
+            Iq = module.Iq_fused(Q, chunk_size=7, **kernel_pars)
+        elif name == "cache":
+            Iq = cache(Q, **pars)
+            # Only the core terms change with the radius.
+            moved = dict(pars, radius=1.1*pars["radius"])
+            assert np.allclose(cache(Q, **moved), _compiled(model, moved), rtol=1e-10, atol=atol), moved
+        else:
+            Iq, jac = module.Iq_grad(Q, **pars)
+            _check_gradient(model, pars, jac, atol)
+        assert np.allclose(Iq, compiled, rtol=1e-10, atol=atol), pars
+    if cache is not None:
+        assert cache.hits > 0
+
+
+def _check_gradient(model, pars, jac, atol):
+    # Central differences of the compiled kernel, with step h = 1e-5 max(|p|, 1).
+    for par, derivative in jac.items():
+        if par in ("scale", "background"):
+            continue
+        value = pars.get(par, model.info.parameters[par].default)
+        h = 1e-5 * max(abs(value), 1.0)
+        upper = _compiled(model, dict(pars, **{par: value + h}))
+        lower = _compiled(model, dict(pars, **{par: value - h}))
+        difference = 0.5 * (upper - lower)
+        assert np.allclose(derivative * h, difference, rtol=1e-6, atol=1e-2*atol), par
@@ -0,0 +1,37 @@
+"""
+Model registry manifest and cache (tools/registry.py).
+"""
+
+import os
+import shutil
+
+import pytest
+
+from sasmodels.core import load_model_info
+from sasmodels.custom import load_custom_kernel_module
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+registry = load_custom_kernel_module(os.path.join(ROOT, "tools", "registry.py"))
+
+
+@pytest.mark.parametrize("entry", registry.manifest(), ids=lambda entry: entry["name"])
+def test_manifest_names_match_models(entry):
+    info = load_model_info(os.path.join(ROOT, entry["path"]))
+    assert info.id == info.name == entry["name"]
+
+
+def test_records_of_same_named_files_are_kept_apart(tmp_path):
+    paths = []
+    for directory in ("a", "b"):
+        for folder in ("Core-Chain", "lib"):
+            shutil.copytree(os.path.join(ROOT, folder), str(tmp_path / directory / folder))
+        paths.append(str(tmp_path / directory / "Core-Chain" / "core_chain.py"))
+    cache = registry.Registry(cache_dir=str(tmp_path / "cache"))
+    records = [cache.record(path) for path in paths]
+    assert [record["path"] for record in records] == paths
+
+    fresh = registry.Registry(cache_dir=str(tmp_path / "cache"))
+    assert [fresh.record(path)["path"] for path in paths] == paths
+    assert len([name for name in os.listdir(str(tmp_path / "cache"))
+                if name.endswith(".json")]) == 2
@@ -0,0 +1,68 @@
+"""
+Smearing operators against sasmodels.resolution on a converged grid
+(lib/smearing.py).
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from sasmodels import resolution
+from sasmodels.custom import load_custom_kernel_module
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+smearing = load_custom_kernel_module(os.path.join(ROOT, "lib", "smearing.py"))
+core_chain = load_custom_kernel_module(os.path.join(ROOT, "Core-Chain", "core_chain.py"))
+
+Q = np.logspace(-3, -1, 60)
+
+
+def Iq(q):
+    return core_chain.Iq_batch(q, radius=60.0)
+
+
+def fine_grid(lower, upper, n=200000):
+    return np.logspace(np.log10(lower), np.log10(upper), n)
+
+
+@pytest.mark.parametrize("dq_over_q, accuracy", [(0.02, 1e-3), (0.1, 1e-3), (0.1, 1e-4)])
+def test_pinhole_matches_sasmodels(dq_over_q, accuracy):
+    dq = dq_over_q*Q
+    q_calc = fine_grid(resolution.MINIMUM_ABSOLUTE_Q*Q[0], 1.5*Q[-1])
+    expected = resolution.Pinhole1D(Q, dq, q_calc=q_calc).apply(Iq(q_calc))
+    actual = smearing.smearing(Q, dq=dq, accuracy=accuracy).evaluate(Iq)
+    assert np.max(np.abs(actual/expected - 1)) < accuracy
+
+
+@pytest.mark.parametrize("slit_length, slit_width", [(0.005, 0.0), (0.05, 0.0), (0.05, 0.002)])
+def test_slit_matches_sasmodels(slit_length, slit_width):
+    accuracy = 1e-3
+    q_calc = fine_grid(resolution.MINIMUM_ABSOLUTE_Q*Q[0],
+                       1.01*np.sqrt((Q[-1] + slit_width)**2 + slit_length**2))
+    expected = resolution.Slit1D(Q, slit_length, slit_width, q_calc=q_calc).apply(Iq(q_calc))
+    actual = smearing.smearing(Q, slit_length=slit_length, slit_width=slit_width,
+                               accuracy=accuracy, Iq=Iq).evaluate(Iq)
+    assert np.max(np.abs(actual/expected - 1)) < accuracy
+
+
+def test_slit_width_is_exact_for_linear_Iq():
+    # Slit1D converges too slowly in the width to check it to 1e-3, but
+    # the linear interpolant of a linear I(q) is exact.
+    q = np.linspace(0.01, 0.1, 20)
+    res = smearing.Smearing(q, slit_width=0.005, density=1)
+    assert np.allclose(res.evaluate(lambda x: 1.0 + 10.0*x), 1.0 + 10.0*q, rtol=1e-12, atol=0)
+
+
+def test_zero_dq_is_not_smeared():
+    dq = 0.05*Q
+    dq[::7] = 0.0
+    res = smearing.Smearing(Q, dq=dq)
+    assert len(res.q_calc) < 10*smearing.points_per_width()*len(Q)
+    assert np.array_equal(res.evaluate(Iq)[::7], Iq(Q[::7]))
+
+
+def test_slit_needs_density_or_model():
+    with pytest.raises(ValueError):
+        smearing.smearing(Q, slit_length=0.05)
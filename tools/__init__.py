@@ -0,0 +1,5 @@
+"""
+Developer tools for the polymer models.
+
+Run from the repository root, e.g. ``python -m tools.benchmark``.
+"""
@@ -0,0 +1,301 @@
+r"""
+Benchmark the models
+--------------------
+
+Times every model over a range of q lengths, with and without polydispersity
+in its size parameters, on each backend:
+
+* ``python``: the NumPy ``Iq_batch`` of the model (see lib/batch.py), with
+  polydispersity evaluated as one batch over the dispersion mesh;
+* ``dll``: the compiled C kernel through sasmodels;
+* ``opencl``: the C kernel on the default OpenCL device, if one is available.
+
+For each case the benchmark reports the best wall time, I(q) evaluations per
+second (q points times dispersion points, divided by time) and the peak
+memory allocated while evaluating.  It also evaluates each model once at
+``random()`` parameters, so broken models and samplers show up as failures.
+
+Results can be saved as a JSON baseline and compared with later runs::
+
+    python -m tools.benchmark --save baseline.json
+    python -m tools.benchmark --compare baseline.json
+
+With ``--compare``, the exit status is nonzero if any case is slower than the
+baseline by more than ``--tolerance``, or fails when it used to pass.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+from sasmodels import kernelcl
+from sasmodels.core import load_model_info, build_model
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.direct_model import call_kernel
+from sasmodels.weights import get_weights
+
+from tools import registry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Model definition files of models.json, relative to the repository root.
+MODELS = [entry["path"] for entry in registry.manifest()]
+
+Q_SIZES = [100, 1000, 10000, 100000, 1000000]
+BACKENDS = ["python", "dll", "opencl"]
+
+#: Candidate size parameters for the polydisperse cases, in order of
+#: preference: one core radius and one chain radius of gyration.
+PD_CANDIDATES = [("radius", "R"), ("rg", "rg1")]
+PD_WIDTH = 0.1
+PD_N = 15
+PD_NSIGMAS = 3.0
+
+#: Largest number of (dispersion point, q) values evaluated at once by the
+#: python backend.
+CHUNK_SIZE = 1 << 21
+
+
+def pd_parameters(info):
+    """
+    Polydisperse size parameters of the model: up to one core radius and
+    one chain radius of gyration.
+    """
+    volume = [p.name for p in info.parameters.kernel_parameters if p.type == "volume"]
+    found = []
+    for candidates in PD_CANDIDATES:
+        for name in candidates:
+            if name in volume:
+                found.append(name)
+                break
+    return found
+
+
+def python_iq(module, q, pars, pd):
+    """
+    Evaluate Iq_batch with *pd* = {name: (values, weights)} averaged over
+    the dispersion mesh.
+    """
+    if not pd:
+        return module.Iq_batch(q, **pars)
+    names = list(pd)
+    values = np.meshgrid(*[pd[k][0] for k in names], indexing="ij")
+    weights = np.prod(np.meshgrid(*[pd[k][1] for k in names], indexing="ij"), axis=0)
+    values = [v.ravel() for v in values]
+    weights = weights.ravel()
+
+    step = max(1, CHUNK_SIZE // len(q))
+    total = np.zeros(len(q))
+    for start in range(0, len(weights), step):
+        stop = start + step
+        chunk = dict(pars, background=0.0, scale=1.0)
+        chunk.update((k, v[start:stop]) for k, v in zip(names, values))
+        total += np.dot(weights[start:stop], module.Iq_batch(q, **chunk))
+    return pars.get("scale", 1.0) * total / weights.sum() + pars.get("background", 0.001)
+
+
+class Case(object):
+    """
+    One model on one backend: holds the loaded kernel and runs evaluations.
+    """
+    def __init__(self, path, backend):
+        self.path = path
+        self.backend = backend
+        self.info = load_model_info(os.path.join(ROOT, path))
+        self.module = load_custom_kernel_module(os.path.join(ROOT, path))
+        self.model = None
+        if backend == "opencl":
+            if not kernelcl.use_opencl():
+                raise RuntimeError("OpenCL is not available")
+            self.model = build_model(self.info, platform="ocl")
+        elif backend == "dll":
+            self.model = build_model(self.info, platform="dll")
+
+    def pd_pars(self, pd):
+        """
+        Dispersion parameters for the compiled kernel, or weight vectors
+        for the python backend.
+        """
+        if not pd:
+            return {}
+        if self.model is not None:
+            pars = {}
+            for name in pd:
+                pars.update({name + "_pd": PD_WIDTH, name + "_pd_n": PD_N,
+                             name + "_pd_nsigma": PD_NSIGMAS})
+            return pars
+        table = self.info.parameters.kernel_parameters
+        limits = dict((p.name, p.limits) for p in table)
+        defaults = dict((p.name, p.default) for p in table)
+        return dict((name, get_weights("gaussian", PD_N, PD_WIDTH, PD_NSIGMAS,
+                                       defaults[name], limits[name], True))
+                    for name in pd)
+
+    def runner(self, q, pars, pd):
+        """
+        Return a function evaluating I(q) once.
+        """
+        pd_pars = self.pd_pars(pd)
+        if self.model is None:
+            return lambda: python_iq(self.module, q, pars, pd_pars)
+        kernel = self.model.make_kernel([q])
+        full = dict(pars, **pd_pars)
+        return lambda: call_kernel(kernel, full)
+
+
+def time_call(fn, min_time, repeat):
+    """
+    Best wall time of *fn* over at least *repeat* calls and *min_time* seconds.
+    """
+    best, total, count = np.inf, 0.0, 0
+    while count < repeat or total < min_time:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best, total, count = min(best, elapsed), total + elapsed, count + 1
+    return best
+
+
+def peak_memory(fn):
+    """
+    Peak bytes allocated through the Python allocator during one call of *fn*.
+    """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def check_random(path):
+    """
+    Evaluate the model once at random() parameters; return an error or None.
+    """
+    try:
+        module = load_custom_kernel_module(os.path.join(ROOT, path))
+        pars = module.random()
+        info = load_model_info(os.path.join(ROOT, path))
+        # Defaults include each element of vector parameters, e.g. N1, N2.
+        unknown = set(pars) - set(info.parameters.defaults)
+        if unknown:
+            return "random() returns unknown parameters: %s" % ", ".join(sorted(unknown))
+        q = np.logspace(-3, 0, 50)
+        Iq = Case(path, "dll").runner(q, pars, [])()
+        if not np.all(np.isfinite(Iq)):
+            return "non-finite I(q) at random() parameters"
+    except Exception as exc:
+        return "%s: %s" % (type(exc).__name__, exc)
+    return None
+
+
+def run(models, backends, q_sizes, min_time=0.2, repeat=1, memory=True, log=print):
+    """
+    Run the benchmark and return the list of result records.
+    """
+    results = []
+    for path in models:
+        error = check_random(path)
+        results.append(dict(model=path, backend="dll", case=path + "/random",
+                            status="ok" if error is None else "error", error=error))
+        log("%-48s random() %s" % (path, "ok" if error is None else "FAILED: " + error))
+        for backend in backends:
+            try:
+                case = Case(path, backend)
+            except Exception as exc:
+                log("%-48s %-7s unavailable: %s" % (path, backend, exc))
+                continue
+            pd = pd_parameters(case.info)
+            for nq in q_sizes:
+                q = np.logspace(-3, 0, nq)
+                for dispersed in (False, True):
+                    if dispersed and not pd:
+                        continue
+                    record = dict(model=path, backend=backend, nq=nq,
+                                  pd=pd if dispersed else [])
+                    record["case"] = "%s/%s/nq=%d%s" % (
+                        path, backend, nq, "/pd=" + ",".join(pd) if dispersed else "")
+                    try:
+                        fn = case.runner(q, {}, pd if dispersed else [])
+                        seconds = time_call(fn, min_time, repeat)
+                        points = nq * PD_N**len(record["pd"])
+                        record.update(status="ok", seconds=seconds,
+                                      evals_per_second=points/seconds)
+                        if memory:
+                            record["peak_bytes"] = peak_memory(fn)
+                        log("%-72s %10.4g s %12.4g eval/s %9s" % (
+                            record["case"], seconds, points/seconds,
+                            "%.1f MB" % (record["peak_bytes"]/1e6) if memory else ""))
+                    except Exception as exc:
+                        record.update(status="error", error="%s: %s" % (type(exc).__name__, exc))
+                        log("%-72s FAILED: %s" % (record["case"], record["error"]))
+                    results.append(record)
+    return results
+
+
+def compare(results, baseline, tolerance, log=print):
+    """
+    Compare *results* with *baseline* records; return the number of
+    regressions.
+    """
+    old = dict((r["case"], r) for r in baseline)
+    regressions = 0
+    for record in results:
+        ref = old.get(record["case"])
+        if ref is None:
+            continue
+        if record["status"] != "ok":
+            if ref["status"] == "ok":
+                regressions += 1
+                log("REGRESSION %s now fails: %s" % (record["case"], record["error"]))
+            continue
+        if ref["status"] != "ok" or "seconds" not in record:
+            continue
+        ratio = record["seconds"] / ref["seconds"]
+        flag = ratio > 1.0 + tolerance
+        regressions += flag
+        log("%-10s %-72s %6.2fx" % ("REGRESSION" if flag else "", record["case"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=MODELS,
+                        help="model files relative to the repository root")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--q-sizes", nargs="+", type=int, default=Q_SIZES)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum seconds spent timing each case")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="minimum number of timed calls per case")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory measurement")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fractional slowdown before a case regresses")
+    opts = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    results = run(opts.models, opts.backends, opts.q_sizes,
+                  min_time=opts.min_time, repeat=opts.repeat, memory=not opts.no_memory)
+    if opts.save:
+        with open(opts.save, "w") as fid:
+            json.dump(dict(numpy=np.__version__, python=sys.version.split()[0],
+                           results=results), fid, indent=1)
+    if opts.compare:
+        with open(opts.compare) as fid:
+            baseline = json.load(fid)["results"]
+        return 1 if compare(results, baseline, opts.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
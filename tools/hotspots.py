@@ -0,0 +1,87 @@
+r"""
+Profile a model's hot path
+--------------------------
+
+Evaluates a model's NumPy kernel with the instrumentation of
+lib/instrument.py and prints where the time goes: each special function
+and each intermediate term, with call counts, values computed and time,
+and the time per dispersion point::
+
+    python -m tools.hotspots Core-Chain-Chain/ccc.py --set radius=80 \
+        --pd radius=0.1 rg1=0.2 --q-size 1000 --save ccc_profile.json
+
+Dispersion is Gaussian with the given relative width, with ``--pd-n``
+points over +/- 3 sigma, as in tools/benchmark.py.  ``--save`` writes the
+report as JSON.
+"""
+
+import argparse
+import os
+import sys
+import warnings
+
+import numpy as np
+
+from sasmodels.core import load_model_info
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.weights import get_weights
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+instrument = load_custom_kernel_module(os.path.join(ROOT, "lib", "instrument.py"))
+
+
+def profile(path, q, pars=None, pd=None, pd_n=15, repeat=1):
+    """
+    Profile of the model at *path* evaluated *repeat* times at *pars*, with
+    *pd* = {name: relative width} of Gaussian dispersion.
+    """
+    info = load_model_info(os.path.join(ROOT, path))
+    module = load_custom_kernel_module(os.path.join(ROOT, path))
+    pars = dict(pars or {})
+    defaults = info.parameters.defaults
+    limits = dict((p.name, p.limits) for p in info.parameters.kernel_parameters)
+    mesh = dict((name, get_weights("gaussian", pd_n, width, 3.0,
+                                   pars.get(name, defaults[name]), limits[name], True))
+                for name, width in (pd or {}).items())
+    result = instrument.Profile()
+    for _ in range(repeat):
+        result.evaluate(module, q, pars, mesh)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="model file relative to the repository root")
+    parser.add_argument("--set", nargs="+", default=[], metavar="NAME=VALUE",
+                        help="parameter values")
+    parser.add_argument("--pd", nargs="+", default=[], metavar="NAME=WIDTH",
+                        help="relative width of Gaussian dispersion in a parameter")
+    parser.add_argument("--pd-n", type=int, default=15, help="dispersion points per parameter")
+    parser.add_argument("--q-size", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=1, help="number of evaluations")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    opts = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    split = lambda items: dict((k, float(v)) for k, v in (item.split("=", 1) for item in items))
+    q = np.logspace(-3, 0, opts.q_size)
+    result = profile(opts.model, q, split(opts.set), split(opts.pd), opts.pd_n, opts.repeat)
+    report = result.report()
+    print("%d points in %.4g s" % (len(report["points"]), report["seconds"]))
+    for title in ("terms", "special"):
+        entries = sorted(report[title].items(), key=lambda item: -item[1]["seconds"])
+        for name, entry in entries:
+            print("%-8s %-14s %8d calls %12d values %10.4g s %6.1f%%"
+                  % (title, name, entry["calls"], entry["values"], entry["seconds"],
+                     100.0*(entry["fraction"] or 0.0)))
+    seconds = np.array([point["seconds"] for point in report["points"]])
+    print("per point: min %.4g s, mean %.4g s, max %.4g s" % (seconds.min(), seconds.mean(), seconds.max()))
+    if opts.save:
+        result.save(opts.save)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
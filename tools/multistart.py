@@ -0,0 +1,280 @@
+r"""
+Multi-start fitting
+-------------------
+
+The core-chain-chain models have many local minima in chi^2, so a single
+local fit depends on where it starts.  This tool runs many local fits from
+starting points drawn with the model's ``random()`` sampler, in a process
+pool, and returns the solutions ranked by chi^2::
+
+    python -m tools.multistart Core-Chain-Chain/ccc.py data.txt \
+        --fit radius rg1 rg2 nu1 scale --starts 64 --workers 16
+
+The data file has columns q, I(q) and optionally dI(q).  From Python::
+
+    from tools import multistart
+    solutions = multistart.fit("Core-Chain-Chain/ccc.py", q, Iq, dIq,
+                               ["radius", "rg1", "rg2", "nu1", "scale"], starts=64)
+    best = solutions[0]["pars"]
+
+Each worker builds the compiled model once, from the cache of
+tools/registry.py, so it neither imports the model nor compiles it.  The q,
+I(q) and dI(q) arrays are placed in shared memory, so they are not copied to
+each task.  Starting values for the fitted parameters come from ``random()``
+and are clipped into the fitting bounds.  Parameters that ``random()`` does
+not sample start from their given or default values.  Each local fit is a
+bounded scipy.optimize.least_squares fit.
+
+The workers share the lowest chi^2 seen so far.  After *min_nfev* model
+evaluations, a fit is stopped early if its best chi^2 is still more than
+*dominance* times the shared best, since it cannot lead to a competitive
+solution.  Stopped fits are returned with status "dominated".  Because the
+shared best depends on timing, whether a fit is stopped is not exactly
+reproducible.  The converged solutions are reproducible for a given *seed*.
+"""
+
+import argparse
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Value
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from scipy.optimize import least_squares
+
+from sasmodels.core import load_model_info
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.direct_model import call_kernel
+
+from tools import registry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_STARTS = 32
+
+#: Stop a fit whose chi^2 is this many times the best chi^2 found so far.
+DOMINANCE = 10.0
+
+#: Number of model evaluations before a fit can be stopped as dominated.
+MIN_NFEV = 30
+
+#: Relative distance in the fitted parameters below which two solutions are
+#: counted as the same minimum.
+RTOL = 1e-3
+
+#: Limits of the parameters common to all models.
+COMMON_LIMITS = dict(scale=(0.0, np.inf), background=(-np.inf, np.inf))
+
+# Per-process state, set by _init_worker.
+_STATE = {}
+
+
+class _Dominated(Exception):
+    pass
+
+
+def parameter_limits(info):
+    """
+    Fitting bounds of each kernel parameter, plus scale and background.
+    """
+    limits = dict(COMMON_LIMITS)
+    for p in info.parameters.kernel_parameters:
+        limits[p.name] = tuple(float(v) for v in p.limits) if len(p.limits) == 2 else (-np.inf, np.inf)
+    return limits
+
+
+def starting_points(module, names, lower, upper, base, starts, seed=None, guesses=()):
+    """
+    *starts* starting vectors for the parameters *names*: first the
+    parameter dicts in *guesses*, then draws from the model's random()
+    sampler.  Parameters missing from a guess or sample come from *base*.
+    """
+    samples = list(guesses)[:starts]
+    if len(samples) < starts and not hasattr(module, "random"):
+        raise ValueError("model has no random() sampler")
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        samples += [module.random() for _ in range(starts - len(samples))]
+    finally:
+        np.random.set_state(state)
+    # Keep starts strictly inside the bounds; least_squares requires it.
+    span = np.where(np.isfinite(upper - lower), upper - lower, np.abs(lower) + 1.0)
+    low = np.where(np.isfinite(lower), lower + 1e-6*span, -np.inf)
+    high = np.where(np.isfinite(upper), upper - 1e-6*span, np.inf)
+    return [np.clip([float(sample.get(name, base[name])) for name in names], low, high)
+            for sample in samples]
+
+
+def _init_worker(path, shm_name, nq, names, base, best, dominance, min_nfev):
+    warnings.simplefilter("ignore")
+    shm = SharedMemory(name=shm_name)
+    data = np.ndarray((3, nq), dtype=float, buffer=shm.buf)
+    model = registry.build(path)
+    _STATE.update(shm=shm, data=data, kernel=model.make_kernel([data[0].copy()]),
+                  names=names, base=base, best=best, dominance=dominance, min_nfev=min_nfev)
+
+
+def _local_fit(task):
+    index, x0, lower, upper = task
+    state = _STATE
+    _, Iq, dIq = state["data"]
+    names, best = state["names"], state["best"]
+    dof = max(len(Iq) - len(names), 1)
+    trace = dict(nfev=0, chi2=np.inf, x=np.array(x0))
+
+    def residuals(x):
+        pars = dict(state["base"], **dict(zip(names, x)))
+        r = (call_kernel(state["kernel"], pars) - Iq) / dIq
+        r = np.nan_to_num(r, nan=1e10, posinf=1e10, neginf=-1e10)
+        chi2 = np.dot(r, r) / dof
+        trace["nfev"] += 1
+        if chi2 < trace["chi2"]:
+            trace.update(chi2=chi2, x=np.array(x))
+            with best.get_lock():
+                best.value = min(best.value, chi2)
+        if (trace["nfev"] >= state["min_nfev"]
+                and trace["chi2"] > state["dominance"] * best.value):
+            raise _Dominated()
+        return r
+
+    record = dict(index=index, start=dict(zip(names, x0)))
+    try:
+        result = least_squares(residuals, x0, bounds=(lower, upper), x_scale="jac")
+        record.update(status="converged" if result.success else "stopped",
+                      message=result.message)
+    except _Dominated:
+        record.update(status="dominated", message="chi2 %.4g > %g times best %.4g"
+                      % (trace["chi2"], state["dominance"], best.value))
+    except Exception as exc:
+        record.update(status="error", message="%s: %s" % (type(exc).__name__, exc))
+    record.update(chi2=float(trace["chi2"]), nfev=trace["nfev"],
+                  pars=dict(state["base"], **dict(zip(names, trace["x"].tolist()))))
+    return record
+
+
+def rank(solutions, names, rtol=RTOL):
+    """
+    Sort *solutions* by status and chi^2, and mark each with the number of
+    other fits that reached the same minimum ("count") or the index of the
+    better solution it duplicates ("duplicate_of").
+    """
+    order = {"converged": 0, "stopped": 1, "dominated": 2, "error": 3}
+    solutions = sorted(solutions, key=lambda s: (order[s["status"]], s["chi2"], s["index"]))
+    kept = []
+    for solution in solutions:
+        solution["count"] = 1
+        x = np.array([solution["pars"][name] for name in names])
+        for other in kept:
+            y = np.array([other["pars"][name] for name in names])
+            if (solution["status"] in ("converged", "stopped")
+                    and np.all(np.abs(x - y) <= rtol * np.maximum(np.abs(y), 1e-12))):
+                solution["duplicate_of"] = other["index"]
+                other["count"] += 1
+                break
+        else:
+            kept.append(solution)
+    return solutions
+
+
+def fit(path, q, Iq, dIq=None, names=(), pars=None, starts=DEFAULT_STARTS, workers=None,
+        seed=None, bounds=None, dominance=DOMINANCE, min_nfev=MIN_NFEV, guesses=(), log=None):
+    """
+    Run *starts* local fits of the model at *path* to the data in a process
+    pool and return the solutions ranked by chi^2.
+
+    :param path:           Model definition file
+    :param q, Iq, dIq:     Data; dIq defaults to ones
+    :param names:          Parameters to fit
+    :param pars:           Values of the other parameters, and defaults for starts
+    :param starts:         Number of local fits
+    :param workers:        Number of processes; default os.cpu_count()
+    :param seed:           Seed for the starting points
+    :param guesses:        Parameter dicts to use as the first starting points
+    :param bounds:         {name: (lower, upper)} overriding the parameter limits
+    :param dominance:      Stop fits worse than this factor times the best chi^2
+    :param min_nfev:       Evaluations before a fit can be stopped
+    :param log:            Function called with each solution as it finishes
+    :return:               Solution records with keys index, status, chi2, pars, start, nfev, count
+    """
+    path = os.path.join(ROOT, path)
+    info = load_model_info(path)
+    module = load_custom_kernel_module(path)
+    names = list(names)
+    if not names:
+        raise ValueError("no parameters to fit")
+    limits = parameter_limits(info)
+    limits.update(bounds or {})
+    unknown = [name for name in names if name not in limits]
+    if unknown:
+        raise ValueError("unknown parameters: %s" % ", ".join(unknown))
+    base = dict((p.name, p.default) for p in info.parameters.kernel_parameters)
+    base.update(scale=1.0, background=0.0)
+    base.update(pars or {})
+    lower = np.array([limits[name][0] for name in names], dtype=float)
+    upper = np.array([limits[name][1] for name in names], dtype=float)
+    x0 = starting_points(module, names, lower, upper, base, starts, seed, guesses)
+
+    q = np.asarray(q, dtype=float)
+    data = np.vstack((q, Iq, np.ones_like(q) if dIq is None else dIq)).astype(float)
+    shm = SharedMemory(create=True, size=data.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=float, buffer=shm.buf)[...] = data
+        best = Value("d", np.inf)
+        initargs = (path, shm.name, len(q), names, base, best, dominance, min_nfev)
+        tasks = [(k, x, lower, upper) for k, x in enumerate(x0)]
+        solutions = []
+        with ProcessPoolExecutor(min(workers or os.cpu_count() or 1, starts),
+                                 initializer=_init_worker, initargs=initargs) as pool:
+            for solution in pool.map(_local_fit, tasks):
+                solutions.append(solution)
+                if log is not None:
+                    log(solution)
+    finally:
+        shm.close()
+        shm.unlink()
+    return rank(solutions, names)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="model file relative to the repository root")
+    parser.add_argument("data", help="text file with columns q, I(q) and optionally dI(q)")
+    parser.add_argument("--fit", nargs="+", required=True, help="parameters to fit")
+    parser.add_argument("--set", nargs="+", default=[], metavar="NAME=VALUE",
+                        help="values of the other parameters")
+    parser.add_argument("--starts", type=int, default=DEFAULT_STARTS)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--surrogate", metavar="DIRECTORY",
+                        help="start the first quarter of the fits from the closest entries "
+                             "of this tools.surrogate table")
+    parser.add_argument("--dominance", type=float, default=DOMINANCE)
+    parser.add_argument("--top", type=int, default=5, help="number of solutions to print")
+    opts = parser.parse_args(argv)
+
+    data = np.loadtxt(opts.data, ndmin=2)
+    pars = dict((k, float(v)) for k, v in (item.split("=", 1) for item in opts.set))
+    guesses = []
+    if opts.surrogate:
+        from tools.surrogate import Surrogate
+        matches = Surrogate(opts.surrogate).nearest(data[:, 0], data[:, 1], max(1, opts.starts//4))
+        guesses = [dict(match["pars"], scale=match["scale"]*pars.get("scale", 1.0))
+                   for match in matches]
+    progress = lambda s: print("fit %3d %-9s chi2 %-12.6g nfev %d"
+                               % (s["index"], s["status"], s["chi2"], s["nfev"]))
+    solutions = fit(opts.model, data[:, 0], data[:, 1], data[:, 2] if data.shape[1] > 2 else None,
+                    opts.fit, pars=pars, starts=opts.starts, workers=opts.workers,
+                    seed=opts.seed, dominance=opts.dominance, guesses=guesses, log=progress)
+    print()
+    for solution in [s for s in solutions if "duplicate_of" not in s][:opts.top]:
+        print("chi2 %-12.6g %-9s found %d times" % (solution["chi2"], solution["status"], solution["count"]))
+        print("    " + " ".join("%s=%.6g" % (name, solution["pars"][name]) for name in opts.fit))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
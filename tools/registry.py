@@ -0,0 +1,304 @@
+r"""
+Model registry
+--------------
+
+The models of this collection are listed by name and definition file in
+models.json at the repository root.  A :class:`Registry` loads a model only
+when it is first used.  It keeps the model definitions and the compiled
+kernels in an on-disk cache, so a new process can evaluate a compiled model
+without importing its Python module (and with it SciPy) or running the C
+compiler::
+
+    python -m tools.registry --build        # fill the cache once
+
+    from tools import registry
+    model = registry.build("ccc")           # a sasmodels KernelModel
+    kernel = model.make_kernel([q])
+
+For each model the cache holds a JSON record of its parameter table and
+other plain-data definitions, and its compiled kernels.  Records are
+named by the definition file and a digest of its full path.  The record is
+checked against the SHA-256 digest of the definition file and of every C
+source the model includes.  A kernel is keyed by that digest, the sasmodels
+version, the full compiler command (compiler, CFLAGS, CPPFLAGS and LDFLAGS)
+and the precision.  Editing a source or changing a flag rebuilds only what
+it affects.  Records and kernels are written to temporary files and renamed
+into place, so any number of processes can share the cache.  Models with a
+Python Iq, such as blend_excl_vol_rpa, are loaded through sasmodels as usual.
+
+A model built from its record has no ``random()``, ``demo`` or ``tests``;
+use sasmodels.core.load_model_info for those.  The cache directory is
+``$POLYMER_MODELS_CACHE``, by default ``~/.sasmodels/polymer_models``.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+import sasmodels
+from sasmodels import generate, kerneldll
+from sasmodels.core import load_model_info, build_model
+from sasmodels.custom import load_custom_kernel_module
+from sasmodels.modelinfo import make_model_info
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MANIFEST = os.path.join(ROOT, "models.json")
+CACHE_DIR = os.environ.get("POLYMER_MODELS_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".sasmodels", "polymer_models"))
+
+#: Module attributes kept in the record of a compiled model.
+ATTRIBUTES = ("name", "title", "description", "category", "parameters", "source", "c_code",
+              "valid", "have_Fq", "radius_effective_modes", "structure_factor",
+              "profile_axes", "single", "opencl", "control", "__doc__")
+
+#: Python functions of a model definition; a model with any of them is not
+#: built from its record.
+FUNCTIONS = ("Iq", "Iqxy", "Iqac", "Iqabc", "Imagnetic", "form_volume", "shell_volume",
+             "radius_effective", "profile", "sesans", "ER")
+
+
+def manifest(filename=MANIFEST):
+    """
+    Entries {"name", "path"} of the models in *filename*, with paths
+    relative to the directory holding it.
+    """
+    with open(filename) as fid:
+        return json.load(fid)["models"]
+
+
+def _digest(files):
+    sha = hashlib.sha256()
+    for path in files:
+        with open(path, "rb") as fid:
+            sha.update(fid.read())
+    return sha.hexdigest()
+
+
+def _cache_name(path):
+    # File name stem in the cache for the model at *path*: its base name,
+    # for reading, and a digest of the full path, since models in
+    # different directories may share a base name.
+    digest = hashlib.sha256(path.encode("utf-8")).hexdigest()[:16]
+    return "%s_%s" % (os.path.splitext(os.path.basename(path))[0], digest)
+
+
+def _plain(value):
+    # NumPy scalars in parameter tables.
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def _replace(directory, suffix, write, target):
+    """
+    Create *target* atomically: *write* is called with the path of a
+    temporary file in *directory*, which is then renamed to *target*.
+    """
+    fd, tmp = tempfile.mkstemp(suffix=suffix, dir=directory)
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+class Registry(object):
+    """
+    The models of a manifest, loaded on first use and cached in *cache_dir*.
+
+    Models are given by name, or by the path of a definition file, which
+    need not be in the manifest.  Relative paths are taken from the
+    directory of the manifest.
+    """
+    def __init__(self, filename=MANIFEST, cache_dir=CACHE_DIR):
+        self.root = os.path.dirname(os.path.abspath(filename))
+        self.paths = OrderedDict((entry["name"], os.path.join(self.root, entry["path"]))
+                                 for entry in manifest(filename))
+        self.cache_dir = cache_dir
+        self._records = {}
+        self._info = {}
+        self._models = {}
+
+    def names(self):
+        """
+        Names of the models in the manifest.
+        """
+        return list(self.paths)
+
+    def path(self, model):
+        """
+        Definition file of *model*.
+        """
+        if model in self.paths:
+            return self.paths[model]
+        path = os.path.abspath(os.path.join(self.root, model))
+        if not os.path.exists(path):
+            raise KeyError("unknown model %r" % model)
+        return path
+
+    def record(self, model):
+        """
+        Cached definitions of *model*: a dict with keys path, files, digest,
+        compiled and definitions.  The record is rebuilt, importing the
+        model, if any of its files changed.
+        """
+        path = self.path(model)
+        if path in self._records:
+            return self._records[path]
+        filename = os.path.join(self.cache_dir, _cache_name(path) + ".json")
+        record = None
+        try:
+            with open(filename) as fid:
+                record = json.load(fid)
+            if record["path"] != path or record["digest"] != _digest(record["files"]):
+                record = None
+        except (IOError, OSError, ValueError, KeyError):
+            record = None
+        if record is None:
+            module = load_custom_kernel_module(path)
+            info = make_model_info(module)
+            files = [path] + generate.model_sources(info)
+            compiled = not any(callable(getattr(module, f, None)) for f in FUNCTIONS)
+            definitions = (dict((k, getattr(module, k)) for k in ATTRIBUTES if hasattr(module, k))
+                           if compiled else {})
+            record = dict(path=path, files=files, digest=_digest(files), compiled=compiled,
+                          definitions=definitions)
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, exist_ok=True)
+            text = json.dumps(record, default=_plain)
+            def write(tmp):
+                with open(tmp, "w") as fid:
+                    fid.write(text)
+            _replace(self.cache_dir, ".json", write, filename)
+            self._info[path] = info
+        self._records[path] = record
+        return record
+
+    def info(self, model):
+        """
+        sasmodels ModelInfo of *model*, built from its record if the model is
+        compiled, so without importing the model.
+        """
+        path = self.path(model)
+        if path not in self._info:
+            record = self.record(model)
+            if path not in self._info:
+                if record["compiled"]:
+                    module = types.ModuleType(str(record["definitions"]["name"]))
+                    module.__dict__.update(record["definitions"])
+                    module.__file__ = path
+                    self._info[path] = make_model_info(module)
+                else:
+                    self._info[path] = load_model_info(path)
+        return self._info[path]
+
+    def kernel(self, model, dtype="double"):
+        """
+        Path of the compiled kernel of *model* at precision *dtype*,
+        compiling it into the cache if needed.
+        """
+        record = self.record(model)
+        if not record["compiled"]:
+            raise ValueError("%s has no compiled kernel" % model)
+        dtype = np.dtype(dtype)
+        command = kerneldll.compile_command(source="SOURCE", output="OUTPUT")
+        key = "\n".join([record["digest"], sasmodels.__version__, " ".join(command), dtype.str])
+        tag = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(record["path"]))[0]
+        dll = os.path.join(self.cache_dir, "%s%d_%s.so" % (name, 8*dtype.itemsize, tag))
+        if not os.path.exists(dll):
+            source = generate.convert_type(generate.make_source(self.info(model))["dll"], dtype)
+            fd, filename = tempfile.mkstemp(suffix=".c", prefix=name + "_", dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, "w") as fid:
+                    fid.write(source)
+                _replace(self.cache_dir, ".so",
+                         lambda output: kerneldll.compile_model(source=filename, output=output), dll)
+            finally:
+                os.unlink(filename)
+        return dll
+
+    def build(self, model, dtype="double"):
+        """
+        sasmodels KernelModel of *model*, built on first use.
+        """
+        path = self.path(model)
+        key = (path, np.dtype(dtype).str)
+        if key not in self._models:
+            info = self.info(model)
+            if self.record(model)["compiled"]:
+                self._models[key] = kerneldll.DllModel(self.kernel(model, dtype), info, np.dtype(dtype))
+            else:
+                self._models[key] = build_model(info, platform="dll")
+        return self._models[key]
+
+
+_REGISTRY = []
+
+
+def default():
+    """
+    The registry of models.json, created on first use.
+    """
+    if not _REGISTRY:
+        _REGISTRY.append(Registry())
+    return _REGISTRY[0]
+
+
+def info(model):
+    """
+    ModelInfo of *model* from the default registry; see :meth:`Registry.info`.
+    """
+    return default().info(model)
+
+
+def build(model, dtype="double"):
+    """
+    KernelModel of *model* from the default registry; see :meth:`Registry.build`.
+    """
+    return default().build(model, dtype)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("models", nargs="*", help="model names or files; default all")
+    parser.add_argument("--build", action="store_true",
+                        help="compile the kernels into the cache")
+    parser.add_argument("--dtype", default="double", help="precision of the kernels")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    opts = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    registry = Registry(cache_dir=opts.cache_dir)
+    failed = 0
+    for model in opts.models or registry.names():
+        start = time.time()
+        record = registry.record(model)
+        status = "compiled" if record["compiled"] else "python"
+        if record["compiled"] and opts.build:
+            try:
+                registry.kernel(model, opts.dtype)
+            except RuntimeError as exc:
+                status = "FAILED"
+                failed += 1
+                print(exc, file=sys.stderr)
+        print("%-20s %-8s %6.3f s  %s" % (model, status, time.time() - start,
+                                          os.path.relpath(record["path"], ROOT)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
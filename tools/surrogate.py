@@ -0,0 +1,273 @@
+r"""
+Surrogate tables for initial guesses
+------------------------------------
+
+Precomputes model curves over a low-discrepancy (Sobol) sample of the
+parameter space and answers "which parameters give the curves closest to
+this dataset" in milliseconds.  The answers are starting points for a fit,
+e.g. with tools/multistart.py::
+
+    python -m tools.surrogate build Core-Chain-Chain/ccc.py ccc_table \
+        --vary radius rg1 rg2 nu1 nu2 --size 65536
+    python -m tools.surrogate query ccc_table data.txt -k 5
+
+Each parameter is sampled over its range from the model's parameter table.
+A half-open limit such as [0, inf] is replaced by
+[default/RANGE_FACTOR, default*RANGE_FACTOR], and positive ranges are
+sampled in log space.  Ranges can be given explicitly with --range.
+
+The table is a directory of NumPy .npy files plus meta.json:
+
+* ``features.npy``: float32 (size, nq), log I(q) minus its mean over q;
+* ``offsets.npy``: the subtracted means;
+* ``pars.npy``: float64 (size, nvary), the sampled parameter values.
+
+:class:`Surrogate` opens the arrays with ``mmap_mode="r"``, so any number of
+processes can query the same table while the operating system keeps a
+single copy in its page cache.  A query interpolates log I of the data
+onto the table q values inside the data range.  It then ranks the entries
+by their squared distance from the data with the best constant offset
+removed, which makes the match independent of the overall scale.  The
+search is exact, in blocks of rows: about 35 ms on one core for 65536
+curves of 200 points.
+
+``python -m tools.multistart ... --surrogate ccc_table`` starts the first
+fits from the closest table entries.
+"""
+
+import argparse
+import json
+import os
+import sys
+import warnings
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.stats import qmc
+
+from sasmodels.core import load_model_info, build_model
+from sasmodels.direct_model import call_kernel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZE = 1 << 14
+DEFAULT_Q = np.logspace(-3, 0, 200)
+
+#: Half-open ranges become [default/RANGE_FACTOR, default*RANGE_FACTOR].
+RANGE_FACTOR = 4.0
+
+#: Rows compared at once in a query.
+BLOCK_SIZE = 8192
+
+#: Intensities are clipped to this fraction of the curve maximum before the log.
+FLOOR = 1e-30
+
+
+def default_ranges(info, names):
+    """
+    {name: (lower, upper)} sampling range of each parameter in *names*.
+    """
+    table = dict((p.name, p) for p in info.parameters.kernel_parameters)
+    ranges = {}
+    for name in names:
+        p = table[name]
+        lower, upper = (float(v) for v in p.limits)
+        if not (np.isfinite(lower) and np.isfinite(upper)):
+            default = float(p.default)
+            if default == 0.0:
+                raise ValueError("no range for %s; give one with --range" % name)
+            lower = max(lower, default/RANGE_FACTOR if default > 0 else default*RANGE_FACTOR)
+            upper = min(upper, default*RANGE_FACTOR if default > 0 else default/RANGE_FACTOR)
+        ranges[name] = (lower, upper)
+    return ranges
+
+
+def sample(ranges, names, size, seed=0):
+    """
+    Scrambled Sobol sample of *size* points; positive ranges in log space.
+    """
+    return from_unit(qmc.Sobol(len(names), scramble=True, seed=seed).random(size), ranges, names)
+
+
+def from_unit(unit, ranges, names):
+    """
+    Map points *unit* in the unit cube onto *ranges*, in log space for
+    positive ranges.
+    """
+    lower = np.array([ranges[name][0] for name in names], dtype=float)
+    upper = np.array([ranges[name][1] for name in names], dtype=float)
+    log = lower > 0
+    lo = np.where(log, np.log(np.where(log, lower, 1.0)), lower)
+    hi = np.where(log, np.log(np.where(log, upper, 1.0)), upper)
+    values = lo + unit*(hi - lo)
+    return np.where(log, np.exp(values), values)
+
+
+def features(Iq):
+    """
+    log I(q) with its mean removed, and the mean.
+    """
+    Iq = np.asarray(Iq, dtype=float)
+    floor = FLOOR*np.max(np.abs(Iq), axis=-1, keepdims=True)
+    logI = np.log(np.maximum(Iq, np.maximum(floor, np.finfo(float).tiny)))
+    offset = logI.mean(axis=-1)
+    return logI - offset[..., None], offset
+
+
+def build(path, directory, names, size=DEFAULT_SIZE, q=DEFAULT_Q, pars=None, ranges=None,
+          seed=0, log=None):
+    """
+    Build a surrogate table for the model at *path* in *directory*.
+
+    :param path:           Model definition file
+    :param directory:      Output directory, created if needed
+    :param names:          Parameters to vary
+    :param size:           Number of curves
+    :param q:              q values of the curves
+    :param pars:           Values of the other parameters
+    :param ranges:         {name: (lower, upper)} overriding the default ranges
+    :param seed:           Seed for the Sobol scrambling
+    :param log:            Function called with the number of curves done
+    """
+    info = load_model_info(os.path.join(ROOT, path))
+    names = list(names)
+    all_ranges = default_ranges(info, [name for name in names if name not in (ranges or {})])
+    all_ranges.update(ranges or {})
+    values = sample(all_ranges, names, size, seed)
+    q = np.asarray(q, dtype=float)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    table = open_memmap(os.path.join(directory, "features.npy"), mode="w+",
+                        dtype=np.float32, shape=(size, len(q)))
+    offsets = np.empty(size)
+    kernel = build_model(info, platform="dll").make_kernel([q])
+    fixed = dict(pars or {}, scale=1.0, background=0.0)
+    try:
+        for k, point in enumerate(values):
+            table[k], offsets[k] = features(call_kernel(kernel, dict(fixed, **dict(zip(names, point)))))
+            if log is not None and (k + 1) % 1000 == 0:
+                log(k + 1)
+    finally:
+        kernel.release()
+    table.flush()
+    del table
+    np.save(os.path.join(directory, "offsets.npy"), offsets)
+    np.save(os.path.join(directory, "pars.npy"), values)
+    meta = dict(model=path, names=names, q=q.tolist(), pars=fixed, seed=seed,
+                ranges=dict((name, list(all_ranges[name])) for name in names))
+    with open(os.path.join(directory, "meta.json"), "w") as fid:
+        json.dump(meta, fid, indent=1)
+
+
+class Surrogate(object):
+    """
+    Read-only, memory-mapped surrogate table.
+
+    *names*, *q*, *pars* (fixed parameter values) and *ranges* come from
+    the table metadata; *values* is the (size, nvary) array of sampled
+    parameters.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as fid:
+            meta = json.load(fid)
+        self.model = meta["model"]
+        self.names = meta["names"]
+        self.q = np.array(meta["q"])
+        self.pars = meta["pars"]
+        self.ranges = meta["ranges"]
+        self.features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self.values = np.load(os.path.join(directory, "pars.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.values)
+
+    def nearest(self, q, Iq, k=5, background=0.0):
+        """
+        The *k* table entries closest to the data, best first.
+
+        Returns a list of {"pars", "scale", "distance"} records, where
+        "pars" holds the varied parameters, "scale" the multiplier that best
+        matches the data, and "distance" the rms difference in log I.
+        """
+        q = np.asarray(q, dtype=float)
+        logI = np.log(np.maximum(np.asarray(Iq, dtype=float) - background,
+                                 np.finfo(float).tiny))
+        order = np.argsort(q)
+        mask = (self.q >= q[order[0]]) & (self.q <= q[order[-1]])
+        if mask.sum() < 2:
+            raise ValueError("data q range does not overlap the table")
+        target = np.interp(self.q[mask], q[order], logI[order]).astype(np.float32)
+        columns = np.flatnonzero(mask)
+        columns = slice(columns[0], columns[-1] + 1)
+
+        k = min(k, len(self))
+        best_distance = np.empty(0)
+        best_index = np.empty(0, dtype=int)
+        for start in range(0, len(self), BLOCK_SIZE):
+            diff = target - self.features[start:start + BLOCK_SIZE, columns]
+            diff -= diff.mean(axis=1, keepdims=True)
+            distance = np.einsum("ij,ij->i", diff, diff).astype(float)
+            best_distance = np.concatenate((best_distance, distance))
+            best_index = np.concatenate((best_index, start + np.arange(len(distance))))
+            if len(best_distance) > k:
+                keep = np.argpartition(best_distance, k - 1)[:k]
+                best_distance, best_index = best_distance[keep], best_index[keep]
+        ranking = np.argsort(best_distance, kind="stable")
+        npoints = columns.stop - columns.start
+        result = []
+        for index, distance in zip(best_index[ranking], best_distance[ranking]):
+            shift = np.mean(target - self.features[index, columns], dtype=float) - self.offsets[index]
+            result.append(dict(pars=dict(zip(self.names, self.values[index].tolist())),
+                               scale=float(np.exp(shift)),
+                               distance=float(np.sqrt(distance/npoints))))
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    make = commands.add_parser("build", help="build a table")
+    make.add_argument("model", help="model file relative to the repository root")
+    make.add_argument("directory")
+    make.add_argument("--vary", nargs="+", required=True, help="parameters to sample")
+    make.add_argument("--size", type=int, default=DEFAULT_SIZE)
+    make.add_argument("--qmin", type=float, default=DEFAULT_Q[0])
+    make.add_argument("--qmax", type=float, default=DEFAULT_Q[-1])
+    make.add_argument("--nq", type=int, default=len(DEFAULT_Q))
+    make.add_argument("--range", nargs=3, action="append", default=[],
+                      metavar=("NAME", "LOWER", "UPPER"))
+    make.add_argument("--set", nargs="+", default=[], metavar="NAME=VALUE",
+                      help="values of the other parameters")
+    make.add_argument("--seed", type=int, default=0)
+    find = commands.add_parser("query", help="find the closest curves to a dataset")
+    find.add_argument("directory")
+    find.add_argument("data", help="text file with columns q and I(q)")
+    find.add_argument("-k", type=int, default=5)
+    find.add_argument("--background", type=float, default=0.0)
+    opts = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    if opts.command == "build":
+        build(opts.model, opts.directory, opts.vary, size=opts.size,
+              q=np.logspace(np.log10(opts.qmin), np.log10(opts.qmax), opts.nq),
+              pars=dict((k, float(v)) for k, v in (item.split("=", 1) for item in opts.set)),
+              ranges=dict((name, (float(lo), float(hi))) for name, lo, hi in opts.range),
+              seed=opts.seed, log=lambda n: print("%d curves" % n))
+    elif opts.command == "query":
+        data = np.loadtxt(opts.data, ndmin=2)
+        for match in Surrogate(opts.directory).nearest(data[:, 0], data[:, 1], opts.k,
+                                                       opts.background):
+            print("distance %-10.4g scale %-10.4g %s" % (
+                match["distance"], match["scale"],
+                " ".join("%s=%.6g" % item for item in match["pars"].items())))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+r"""
+Synthetic datasets
+------------------
+
+Generates large sets of simulated SANS curves, e.g. to train parameter
+estimators, and writes them to disk in chunks as it goes::
+
+    python -m tools.synthetic Core-Chain-Chain/ccc.py ccc_train \
+        --vary radius rg1 rg2 nu1 nu2 --size 10000000 --noise poisson \
+        --exposure 1e4 --dq-over-q 0.05 --workers 16
+
+Parameters are drawn independently and uniformly over the ranges of
+tools/surrogate.py, in log space for positive ranges, with --range to
+override them.  Each chunk of *chunk_size* curves is evaluated with the
+model's vectorized ``Iq_batch``, *batch_size* curves at a time, so the memory
+used depends only on those two sizes and not on the number of curves.
+With --dq-over-q or --slit-length the curves are smeared with
+lib/smearing.py; the slit grid is fitted to the model at its fixed
+parameters.
+
+Noise models counting statistics, with *exposure* counts per unit of
+intensity at every q (a scalar, or an array over q):
+
+* ``poisson``: I = N/exposure with N ~ Poisson(exposure*I);
+* ``gaussian``: I ~ Normal(I, I/exposure), its large count limit;
+* ``none``: no noise; dI is zero.
+
+The output directory holds meta.json and, for chunk k, the NumPy files
+``pars_k.npy`` (float64, drawn values of the varied parameters),
+``Iq_k.npy`` and ``dIq_k.npy`` (float32) and ``valid_k.npy``, which is
+false for curves with a negative or non-finite noiseless intensity.
+Chunk k uses a random generator seeded with (seed, k), so every chunk is
+reproducible on its own.  The finished chunks are recorded in
+``checkpoint.json`` after their files are complete.  Running the same
+command again after an interruption generates only the missing chunks, and
+gives the same dataset as an uninterrupted run.  Read the result with
+:class:`Dataset`, which memory-maps the chunks.
+"""
+
+import argparse
+import json
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from sasmodels.core import load_model_info
+from sasmodels.custom import load_custom_kernel_module
+
+from tools.surrogate import DEFAULT_Q, default_ranges, from_unit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZE = 1 << 20
+
+#: Curves per output chunk.
+CHUNK_SIZE = 1 << 16
+
+#: Curves evaluated at once by Iq_batch.
+BATCH_SIZE = 256
+
+NOISE = ("none", "poisson", "gaussian")
+
+CHECKPOINT = "checkpoint.json"
+
+# Per-process state, set by _init_worker.
+_STATE = {}
+
+
+def chunk_files(directory, index):
+    """
+    {name: path} of the files of chunk *index*.
+    """
+    return dict((name, os.path.join(directory, "%s_%06d.npy" % (name, index)))
+                for name in ("pars", "Iq", "dIq", "valid"))
+
+
+def add_noise(Iq, noise, exposure, rng):
+    """
+    Noisy intensities and their uncertainties for the noiseless *Iq*.
+    """
+    if noise == "none":
+        return Iq, np.zeros_like(Iq)
+    if noise == "poisson":
+        counts = rng.poisson(Iq*exposure)
+        return counts/exposure, np.sqrt(np.maximum(counts, 1))/exposure
+    if noise == "gaussian":
+        dIq = np.sqrt(Iq/exposure)
+        return Iq + dIq*rng.standard_normal(Iq.shape), dIq
+    raise ValueError("noise must be one of %s" % ", ".join(NOISE))
+
+
+def _init_worker(meta):
+    warnings.simplefilter("ignore")
+    _STATE.update(meta=meta, module=load_custom_kernel_module(os.path.join(ROOT, meta["model"])),
+                  q_calc=np.array(meta["q"]), smear=None)
+    if meta["dq"] is not None or meta["slit_length"] is not None:
+        smearing = load_custom_kernel_module(os.path.join(ROOT, "lib", "smearing.py"))
+        _STATE["smear"] = smearing.smearing(
+            meta["q"], meta["dq"], meta["slit_length"],
+            Iq=lambda q: _STATE["module"].Iq_batch(q, **meta["pars"]))
+        _STATE["q_calc"] = _STATE["smear"].q_calc
+
+
+def _generate(task):
+    index, directory = task
+    meta, module, smear = _STATE["meta"], _STATE["module"], _STATE["smear"]
+    names = meta["names"]
+    start = index*meta["chunk_size"]
+    size = min(meta["chunk_size"], meta["size"] - start)
+    rng = np.random.default_rng([meta["seed"], index])
+    values = from_unit(rng.random((size, len(names))), meta["ranges"], names)
+
+    nq = len(meta["q"])
+    Iq, dIq = np.empty((size, nq), dtype=np.float32), np.empty((size, nq), dtype=np.float32)
+    valid = np.empty(size, dtype=bool)
+    exposure = np.asarray(meta["exposure"], dtype=float)
+    for lo in range(0, size, meta["batch_size"]):
+        hi = min(lo + meta["batch_size"], size)
+        pars = dict(meta["pars"], **dict(zip(names, values[lo:hi].T)))
+        clean = module.Iq_batch(_STATE["q_calc"], **pars)
+        if smear is not None:
+            clean = smear.apply(clean)
+        valid[lo:hi] = np.all(np.isfinite(clean) & (clean >= 0), axis=-1)
+        clean = np.where(valid[lo:hi, None], clean, 0.0)
+        Iq[lo:hi], dIq[lo:hi] = add_noise(clean, meta["noise"], exposure, rng)
+
+    # Write to temporary names first so a chunk is never left half written.
+    for name, data in zip(("pars", "Iq", "dIq", "valid"), (values, Iq, dIq, valid)):
+        path = chunk_files(directory, index)[name]
+        with open(path + ".tmp", "wb") as fid:
+            np.save(fid, data)
+        os.replace(path + ".tmp", path)
+    return index, int(valid.sum())
+
+
+def _read_checkpoint(directory):
+    path = os.path.join(directory, CHECKPOINT)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as fid:
+        return set(json.load(fid)["done"])
+
+
+def _write_checkpoint(directory, done):
+    path = os.path.join(directory, CHECKPOINT)
+    with open(path + ".tmp", "w") as fid:
+        json.dump(dict(done=sorted(done)), fid)
+    os.replace(path + ".tmp", path)
+
+
+def generate(path, directory, names, size=DEFAULT_SIZE, q=DEFAULT_Q, pars=None, ranges=None,
+             noise="poisson", exposure=1e4, dq=None, slit_length=None, seed=0,
+             chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE, workers=1, log=None):
+    """
+    Generate *size* noisy curves of the model at *path* into *directory*,
+    or finish an interrupted run with the same arguments.
+
+    :param path:           Model definition file
+    :param directory:      Output directory, created if needed
+    :param names:          Parameters to vary
+    :param size:           Number of curves
+    :param q:              q values of the curves
+    :param pars:           Values of the other parameters, including scale and background
+    :param ranges:         {name: (lower, upper)} overriding the default ranges
+    :param noise:          "poisson", "gaussian" or "none"
+    :param exposure:       Counts per unit intensity; scalar or array over q
+    :param dq:             Pinhole resolution at each q, for smearing
+    :param slit_length:    Slit length, for slit smearing
+    :param seed:           Seed of the random generators
+    :param chunk_size:     Curves per output chunk
+    :param batch_size:     Curves evaluated at once
+    :param workers:        Number of processes
+    :param log:            Function called with (chunk index, number of valid curves)
+    """
+    if noise not in NOISE:
+        raise ValueError("noise must be one of %s" % ", ".join(NOISE))
+    info = load_model_info(os.path.join(ROOT, path))
+    module = load_custom_kernel_module(os.path.join(ROOT, path))
+    if not hasattr(module, "Iq_batch"):
+        raise ValueError("model has no Iq_batch")
+    names = list(names)
+    all_ranges = default_ranges(info, [name for name in names if name not in (ranges or {})])
+    all_ranges.update(ranges or {})
+    tolist = lambda v: None if v is None else np.asarray(v, dtype=float).tolist()
+    meta = dict(model=path, names=names, size=size, q=tolist(q),
+                pars=dict(dict(scale=1.0, background=0.0), **(pars or {})),
+                ranges=dict((name, [float(v) for v in all_ranges[name]]) for name in names),
+                noise=noise, exposure=tolist(exposure), dq=tolist(dq),
+                slit_length=tolist(slit_length), seed=seed, chunk_size=chunk_size,
+                batch_size=batch_size)
+
+    meta_path = os.path.join(directory, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as fid:
+            previous = json.load(fid)
+        if previous != json.loads(json.dumps(meta)):
+            raise ValueError("%s holds a different dataset" % directory)
+    else:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(meta_path, "w") as fid:
+            json.dump(meta, fid, indent=1)
+
+    done = _read_checkpoint(directory)
+    tasks = [(k, directory) for k in range(-(-size//chunk_size)) if k not in done]
+    if workers == 1:
+        _init_worker(meta)
+        results = (_generate(task) for task in tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(meta,))
+        results = (future.result() for future in
+                   as_completed([pool.submit(_generate, task) for task in tasks]))
+    try:
+        for index, nvalid in results:
+            done.add(index)
+            _write_checkpoint(directory, done)
+            if log is not None:
+                log(index, nvalid)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+class Dataset(object):
+    """
+    Read-only view of a finished synthetic dataset.
+
+    *names*, *q*, *pars* (fixed parameter values) and the generation
+    settings come from meta.json.  Iterating gives one
+    {"pars", "Iq", "dIq", "valid"} record of memory-mapped arrays per chunk.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as fid:
+            self.meta = json.load(fid)
+        self.directory = directory
+        self.names = self.meta["names"]
+        self.q = np.array(self.meta["q"])
+        self.pars = self.meta["pars"]
+        nchunks = -(-self.meta["size"]//self.meta["chunk_size"])
+        missing = set(range(nchunks)) - _read_checkpoint(directory)
+        if missing:
+            raise ValueError("%s is incomplete: %d of %d chunks missing"
+                             % (directory, len(missing), nchunks))
+        self.nchunks = nchunks
+
+    def __len__(self):
+        return self.meta["size"]
+
+    def chunk(self, index):
+        """
+        Memory-mapped arrays of chunk *index*.
+        """
+        return dict((name, np.load(path, mmap_mode="r"))
+                    for name, path in chunk_files(self.directory, index).items())
+
+    def __iter__(self):
+        for index in range(self.nchunks):
+            yield self.chunk(index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("model", help="model file relative to the repository root")
+    parser.add_argument("directory")
+    parser.add_argument("--vary", nargs="+", required=True, help="parameters to sample")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE)
+    parser.add_argument("--qmin", type=float, default=DEFAULT_Q[0])
+    parser.add_argument("--qmax", type=float, default=DEFAULT_Q[-1])
+    parser.add_argument("--nq", type=int, default=len(DEFAULT_Q))
+    parser.add_argument("--range", nargs=3, action="append", default=[],
+                        metavar=("NAME", "LOWER", "UPPER"))
+    parser.add_argument("--set", nargs="+", default=[], metavar="NAME=VALUE",
+                        help="values of the other parameters")
+    parser.add_argument("--noise", choices=NOISE, default="poisson")
+    parser.add_argument("--exposure", type=float, default=1e4,
+                        help="counts per unit intensity")
+    parser.add_argument("--dq-over-q", type=float, help="relative pinhole resolution")
+    parser.add_argument("--slit-length", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    opts = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    q = np.logspace(np.log10(opts.qmin), np.log10(opts.qmax), opts.nq)
+    generate(opts.model, opts.directory, opts.vary, size=opts.size, q=q,
+             pars=dict((k, float(v)) for k, v in (item.split("=", 1) for item in opts.set)),
+             ranges=dict((name, (float(lo), float(hi))) for name, lo, hi in opts.range),
+             noise=opts.noise, exposure=opts.exposure,
+             dq=None if opts.dq_over_q is None else opts.dq_over_q*q,
+             slit_length=opts.slit_length, seed=opts.seed, chunk_size=opts.chunk_size,
+             batch_size=opts.batch_size, workers=opts.workers,
+             log=lambda k, n: print("chunk %d: %d valid curves" % (k, n)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())